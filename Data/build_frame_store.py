@@ -0,0 +1,77 @@
+import argparse
+import json
+import os
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+
+# BGR statistics the datasets normalise with
+mean_I = np.reshape(np.array([118.93, 113.97, 102.60]), (1, 1, 3))
+std_I = np.reshape(np.array([69.85, 68.81, 72.45]), (1, 1, 3))
+
+
+def frame_names(list_path):
+    """
+    :return: unique frame names of a pair list in first-seen order, relative to its image folder
+    """
+    names = OrderedDict()
+    for line in open(list_path, 'r'):
+        for name in line.split():
+            if name[-1] == 'M':
+                # 'LM' tag of the test pairs
+                name = name[:-2]
+            names[name] = None
+    return list(names)
+
+
+def read_frame(path):
+    """
+    :return: BGR frame of a jpg/png, or of a raw .npy of video2img.py --ext npy, None if unreadable
+    """
+    if path.endswith('.npy'):
+        img = np.load(path)
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR) if img.ndim == 2 else img
+    return cv2.imread(path)
+
+
+def build_frame_store(list_path, img_path, out_path, dtype='uint8', width=640, height=360):
+    """
+    Decode, resize and (for float16) normalise every frame of a pair list once, into
+    out_path.npy with one frame per row and out_path.json with the name -> row index
+    :param dtype: 'uint8' keeps the BGR frames, 'float16' stores the normalised gray the datasets compute
+    """
+    names = frame_names(list_path)
+    channels = 3 if dtype == 'uint8' else 1
+    frames = np.lib.format.open_memmap(out_path + '.npy', mode='w+', dtype=dtype,
+                                       shape=(len(names), height, width, channels))
+    for row, name in enumerate(names):
+        img = read_frame(os.path.join(img_path, name))
+        if img is None:
+            raise IOError('can not read {}'.format(os.path.join(img_path, name)))
+        if img.shape[0] != height or img.shape[1] != width:
+            img = cv2.resize(img, (width, height))
+        if dtype != 'uint8':
+            img = np.mean((img - mean_I) / std_I, axis=2, keepdims=True)
+        frames[row] = img
+    frames.flush()
+
+    with open(out_path + '.json', 'w') as f:
+        json.dump({'dtype': dtype, 'height': height, 'width': width, 'names': names}, f)
+    print('{} frames of {} -> {}.npy'.format(len(names), list_path, out_path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default='./', help='folder with Train_List.txt, Test_List.txt, Train/ and Test/')
+    parser.add_argument('--splits', type=str, nargs='+', default=['Train', 'Test'])
+    parser.add_argument('--dtype', type=str, default='uint8', choices=['uint8', 'float16'])
+    parser.add_argument('--img_w', type=int, default=640)
+    parser.add_argument('--img_h', type=int, default=360)
+    args = parser.parse_args()
+
+    for split in args.splits:
+        # eg: ./Train_List.txt + ./Train/ -> ./Train_frames.npy, ./Train_frames.json
+        build_frame_store(os.path.join(args.data_dir, split + '_List.txt'), os.path.join(args.data_dir, split),
+                          os.path.join(args.data_dir, split + '_frames'), args.dtype, args.img_w, args.img_h)
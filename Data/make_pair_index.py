@@ -0,0 +1,126 @@
+import argparse
+import os
+
+import cv2
+import numpy as np
+
+
+def scan_frames(root, ext='jpg'):
+    """
+    Frames extracted by video2img.py: root/<video>/<video>_<10000+i>.<ext>
+    :return: list of per-video lists of frame names relative to root, in frame order
+    """
+    videos = []
+    for folder, _, files in sorted(os.walk(root)):
+        frames = sorted(f for f in files if f.endswith('.' + ext))
+        if frames:
+            rel = os.path.relpath(folder, root)
+            videos.append([f if rel == '.' else rel + '/' + f for f in frames])
+    return videos
+
+
+def scan_videos(root, ext='jpg'):
+    """
+    Frame names video2img.py would extract from the videos in root, without extracting them
+    :return: list of per-video lists of frame names relative to root, in frame order
+    """
+    videos = []
+    for video_name in sorted(os.listdir(root)):
+        path = os.path.join(root, video_name)
+        if not os.path.isfile(path):
+            continue
+        vc = cv2.VideoCapture(path)
+        count = int(vc.get(cv2.CAP_PROP_FRAME_COUNT)) if vc.isOpened() else 0
+        vc.release()
+        file_name = video_name.split('.')[0]
+        if count > 0:
+            videos.append(['{0}/{0}_{1}.{2}'.format(file_name, c + 10000, ext) for c in range(1, count + 1)])
+    return videos
+
+
+def read_pair_list(list_path):
+    """
+    Pairs of an existing Train_List.txt / Test_List.txt, without the 'LM' tags of the test pairs
+    :return: frame names, (n, 2) indices into them
+    """
+    ids, names, pairs = {}, [], []
+    for line in open(list_path, 'r'):
+        pair = []
+        for name in line.split():
+            if name[-1] == 'M':
+                name = name[:-2]
+            if name not in ids:
+                ids[name] = len(names)
+                names.append(name)
+            pair.append(ids[name])
+        pairs.append(pair)
+    return names, np.array(pairs, dtype=np.int32).reshape(-1, 2)
+
+
+def sample_gaps(rng, size, min_gap, max_gap, gap_dist='uniform', p=0.3):
+    if gap_dist == 'uniform':
+        return rng.randint(min_gap, max_gap + 1, size)
+    # geometric: small gaps are the most likely, min_gap with probability p
+    return np.minimum(min_gap - 1 + rng.geometric(p, size), max_gap)
+
+
+def make_pairs(videos, min_gap=1, max_gap=8, gap_dist='uniform', p=0.3, pairs_per_frame=1, seed=0):
+    """
+    Pair every frame pairs_per_frame times with a later frame of the same video
+    :return: frame names, (n, 2) indices into them
+    """
+    rng = np.random.RandomState(seed)
+    names, pairs, base = [], [], 0
+    for frames in videos:
+        first = np.repeat(np.arange(len(frames)), pairs_per_frame)
+        second = first + sample_gaps(rng, len(first), min_gap, max_gap, gap_dist, p)
+        keep = second < len(frames)
+        pairs.append(np.stack([first[keep], second[keep]], axis=1) + base)
+        names.extend(frames)
+        base += len(frames)
+    pairs = np.concatenate(pairs, axis=0) if pairs else np.zeros((0, 2), dtype=np.int64)
+    return names, pairs.astype(np.int32)
+
+
+def save_pair_index(out_path, names, pairs):
+    """
+    Write the index dataset.PairIndex reads: int32 frame-id pairs plus the frame names as one
+    utf-8 blob with int64 offsets, so a dataset holds three arrays instead of a list of strings
+    """
+    encoded = [name.encode('utf-8') for name in names]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(name) for name in encoded])
+    blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    np.savez(out_path, pairs=pairs, names=blob, offsets=offsets)
+    print('{} pairs of {} frames -> {}'.format(len(pairs), len(names), out_path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--frames', type=str, help='folder of frames extracted by video2img.py, eg: ./Train/')
+    source.add_argument('--videos', type=str, help='folder of videos, frames named as video2img.py would')
+    source.add_argument('--from_list', type=str, help='convert an existing pair list, eg: ./Train_List.txt')
+    parser.add_argument('--out', type=str, default='./Train_pairs.npz')
+    parser.add_argument('--txt', type=str, default=None, help='also write the pairs as a text pair list')
+    parser.add_argument('--ext', type=str, default='jpg', help='frame extension, jpg, png or npy')
+    parser.add_argument('--min_gap', type=int, default=1)
+    parser.add_argument('--max_gap', type=int, default=8)
+    parser.add_argument('--gap_dist', type=str, default='uniform', choices=['uniform', 'geometric'])
+    parser.add_argument('--geometric_p', type=float, default=0.3)
+    parser.add_argument('--pairs_per_frame', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.from_list is not None:
+        names, pairs = read_pair_list(args.from_list)
+    else:
+        videos = scan_frames(args.frames, args.ext) if args.frames is not None else scan_videos(args.videos, args.ext)
+        names, pairs = make_pairs(videos, args.min_gap, args.max_gap, args.gap_dist, args.geometric_p,
+                                  args.pairs_per_frame, args.seed)
+    save_pair_index(args.out, names, pairs)
+
+    if args.txt is not None:
+        with open(args.txt, 'w') as f:
+            for first, second in pairs:
+                f.write(names[first] + ' ' + names[second] + '\n')
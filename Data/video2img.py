@@ -1,34 +1,122 @@
-import cv2
+import argparse
+import json
 import os
+import time
+from functools import partial
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+
+
+MANIFEST = 'extract_manifest.json'
+
+
+def extract_video(video_path, video_name, size=None, gray=False, ext='jpg', quality=95):
+    """
+    Write every frame of video_path/video_name to video_path/<name>/<name>_<10000+i>.<ext>, i from 1
+    :param size: (width, height) to resize the frames to, None keeps the video resolution
+    :param gray: store single-channel gray frames
+    :param ext: 'jpg' (with quality), 'png' or 'npy' (raw uint8 arrays)
+    :return: (video_name, number of frames, seconds)
+    """
+    start = time.time()
+    vc = cv2.VideoCapture(os.path.join(video_path, video_name))
+    c = 0
+    rval = vc.isOpened()
+    if not rval:
+        # not a video, eg. the video_index.json of dataset.VideoPairDataset
+        return video_name, c, time.time() - start
+
+    file_name = video_name.split('.')[0]
+    folder_name = os.path.join(video_path, file_name)
+    os.makedirs(folder_name, exist_ok=True)
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality] if ext == 'jpg' else []
+    while rval:
+        rval, frame = vc.read()
+        if not rval:
+            break
+        c = c + 1
+        if size is not None and (frame.shape[1], frame.shape[0]) != size:
+            frame = cv2.resize(frame, size)
+        if gray:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        img_name = os.path.join(folder_name, file_name + '_' + str(c + 10000) + '.' + ext)
+        if ext == 'npy':
+            np.save(img_name, frame)
+        else:
+            cv2.imwrite(img_name, frame, params)
+    vc.release()
+    return video_name, c, time.time() - start
+
+
+def load_manifest(video_path):
+    manifest_file = os.path.join(video_path, MANIFEST)
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(video_path, manifest):
+    manifest_file = os.path.join(video_path, MANIFEST)
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def save_img(video_path, workers=None, size=None, gray=False, ext='jpg', quality=95):
+    """
+    Extract the frames of every video in video_path with a pool of workers. Finished videos
+    are recorded in video_path/extract_manifest.json and skipped on the next run as long as
+    the video file and the extraction options are unchanged
+    """
+    options = {'size': list(size) if size is not None else None, 'gray': gray, 'ext': ext, 'quality': quality}
+    manifest = load_manifest(video_path)
+
+    todo, done = [], 0
+    for video_name in sorted(os.listdir(video_path)):
+        path = os.path.join(video_path, video_name)
+        if video_name.startswith(MANIFEST) or not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        entry = manifest.get(video_name)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime \
+                and entry['options'] == options:
+            done += 1
+            continue
+        todo.append((video_name, stat))
+    print('{}: {} videos to extract, {} already done'.format(video_path, len(todo), done))
+
+    start = time.time()
+    total_frames = 0
+    extract = partial(extract_video, video_path, size=size, gray=gray, ext=ext, quality=quality)
+    stats = dict(todo)
+    with Pool(workers) as pool:
+        for video_name, frames, seconds in pool.imap_unordered(extract, [name for name, _ in todo]):
+            stat = stats[video_name]
+            manifest[video_name] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'frames': frames, 'options': options}
+            save_manifest(video_path, manifest)
+            total_frames += frames
+            print('save_success {} {} frames, {:.1f} frames/s'.format(video_name, frames, frames / max(seconds, 1e-6)))
+    elapsed = time.time() - start
+    print('{}: {} frames in {:.1f}s, {:.1f} frames/s'.format(video_path, total_frames, elapsed,
+                                                            total_frames / max(elapsed, 1e-6)))
 
 
-def save_img(video_path):
-    videos = os.listdir(video_path)
-    for video_name in videos:
-        file_name = video_name.split('.')[0]
-        folder_name = os.path.join(video_path, file_name)
-        if not os.path.exists(folder_name):
-            os.makedirs(folder_name, exist_ok=True)
-        vc = cv2.VideoCapture(video_path+video_name)
-        c = 0
-        rval = vc.isOpened()
-
-        while rval:
-            c = c + 1
-            rval, frame = vc.read()
-            if rval:
-                frames = c + 10000
-                cv2.imwrite(os.path.join(folder_name, file_name + '_' + str(frames) + '.jpg'), frame)
-                cv2.waitKey(1)
-            else:
-                break
-        vc.release()
-        print('save_success')
-        print(folder_name)
 if __name__ == '__main__':
-    # path to video folds eg: video_path = './Test/'
-    video_path = './Test/'
-    save_img(video_path)
-    video_path = './Train/'
-    save_img(video_path)
-    
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    # path to video folds eg: ./Test/
+    parser.add_argument('--video_paths', type=str, nargs='+', default=['./Test/', './Train/'])
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes, all cpus by default')
+    parser.add_argument('--resize', action='store_true', help='Resize the frames to --img_w x --img_h')
+    parser.add_argument('--img_w', type=int, default=640)
+    parser.add_argument('--img_h', type=int, default=360)
+    parser.add_argument('--gray', action='store_true', help='Store single-channel gray frames')
+    parser.add_argument('--ext', type=str, default='jpg', choices=['jpg', 'png', 'npy'])
+    parser.add_argument('--quality', type=int, default=95, help='JPEG quality')
+    args = parser.parse_args()
+
+    size = (args.img_w, args.img_h) if args.resize else None
+    for video_path in args.video_paths:
+        save_img(video_path, args.workers, size, args.gray, args.ext, args.quality)
@@ -1,10 +1,10 @@
 import torch.nn as nn
 import torch.utils.model_zoo as model_zoo
 import torch, imageio
-from utils import transform, DLT_solve
+from utils import transform_patch, get_patch_origin, get_geometry, get_patch_corners, DLT_solve, normalize_gray
+from utils import inference_mode, siamese_forward, stage_timer, masked_triplet_loss
 
 criterion_l2 = nn.MSELoss(reduce=True, size_average=True)
-triplet_loss = nn.TripletMarginLoss(margin=1.0, p=1, reduce=False,size_average=False)
 
 __all__ = ['ResNet', 'resnet18', 'resnet34', 'resnet50', 'resnet101',
            'resnet152']
@@ -26,16 +26,20 @@ def create_gif(image_list, gif_name, duration=0.35):
     return
 
 
-def getPatchFromFullimg(patch_size_h, patch_size_w, patchIndices, batch_indices_tensor, img_full):
+def getPatchFromFullimg(patch_size_h, patch_size_w, patch_origin, img_full):
+    """
+    :param patch_origin: (x, y) crop origin of every patch, shape=(bs, 2)
+    :return: shape=(bs, c, patch_size_h, patch_size_w)
+    """
     num_batch, num_channels, height, width = img_full.size()
-    warped_images_flat = img_full.reshape(-1)
-    patch_indices_flat = patchIndices.reshape(-1)
+    patch_origin = patch_origin.long()
 
-    pixel_indices = patch_indices_flat.long() + batch_indices_tensor
-    mask_patch = torch.gather(warped_images_flat, 0, pixel_indices)
-    mask_patch = mask_patch.reshape([num_batch, 1, patch_size_h, patch_size_w])
+    batch = torch.arange(num_batch, device=img_full.device).reshape(-1, 1, 1)
+    rows = patch_origin[:, 1:] + torch.arange(patch_size_h, device=img_full.device)
+    cols = patch_origin[:, :1] + torch.arange(patch_size_w, device=img_full.device)
+    mask_patch = img_full[batch, :, rows.unsqueeze(2), cols.unsqueeze(1)]
 
-    return mask_patch
+    return mask_patch.permute(0, 3, 1, 2)
 
 
 def normMask(mask, strenth = 0.5):
@@ -133,7 +137,7 @@ class Bottleneck(nn.Module):
 # define and forward ( Because of the load is unbalanced when use torch.nn.DataParallel, we define warp in forward)
 class ResNet(nn.Module):
 
-    def __init__(self, block, layers, num_classes=1000, fix_mask=False):
+    def __init__(self, block, layers, num_classes=1000, fix_mask=False, siamese=True):
         self.inplanes = 64
         super(ResNet, self).__init__()
         self.conv1 = nn.Conv2d(2, 64, kernel_size=7, stride=2, padding=3,
@@ -148,6 +152,8 @@ class ResNet(nn.Module):
         self.avgpool = nn.AvgPool2d(7, stride=1)
         self.fc = nn.Linear(512 * block.expansion, num_classes)
         self.fix_mask = fix_mask
+        # run the shared-weight branches as one batched call, see utils.siamese_forward
+        self.siamese = siamese
 
         self.ShareFeature = nn.Sequential(
             nn.Conv2d(1, 4, kernel_size=3, padding=1, bias=False),
@@ -209,7 +215,7 @@ class ResNet(nn.Module):
 
         return nn.Sequential(*layers)
 
-    def predict_homography(self, patch_1, patch_2, h4p):
+    def regress_offsets(self, patch_1, patch_2):
 
         x = torch.cat((patch_1, patch_2), dim=1)
 
@@ -226,40 +232,106 @@ class ResNet(nn.Module):
         x = self.avgpool(x)
         x = x.view(x.size(0), -1)
         x = self.fc(x)
+
+        return x
+
+    def predict_homography(self, patch_1, patch_2, h4p):
+
+        stage_timer.mark('backbone')
+        x = self.regress_offsets(patch_1, patch_2)
+        stage_timer.mark('DLT')
         H_mat = DLT_solve(h4p, x).squeeze(1)
 
         return H_mat
 
-    def forward(self, org_imges, input_tesnors, h4p, patch_indices):
+    def predict_bidirectional(self, patch_1, patch_2, h4p):
+        """
+        predict_homography of both pair orders from one backbone pass and one DLT_solve,
+        the two orders stacked on the batch dimension (see utils.siamese_forward)
+        :return: H_mat_12, H_mat_21
+        """
+        stage_timer.mark('backbone')
+        x_12, x_21 = siamese_forward(self, [torch.cat((patch_1, patch_2), dim=1), torch.cat((patch_2, patch_1), dim=1)],
+                                     self.siamese, forward_fn=lambda x: self.regress_offsets(*x.chunk(2, dim=1)))
+        stage_timer.mark('DLT')
+        H_mat = DLT_solve(torch.cat((h4p, h4p), dim=0), torch.cat((x_12, x_21), dim=0)).squeeze(1)
+
+        return H_mat.chunk(2, dim=0)
+
+    def encode_frames(self, frames, patch_origin, patch_size_h, patch_size_w):
+        """
+        Masked ShareFeature of one patch per frame, the per-frame part of forward
+        :param frames: normalised gray, shape=(bs, 1, h, w)
+        :param patch_origin: (x, y) of the patch, shared by the batch
+        :return: shape=(bs, 1, patch_size_h, patch_size_w)
+        """
+        _, _, img_h, img_w = frames.size()
+        x, y = patch_origin
+        stage_timer.mark('genMask')
+        # genMask only needs its receptive field around the patch, not the full frame
+        halo = sum(m.padding[0] for m in self.genMask if isinstance(m, nn.Conv2d))
+        x0, y0 = max(x - halo, 0), max(y - halo, 0)
+        x1, y1 = min(x + patch_size_w + halo, img_w), min(y + patch_size_h + halo, img_h)
+        mask = self.genMask(frames[:, :, y0:y1, x0:x1])
+        mask = normMask(mask[:, :, y - y0:y - y0 + patch_size_h, x - x0:x - x0 + patch_size_w])
+
+        stage_timer.mark('ShareFeature')
+        patch = self.ShareFeature(frames[:, :, y:y + patch_size_h, x:x + patch_size_w])
+        return torch.mul(patch, mask)
+
+    def estimate_homography(self, img1, img2, patch_size_h=315, patch_size_w=560, patch_origin=None):
+        """
+        Inference-only homography of the pair: mask, features, backbone and DLT, without
+        the warps, loss and debug outputs of forward. Call eval() first
+        :param img1: uint8 BGR, shape=(bs, 3, h, w), or normalised gray, shape=(bs, 1, h, w)
+        :param patch_origin: (x, y) of the patch, the centred patch of test.py by default
+        :return: H mapping img2 pixel coordinates into img1, in full-frame pixels, shape=(bs, 3, 3)
+        """
+        batch_size, _, img_h, img_w = img1.size()
+        if patch_origin is None:
+            patch_origin = ((img_w - patch_size_w + 1) // 2, (img_h - patch_size_h + 1) // 2)
+        h4p = get_patch_corners(batch_size, patch_origin, patch_size_h, patch_size_w, img1.device)
+
+        with inference_mode():
+            stage_timer.mark('prepare')
+            frames = torch.cat((img1, img2), dim=0)
+            if frames.dtype == torch.uint8:
+                frames = normalize_gray(frames)
+            features = self.encode_frames(frames, patch_origin, patch_size_h, patch_size_w)
+            patch_1, patch_2 = features.chunk(2, dim=0)
+            return self.predict_homography(patch_1, patch_2, h4p)
+
+    def forward(self, org_imges, input_tesnors, h4p, patch_origin):
+
+        stage_timer.mark('prepare')
+        if org_imges.dtype == torch.uint8:
+            # raw BGR frames of the datasets' uint8_frames mode
+            org_imges = normalize_gray(org_imges)
+            input_tesnors = normalize_gray(input_tesnors)
 
         batch_size, _, img_h, img_w = org_imges.size()
         _, _, patch_size_h, patch_size_w = input_tesnors.size() 
 
-        y_t = torch.arange(0, batch_size * img_w * img_h, img_w * img_h)
-        batch_indices_tensor = y_t.unsqueeze(1).expand(y_t.shape[0], patch_size_h * patch_size_w).reshape(-1)
-        M_tensor = torch.tensor([[img_w / 2.0, 0., img_w / 2.0], [0., img_h / 2.0, img_h / 2.0], [0., 0., 1.]])
-
-        if torch.cuda.is_available():
-            M_tensor = M_tensor.cuda()
-            batch_indices_tensor = batch_indices_tensor.cuda()
-
-        M_tile = M_tensor.unsqueeze(0).expand(batch_size, M_tensor.shape[-2], M_tensor.shape[-1])
+        geometry = get_geometry(batch_size, img_h, img_w, patch_size_h, patch_size_w, org_imges.device)
+        M_tile, M_tile_inv = geometry.M_tile, geometry.M_tile_inv
 
-        # Inverse of M
-        M_tensor_inv = torch.inverse(M_tensor)
-        M_tile_inv = M_tensor_inv.unsqueeze(0).expand(batch_size, M_tensor_inv.shape[-2], M_tensor_inv.shape[-1])
+        if patch_origin.size()[-1] != 2:
+            # flat patch pixel indices of the old dataset contract
+            patch_origin = get_patch_origin(patch_origin, img_w)
+        stage_timer.mark('genMask')
 
-        mask_I1_full = self.genMask(org_imges[:, :1, ...])
-        mask_I2_full = self.genMask(org_imges[:, 1:, ...])
+        mask_I1_full, mask_I2_full = siamese_forward(self.genMask, [org_imges[:, :1, ...], org_imges[:, 1:, ...]],
+                                                     self.siamese)
 
-        mask_I1 = getPatchFromFullimg(patch_size_h, patch_size_w, patch_indices, batch_indices_tensor, mask_I1_full)
-        mask_I2 = getPatchFromFullimg(patch_size_h, patch_size_w, patch_indices, batch_indices_tensor, mask_I2_full)
+        mask_I1 = getPatchFromFullimg(patch_size_h, patch_size_w, patch_origin, mask_I1_full)
+        mask_I2 = getPatchFromFullimg(patch_size_h, patch_size_w, patch_origin, mask_I2_full)
 
         mask_I1 = normMask(mask_I1)
         mask_I2 = normMask(mask_I2)
+        stage_timer.mark('ShareFeature')
 
-        patch_1 = self.ShareFeature(input_tesnors[:, :1, ...])
-        patch_2 = self.ShareFeature(input_tesnors[:, 1:, ...])
+        patch_1, patch_2 = siamese_forward(self.ShareFeature, [input_tesnors[:, :1, ...], input_tesnors[:, 1:, ...]],
+                                           self.siamese)
 
         patch_1_res = torch.mul(patch_1, mask_I1)
         patch_2_res = torch.mul(patch_2, mask_I2)
@@ -268,19 +340,18 @@ class ResNet(nn.Module):
         # 1 -> 2
         #######################################################################
 
-        H_mat_12 = self.predict_homography(patch_1_res, patch_2_res, h4p)
-        pred_I2 = transform(patch_size_h, patch_size_w, M_tile_inv, H_mat_12, M_tile, org_imges[:, :1, ...],
-                            patch_indices, batch_indices_tensor)
-        pred_Mask_I2 = transform(patch_size_h, patch_size_w, M_tile_inv, H_mat_12, M_tile, mask_I1_full, patch_indices,
-                              batch_indices_tensor)
+        H_mat_12, H_mat_21 = self.predict_bidirectional(patch_1_res, patch_2_res, h4p)
+        stage_timer.mark('warp')
+        pred_I2, pred_Mask_I2 = transform_patch(patch_size_h, patch_size_w, M_tile_inv, H_mat_12, M_tile,
+                                                [org_imges[:, :1, ...], mask_I1_full], patch_origin)
         pred_Mask_I2 = normMask(pred_Mask_I2)
         mask_ap_I2 = torch.mul(mask_I2, pred_Mask_I2)
         if self.fix_mask:
             mask_ap_I2 = torch.ones_like(mask_ap_I2)
-        sum_value_I2 = torch.sum(mask_ap_I2)
+        stage_timer.mark('ShareFeature')
         pred_I2_CnnFeature = self.ShareFeature(pred_I2)
-        feature_loss_mat_12 = triplet_loss(patch_2, pred_I2_CnnFeature, patch_1)
-        feature_loss_12 = torch.sum(torch.mul(feature_loss_mat_12, mask_ap_I2)) / sum_value_I2
+        stage_timer.mark('loss')
+        feature_loss_12, feature_loss_mat_12 = masked_triplet_loss(patch_2, pred_I2_CnnFeature, patch_1, mask_ap_I2)
         feature_loss_12 = torch.unsqueeze(feature_loss_12, 0)
 
         pred_I2_d = pred_I2[:1, ...]
@@ -293,19 +364,17 @@ class ResNet(nn.Module):
         # 2 -> 1
         #######################################################################
 
-        H_mat_21 = self.predict_homography(patch_2_res, patch_1_res, h4p)
-        pred_I1 = transform(patch_size_h, patch_size_w, M_tile_inv, H_mat_21, M_tile, org_imges[:, 1:, ...],
-                            patch_indices, batch_indices_tensor)
-        pred_Mask_I1 = transform(patch_size_h, patch_size_w, M_tile_inv, H_mat_21, M_tile, mask_I2_full, patch_indices,
-                              batch_indices_tensor)
+        stage_timer.mark('warp')
+        pred_I1, pred_Mask_I1 = transform_patch(patch_size_h, patch_size_w, M_tile_inv, H_mat_21, M_tile,
+                                                [org_imges[:, 1:, ...], mask_I2_full], patch_origin)
         pred_Mask_I1 = normMask(pred_Mask_I1)
         mask_ap_I1 = torch.mul(mask_I1, pred_Mask_I1)
         if self.fix_mask:
             mask_ap_I1 = torch.ones_like(mask_ap_I1)
-        sum_value_I1 = torch.sum(mask_ap_I1)
+        stage_timer.mark('ShareFeature')
         pred_I1_CnnFeature = self.ShareFeature(pred_I1)
-        feature_loss_mat_21 = triplet_loss(patch_1, pred_I1_CnnFeature, patch_2)
-        feature_loss_21 = torch.sum(torch.mul(feature_loss_mat_21, mask_ap_I1)) / sum_value_I1
+        stage_timer.mark('loss')
+        feature_loss_21, feature_loss_mat_21 = masked_triplet_loss(patch_1, pred_I1_CnnFeature, patch_2, mask_ap_I1)
         feature_loss_21 = torch.unsqueeze(feature_loss_21, 0)
 
         pred_I1_d = pred_I1[:1, ...]
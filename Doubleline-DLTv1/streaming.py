@@ -0,0 +1,184 @@
+# coding: utf-8
+import argparse
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+import torch
+
+from torch_homography_model import build_model
+from utils import get_patch_corners, normalize_gray, inference_mode
+
+
+def load_model(model_name, model_path=None, device='cpu'):
+    """
+    Model for inference from a CheckPointer checkpoint ({'model': state_dict}), a pickled
+    network (torch.save(net)) or a plain state_dict, with or without the DataParallel 'module.' prefix
+    """
+    net = build_model(model_name)
+    if model_path is not None:
+        checkpoint = torch.load(model_path, map_location='cpu')
+        if isinstance(checkpoint, torch.nn.Module):
+            checkpoint = checkpoint.state_dict()
+        state_dict = checkpoint.get('model', checkpoint)
+        state_dict = {(k[7:] if k.startswith('module.') else k): v for k, v in state_dict.items()}
+        net.load_state_dict(state_dict, strict=True)
+    net.eval()
+    return net.to(device)
+
+
+class StreamingEstimator(object):
+    """
+    Homographies along a video stream. Every frame goes through genMask and ShareFeature
+    (ResNet.encode_frames) once; its masked patch features are kept in a bounded LRU keyed
+    by frame id and paired with the cached neighbours, so a frame shared by the pairs
+    (t-1, t) and (t, t+1) is not encoded twice
+    """
+
+    def __init__(self, net, patch_size_h=315, patch_size_w=560, patch_origin=None, cache_size=8):
+        """
+        :param net: ResNet in eval mode
+        :param patch_origin: (x, y) of the patch, the centred patch of test.py by default
+        :param cache_size: frames whose features are kept, 0 encodes both frames of every pair
+        """
+        self.net = net
+        self.device = next(net.parameters()).device
+        self.patch_size_h, self.patch_size_w = patch_size_h, patch_size_w
+        self.patch_origin = patch_origin
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.last = None
+        self.hits, self.misses = 0, 0
+        self.encode_seconds, self.pair_seconds, self.pairs = 0.0, 0.0, 0
+
+    def _timer(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def _to_tensor(self, frame):
+        # uint8 BGR (h, w, 3) as read by cv2, or a (3, h, w) / (1, 3, h, w) tensor
+        if isinstance(frame, np.ndarray):
+            frame = torch.from_numpy(np.ascontiguousarray(frame)).permute(2, 0, 1)
+        if frame.dim() == 3:
+            frame = frame.unsqueeze(0)
+        return frame.to(self.device)
+
+    def encode(self, frame):
+        """
+        :param frame: uint8 BGR frame, see _to_tensor
+        :return: masked patch features, shape=(1, 1, patch_size_h, patch_size_w)
+        """
+        start = self._timer()
+        frame = self._to_tensor(frame)
+        if self.patch_origin is None:
+            _, _, img_h, img_w = frame.size()
+            self.patch_origin = ((img_w - self.patch_size_w + 1) // 2, (img_h - self.patch_size_h + 1) // 2)
+        with inference_mode():
+            if frame.dtype == torch.uint8:
+                frame = normalize_gray(frame)
+            features = self.net.encode_frames(frame, self.patch_origin, self.patch_size_h, self.patch_size_w)
+        self.encode_seconds += self._timer() - start
+        return features
+
+    def features(self, frame_id, frame=None):
+        """
+        Cached features of frame_id, encoded from frame on a miss
+        """
+        if frame_id in self.cache:
+            self.cache.move_to_end(frame_id)
+            self.hits += 1
+            return self.cache[frame_id]
+        if frame is None:
+            raise KeyError('frame {} is not cached'.format(frame_id))
+        self.misses += 1
+        features = self.encode(frame)
+        if self.cache_size > 0:
+            self.cache[frame_id] = features
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return features
+
+    def estimate(self, frame_id_1, frame_id_2, frame_1=None, frame_2=None):
+        """
+        :return: H mapping frame_id_2 pixel coordinates into frame_id_1, in full-frame pixels, shape=(3, 3)
+        """
+        patch_1 = self.features(frame_id_1, frame_1)
+        patch_2 = self.features(frame_id_2, frame_2)
+        start = self._timer()
+        h4p = get_patch_corners(1, self.patch_origin, self.patch_size_h, self.patch_size_w, self.device)
+        with inference_mode():
+            H_mat = self.net.predict_homography(patch_1, patch_2, h4p)[0]
+        self.pair_seconds += self._timer() - start
+        self.pairs += 1
+        return H_mat
+
+    def push(self, frame_id, frame):
+        """
+        Add the next frame of the stream
+        :return: H mapping this frame's pixel coordinates into the previous frame, None for the first frame
+        """
+        H_mat = None
+        if self.last is None:
+            self.features(frame_id, frame)
+        else:
+            H_mat = self.estimate(self.last[0], frame_id, self.last[1], frame)
+        # the raw frame is kept so that the next pair still works when its features were not cached
+        self.last = (frame_id, frame)
+        return H_mat
+
+    def stats(self):
+        lookups = max(self.hits + self.misses, 1)
+        return {'frames_encoded': self.misses, 'pairs': self.pairs,
+                'hit_rate': self.hits / float(lookups),
+                'encode_ms_per_frame': 1000.0 * self.encode_seconds / max(self.misses, 1),
+                'encode_ms_per_pair': 1000.0 * self.encode_seconds / max(self.pairs, 1),
+                'pair_ms': 1000.0 * self.pair_seconds / max(self.pairs, 1)}
+
+
+def align_video(args):
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    net = load_model(args.model_name, args.model_path, device)
+    estimator = StreamingEstimator(net, args.patch_size_h, args.patch_size_w, cache_size=args.cache_size)
+
+    vc = cv2.VideoCapture(args.video)
+    H_mats, frame_id = [], 0
+    start = time.perf_counter()
+    while True:
+        rval, frame = vc.read()
+        if not rval or (args.max_frames > 0 and frame_id >= args.max_frames):
+            break
+        frame = cv2.resize(frame, (args.img_w, args.img_h))
+        H_mat = estimator.push(frame_id, frame)
+        if H_mat is not None:
+            H_mats.append(H_mat.cpu().numpy())
+        frame_id += 1
+    vc.release()
+    elapsed = time.perf_counter() - start
+
+    if args.out is not None:
+        # H_mats[i]: frame i -> frame i + 1
+        np.save(args.out, np.array(H_mats, dtype=np.float32).reshape(-1, 3, 3))
+    stats = estimator.stats()
+    print('{} frames, {:.1f} ms per frame'.format(frame_id, 1000.0 * elapsed / max(frame_id, 1)))
+    print(', '.join('{}: {:.3f}'.format(k, v) if isinstance(v, float) else '{}: {}'.format(k, v)
+                    for k, v in stats.items()))
+
+
+if __name__=="__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--video', type=str, required=True)
+    parser.add_argument('--model_name', type=str, default='resnet34')
+    parser.add_argument('--model_path', type=str, default=None, help='checkpoint, random weights if not given')
+    parser.add_argument('--out', type=str, default=None, help='save the frame-to-frame homographies as .npy')
+    parser.add_argument('--cache_size', type=int, default=8, help='frames whose features are cached, 0 disables')
+    parser.add_argument('--max_frames', type=int, default=0)
+    parser.add_argument('--img_w', type=int, default=640)
+    parser.add_argument('--img_h', type=int, default=360)
+    parser.add_argument('--patch_size_h', type=int, default=315)
+    parser.add_argument('--patch_size_w', type=int, default=560)
+
+    args = parser.parse_args()
+    align_video(args)
@@ -12,8 +12,8 @@ from tensorboardX import SummaryWriter
 import cv2
 from torch_homography_model import build_model
 from datetime import datetime
-from dataset import TrainDataset
-from utils import display_using_tensorboard
+from dataset import TrainDataset, VideoPairDataset, SyntheticPairDataset
+from utils import display_using_tensorboard, get_display_inputs, stage_timer, build_profiler
 from utils import synchronize, get_rank
 from dist_utils.checkpoint import CheckPointer
 
@@ -37,7 +37,8 @@ now_time = datetime.now()
 def train(args, writer):
 
     train_path = os.path.join(exp_name, 'Data/Train_List.txt')
-    net = build_model(args.model_name, pretrained=args.pretrained, fix_mask=args.fix_mask)
+    net = build_model(args.model_name, pretrained=args.pretrained, fix_mask=args.fix_mask,
+                      siamese=not args.sequential_branches)
 
     if args.distributed:
         torch.nn.SyncBatchNorm.convert_sync_batchnorm(net)
@@ -52,13 +53,26 @@ def train(args, writer):
         device = torch.device('cpu:0')
         net = net.to(device)
 
-    train_data = TrainDataset(data_path=train_path, exp_path=exp_name, patch_w=args.patch_size_w,
-                              patch_h=args.patch_size_h, rho=16)
-    if args.distributed:
-        train_sampler = torch.utils.data.distributed.DistributedSampler(train_data, num_replicas=args.gpus,
-                                                                        rank=args.local_rank)
+    if args.video_path is not None:
+        # pairs decoded straight from the videos, the dataset shards them over ranks and workers
+        train_data = VideoPairDataset(video_path=args.video_path, patch_w=args.patch_size_w,
+                                      patch_h=args.patch_size_h, rho=16, uint8_frames=args.uint8_frames)
+        train_sampler = None
     else:
-        train_sampler = torch.utils.data.RandomSampler(train_data)
+        if args.synthetic > 0:
+            # generated pairs with the layout of TrainDataset, no dataset needed
+            train_data = SyntheticPairDataset(args.synthetic, patch_w=args.patch_size_w, patch_h=args.patch_size_h,
+                                              rho=16, seed=args.seed, moving_object=args.synthetic_objects,
+                                              uint8_frames=args.uint8_frames)
+        else:
+            train_data = TrainDataset(data_path=train_path, exp_path=exp_name, patch_w=args.patch_size_w,
+                                      patch_h=args.patch_size_h, rho=16, uint8_frames=args.uint8_frames,
+                                      frame_store=args.frame_store, pair_index=args.pair_index)
+        if args.distributed:
+            train_sampler = torch.utils.data.distributed.DistributedSampler(train_data, num_replicas=args.gpus,
+                                                                            rank=args.local_rank)
+        else:
+            train_sampler = torch.utils.data.RandomSampler(train_data)
     train_loader = DataLoader(dataset=train_data, batch_size=args.batch_size, num_workers=args.cpus, shuffle=False,
                               drop_last=True, sampler=train_sampler)
     optimizer = optim.Adam(net.parameters(), lr=args.lr, amsgrad=True, weight_decay=1e-4)  # default as 0.0001
@@ -79,6 +93,16 @@ def train(args, writer):
     # Start training
     ###########################################################################
 
+    if args.timing:
+        stage_timer.enable(device, cuda_events=args.timing_cuda_events,
+                           jsonl_path=os.path.join(LOG_DIR, 'timing.jsonl') if save_to_disk else None)
+    prof = None
+    if args.profile and save_to_disk:
+        prof = build_profiler(LOG_DIR, args.profile_wait, args.profile_warmup, args.profile_active,
+                              args.profile_repeat, args.profile_top)
+        stage_timer.enable_ranges()
+        prof.start()
+
     print("######################start training######################")
     print('LEN TRAIN_LOADER: ', len(train_loader))
 
@@ -93,40 +117,38 @@ def train(args, writer):
 
     for epoch in range(start_epoch, args.max_epoch):
         net.train()
+        if hasattr(train_data, 'set_epoch'):
+            train_data.set_epoch(epoch)
         loss_sigma = 0.0
         loss_sigma_feature = 0.0
 
         scheduler.step()  # Note: The initial learning rate should be 1e-4. torch_version==1.0.1 ->init lr == 0.0001; torch_version>=1.2.0 ->init lr == 0.0001*1.25?
         print(epoch, 'lr={:.6f}'.format(scheduler.get_lr()[0]))
+        stage_timer.reset()
+        stage_timer.mark('data')
         for i, batch_value in enumerate(train_loader):
-
-            org_imges = batch_value[0].float()
-            input_tesnors = batch_value[1].float()
-            patch_indices = batch_value[2].float()
+            stage_timer.mark('h2d')
+
+            org_imges = batch_value[0]
+            input_tesnors = batch_value[1]
+            if org_imges.dtype != torch.uint8:
+                # uint8 frames are normalised on the device by the model
+                org_imges = org_imges.float()
+                input_tesnors = input_tesnors.float()
+            patch_origin = batch_value[2]
             h4p = batch_value[3].float()
 
-            I = org_imges[:, 0, ...]
-            I = I[:, np.newaxis, ...]
-            I2_ori_img = org_imges[:, 1, ...]
-            I2_ori_img = I2_ori_img[:, np.newaxis, ...]
-            I1 = input_tesnors[:, 0, ...]
-            I1 = I1[:, np.newaxis, ...]
-            I2 = input_tesnors[:, 1, ...]
-            I2 = I2[:, np.newaxis, ...]
-
             # move to device
             org_imges = org_imges.to(device)
             input_tesnors = input_tesnors.to(device)
-            patch_indices = patch_indices.to(device)
+            patch_origin = patch_origin.to(device)
             h4p = h4p.to(device)
-            I = I.to(device)
-            I2_ori_img = I2_ori_img.to(device)
-            I2 = I2.to(device)
+            stage_timer.mark('forward')
 
             # forward, backward, update weights
             optimizer.zero_grad()
 
-            batch_out = net(org_imges, input_tesnors, h4p, patch_indices)
+            batch_out = net(org_imges, input_tesnors, h4p, patch_origin)
             loss_feature_12 = batch_out['feature_loss_12'].mean()
             loss_feature_21 = batch_out['feature_loss_21'].mean()
             loss_homography = batch_out['homography_loss'].mean()
@@ -137,8 +159,11 @@ def train(args, writer):
             loss_map = batch_out['feature_loss_mat_12_d']
 
             total_loss = loss_feature_12 + loss_feature_21 + loss_homography
+            stage_timer.mark('backward')
             total_loss.backward()
+            stage_timer.mark('optimizer')
             optimizer.step()
+            stage_timer.mark('logging')
 
             loss_sigma += total_loss.item()
             loss_sigma_feature += loss_feature_12.item()
@@ -157,6 +182,7 @@ def train(args, writer):
             # using tensorbordX to check the input or output performance during training
             if writer:
                 if glob_iter % 200 == 0:
+                    I, I2_ori_img, I2 = get_display_inputs(org_imges, input_tesnors)
                     display_using_tensorboard(I, I2_ori_img, I2, pred_I2, I2_dataMat_CnnFeature, pred_I2_dataMat_CnnFeature,
                                               triMask, loss_map, writer)
                     writer.add_scalars('Loss_group', {'feature_loss_12': loss_feature_12.item()}, glob_iter)
@@ -178,9 +204,21 @@ def train(args, writer):
                             writer.add_histogram(name + '_grad', layer.grad.cpu().data.numpy(), glob_iter)
                             writer.add_histogram(name + '_data', layer.cpu().data.numpy(), glob_iter)
 
+            stage_timer.end_step()
+            if glob_iter % args.timing_every == 0 and glob_iter != 0:
+                timing = stage_timer.flush(writer, glob_iter)
+                if timing is not None:
+                    print('Timing p50 ms: ' + ', '.join('{} {:.1f}'.format(name, s['p50_ms']) for name, s in timing.items()))
+            if prof is not None:
+                prof.step()
+            stage_timer.mark('data')
+
             # Another glob iter
             glob_iter += 1
 
+    if prof is not None:
+        prof.stop()
+
     # Save state
     checkpoint_arguments['step'] = glob_iter - 1
     checkpointer.save("model_{:06d}".format(glob_iter), **checkpoint_arguments)
@@ -197,6 +235,28 @@ if __name__=="__main__":
     parser.add_argument('--img_h', type=int, default=360)
     parser.add_argument('--patch_size_h', type=int, default=315)
     parser.add_argument('--patch_size_w', type=int, default=560)
+    parser.add_argument('--uint8_frames', action='store_true', help='Load raw uint8 frames, normalised on the device')
+    parser.add_argument('--sequential_branches', action='store_true',
+                        help='Run the shared-weight branches one call per input instead of batched')
+    parser.add_argument('--timing', action='store_true',
+                        help='Time the stages of every step, percentiles to tensorboard and timing.jsonl')
+    parser.add_argument('--timing_every', type=int, default=200, help='Steps between two timing flushes')
+    parser.add_argument('--timing_cuda_events', action='store_true',
+                        help='Time with CUDA events instead of synchronising the device at every stage')
+    parser.add_argument('--profile', action='store_true',
+                        help='torch.profiler over a window of steps, trace and operator table to the log dir')
+    parser.add_argument('--profile_wait', type=int, default=1, help='Steps skipped before the window')
+    parser.add_argument('--profile_warmup', type=int, default=1, help='Steps traced and dropped')
+    parser.add_argument('--profile_active', type=int, default=3, help='Steps recorded')
+    parser.add_argument('--profile_repeat', type=int, default=1, help='Number of windows, 0 until the end')
+    parser.add_argument('--profile_top', type=int, default=20, help='Rows of the operator tables')
+    parser.add_argument('--frame_store', type=str, default=None, help='Path of a Data/build_frame_store.py output, without extension')
+    parser.add_argument('--pair_index', type=str, default=None, help='Data/make_pair_index.py output used instead of Train_List.txt')
+    parser.add_argument('--video_path', type=str, default=None, help='Train on pairs decoded from the videos of this folder')
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help='Train on this many generated pairs per epoch instead of Train_List.txt')
+    parser.add_argument('--synthetic_objects', action='store_true',
+                        help='Add an independently moving object to the generated pairs')
 
     parser.add_argument('--batch_size', type=int, default=32)
     parser.add_argument('--max_epoch', type=int, default=30)
@@ -1,14 +1,198 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from functools import partial
+
 import torch
+import torch.nn.functional as F
 import torch.distributed as dist
 
 import numpy as np
 import cv2
 
 
+class ShapeCache(object):
+    """
+    Thread-safe LRU cache for constant tensors that only depend on input shapes,
+    bounded so that variable-resolution inference cannot grow it without limit
+    """
+
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        value = build()
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# torch.inference_mode appeared in torch 1.9
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+Geometry = namedtuple('Geometry', ['M_tile', 'M_tile_inv', 'batch_indices_tensor'])
+
+# forward-pass constants of ResNet, see get_geometry
+geometry_cache = ShapeCache(max_entries=16)
+# sampling grids of transformer
+grid_cache = ShapeCache(max_entries=16)
+
+
+def get_geometry(batch_size, img_h, img_w, patch_size_h, patch_size_w, device, dtype=torch.float32):
+    """
+    M_tile and its inverse map pixel coordinates to the [-1, 1] coordinates of
+    transformer; batch_indices_tensor is the flat offset of every patch pixel's
+    image in the batch. Built once per shape and device and then reused.
+    """
+    key = (batch_size, img_h, img_w, patch_size_h, patch_size_w, str(device), dtype)
+
+    def build():
+        y_t = torch.arange(0, batch_size * img_w * img_h, img_w * img_h, device=device)
+        batch_indices_tensor = y_t.unsqueeze(1).expand(y_t.shape[0], patch_size_h * patch_size_w).reshape(-1)
+
+        M_tensor = torch.tensor([[img_w / 2.0, 0., img_w / 2.0],
+                                 [0., img_h / 2.0, img_h / 2.0],
+                                 [0., 0., 1.]], dtype=dtype, device=device)
+        M_tile = M_tensor.unsqueeze(0).expand(batch_size, M_tensor.shape[-2], M_tensor.shape[-1])
+        # Inverse of M
+        M_tensor_inv = torch.inverse(M_tensor)
+        M_tile_inv = M_tensor_inv.unsqueeze(0).expand(batch_size, M_tensor_inv.shape[-2], M_tensor_inv.shape[-1])
+        return Geometry(M_tile, M_tile_inv, batch_indices_tensor)
+
+    return geometry_cache.get(key, build)
+
+
+def get_patch_corners(batch_size, patch_origin, patch_size_h, patch_size_w, device, dtype=torch.float32):
+    """
+    h4p of a patch shared by the batch: top-left, bottom-left, bottom-right and top-right corner
+    :param patch_origin: (x, y) of the patch
+    :return: shape=(bs, 8)
+    """
+    x, y = int(patch_origin[0]), int(patch_origin[1])
+    key = ('h4p', batch_size, x, y, patch_size_h, patch_size_w, str(device), dtype)
+
+    def build():
+        corners = torch.tensor([x, y, x, y + patch_size_h, x + patch_size_w, y + patch_size_h, x + patch_size_w, y],
+                               dtype=dtype, device=device)
+        return corners.unsqueeze(0).expand(batch_size, 8)
+
+    return geometry_cache.get(key, build)
+
+
+# BGR statistics of the training frames, the same values dataset.py normalises with
+MEAN_I = (118.93, 113.97, 102.60)
+STD_I = (69.85, 68.81, 72.45)
+
+
+def normalize_gray(frames):
+    """
+    On-device version of the dataset preprocessing for uint8 frames: (img - MEAN_I) / STD_I
+    averaged over the BGR channels. Computed in float64 in numpy's order of operations, so
+    the result is bit-identical to the float64 dataset path followed by .float()
+    :param frames: uint8 BGR frames stacked on channels, shape=(bs, 3*k, h, w)
+    :return: float32, shape=(bs, k, h, w)
+    """
+    num_batch, num_channels, height, width = frames.size()
+    key = ('bgr_stats', str(frames.device))
+    stats = geometry_cache.get(key, lambda: torch.tensor([MEAN_I, STD_I], dtype=torch.float64,
+                                                          device=frames.device).reshape(2, 1, 1, 3, 1, 1))
+    frames = frames.reshape(num_batch, num_channels // 3, 3, height, width).double()
+    frames = (frames - stats[0]) / stats[1]
+    gray = (frames[:, :, 0] + frames[:, :, 1] + frames[:, :, 2]) / 3
+    return gray.float()
+
+
+# Corner indices of every mesh cell, cached per (divide, device)
+_DLT_CELL_INDICES = {}
+
+
+def _mesh_cell_indices(divide, device):
+    """
+    Flat indices of the 4 (x, y) corners of every cell of a divide x divide mesh,
+    in the order DLT_solve_loop visits them
+    :return: shape=(divide*divide, 8)
+    """
+    key = (divide, str(device))
+    if key not in _DLT_CELL_INDICES:
+        row_num = (divide+1)*2
+        i, j = np.meshgrid(np.arange(divide), np.arange(divide), indexing='ij')
+        top_left = (2*j + row_num*i).reshape(-1, 1)
+        cell_indices = np.concatenate([top_left, top_left+1,
+                                       top_left+2, top_left+3,
+                                       top_left+2+row_num, top_left+3+row_num,
+                                       top_left+row_num, top_left+row_num+1], 1)
+        _DLT_CELL_INDICES[key] = torch.from_numpy(cell_indices).long().to(device)
+    return _DLT_CELL_INDICES[key]
+
+
+def _batched_solve(A, b):
+    if hasattr(torch, 'linalg'):
+        return torch.linalg.solve(A, b)
+    return torch.solve(b, A)[0]
+
+
 def DLT_solve(src_p, off_set):
+    # src_p: shape=(bs, 2*(divide+1)**2), (x, y) of the mesh points row by row
+    # off_set: shape=(bs, 2*(divide+1)**2)
+    # can be used to compute mesh points (multi-H)
+    # same result as DLT_solve_loop, with all mesh cells gathered at once and
+    # the 8x8 systems solved directly instead of through their inverse
+
+    bs, _ = src_p.shape
+    divide = int(np.sqrt(len(src_p[0])/2)-1)
+    cell_indices = _mesh_cell_indices(divide, src_p.device)
+
+    n = cell_indices.shape[0]
+    N = bs*n
+
+    src_ps = src_p[:, cell_indices].reshape(N, 4, 2)
+    off_sets = off_set[:, cell_indices].reshape(N, 4, 2)
+
+    dst_p = src_ps + off_sets
+
+    ones = torch.ones(N, 4, 1, dtype=src_ps.dtype, device=src_ps.device)
+    xy1 = torch.cat((src_ps, ones), 2)
+    zeros = torch.zeros_like(xy1)
+
+    xyu, xyd = torch.cat((xy1, zeros), 2), torch.cat((zeros, xy1), 2)
+    M1 = torch.cat((xyu, xyd), 2).reshape(N, -1, 6)
+    M2 = torch.matmul(
+        dst_p.reshape(-1, 2, 1),
+        src_ps.reshape(-1, 1, 2),
+    ).reshape(N, -1, 2)
+
+    A = torch.cat((M1, -M2), 2)
+    b = dst_p.reshape(N, -1, 1)
+
+    h8 = _batched_solve(A, b).reshape(N, 8)
+
+    H = torch.cat((h8, ones[:,0,:]), 1).reshape(N, 3, 3)
+    H = H.reshape(bs, n, 3, 3)
+    return H
+
+
+def DLT_solve_loop(src_p, off_set):
     # src_p: shape=(bs, n, 4, 2)
     # off_set: shape=(bs, n, 4, 2)
     # can be used to compute mesh points (multi-H)
+    # original per-cell implementation, kept as the reference for DLT_solve
    
     bs, _ = src_p.shape
     divide = int(np.sqrt(len(src_p[0])/2)-1)
@@ -69,7 +253,182 @@ def DLT_solve(src_p, off_set):
     return H
 
  
-def transformer(U, theta, out_size, **kwargs):
+def _branch_batch_norm(bn, num_branches, x):
+    """
+    Training-mode BatchNorm of num_branches inputs stacked on the batch dimension, each
+    normalised with its own batch statistics. The running statistics are updated once
+    per branch, in order, as num_branches separate calls of bn would
+    """
+    num_batch, num_channels = x.size()[:2]
+    # branches side by side on the channel dimension: one native batch_norm call
+    x_branches = x.reshape(num_branches, num_batch // num_branches, num_channels, -1).transpose(0, 1)
+    x_branches = x_branches.reshape(num_batch // num_branches, num_branches * num_channels, -1)
+    weight = bn.weight.repeat(num_branches) if bn.affine else None
+    bias = bn.bias.repeat(num_branches) if bn.affine else None
+    out = F.batch_norm(x_branches, None, None, weight, bias, True, 0.0, bn.eps)
+
+    if bn.track_running_stats:
+        # each branch goes through the statistics kernel of a separate call, so the
+        # running statistics are bit-identical to it
+        with torch.no_grad():
+            for x_branch in x.chunk(num_branches):
+                bn.num_batches_tracked.add_(1)
+                momentum = bn.momentum if bn.momentum is not None else 1.0 / float(bn.num_batches_tracked)
+                torch.batch_norm_update_stats(x_branch, bn.running_mean, bn.running_var, momentum)
+
+    out = out.reshape(num_batch // num_branches, num_branches, num_channels, -1).transpose(0, 1)
+    return out.reshape(x.size())
+
+
+def siamese_forward(module, inputs, batched=True, forward_fn=None):
+    """
+    Run a shared-weight module on several inputs of the same shape as one batched call
+    instead of one call per input. BatchNorm layers in training mode are switched to
+    per-branch statistics for the call: running statistics are identical to separate
+    calls and outputs match them up to float rounding. SyncBatchNorm falls back to separate calls
+    :param inputs: list of tensors, shape=(bs, c, h, w) each
+    :param forward_fn: callable run on the inputs instead of module, using only the layers of module
+    :return: list of outputs, one per input
+    """
+    forward_fn = module if forward_fn is None else forward_fn
+    norms = [m for m in module.modules() if isinstance(m, torch.nn.modules.batchnorm._BatchNorm) and m.training]
+    if not batched or len(inputs) == 1 or any(isinstance(m, torch.nn.SyncBatchNorm) for m in norms):
+        return [forward_fn(x) for x in inputs]
+
+    for m in norms:
+        m.forward = partial(_branch_batch_norm, m, len(inputs))
+    try:
+        outputs = forward_fn(torch.cat(inputs, dim=0))
+    finally:
+        for m in norms:
+            del m.forward
+    return list(outputs.chunk(len(inputs), dim=0))
+
+
+def _repeat(x, n_repeats):
+
+    rep = torch.ones([n_repeats, ]).unsqueeze(0)
+    rep = rep.int()
+    x = x.int()
+
+    x = torch.matmul(x.reshape([-1,1]), rep)
+    return x.reshape([-1])
+
+
+def _interpolate_gather(im, x, y, out_size, scale_h):
+
+    num_batch, num_channels , height, width = im.size()
+
+    height_f = height
+    width_f = width
+    out_height, out_width = out_size[0], out_size[1]
+
+    zero = 0
+    max_y = height - 1
+    max_x = width - 1
+    if scale_h:
+
+        x = (x + 1.0)*(width_f) / 2.0
+        y = (y + 1.0) * (height_f) / 2.0
+
+    # do sampling
+    x0 = torch.floor(x).int()
+    x1 = x0 + 1
+    y0 = torch.floor(y).int()
+    y1 = y0 + 1
+
+    x0 = torch.clamp(x0, zero, max_x)
+    x1 = torch.clamp(x1, zero, max_x)
+    y0 = torch.clamp(y0, zero, max_y)
+    y1 = torch.clamp(y1, zero, max_y)
+    dim2 = torch.from_numpy( np.array(width) )
+    dim1 = torch.from_numpy( np.array(width * height) )
+
+    base = _repeat(torch.arange(0,num_batch) * dim1, out_height * out_width)
+    if torch.cuda.is_available():
+        dim2 = dim2.cuda()
+        dim1 = dim1.cuda()
+        y0 = y0.cuda()
+        y1 = y1.cuda()
+        x0 = x0.cuda()
+        x1 = x1.cuda()
+        base = base.cuda()
+    base_y0 = base + y0 * dim2
+    base_y1 = base + y1 * dim2
+    idx_a = base_y0 + x0
+    idx_b = base_y1 + x0
+    idx_c = base_y0 + x1
+    idx_d = base_y1 + x1
+
+    # channels dim
+    im = im.permute(0,2,3,1)
+    im_flat = im.reshape([-1, num_channels]).float()
+
+    idx_a = idx_a.unsqueeze(-1).long()
+    idx_a = idx_a.expand(out_height * out_width * num_batch, num_channels)
+    Ia = torch.gather(im_flat, 0, idx_a)
+
+    idx_b = idx_b.unsqueeze(-1).long()
+    idx_b = idx_b.expand(out_height * out_width * num_batch, num_channels)
+    Ib = torch.gather(im_flat, 0, idx_b)
+
+    idx_c = idx_c.unsqueeze(-1).long()
+    idx_c = idx_c.expand(out_height * out_width * num_batch, num_channels)
+    Ic = torch.gather(im_flat, 0, idx_c)
+
+    idx_d = idx_d.unsqueeze(-1).long()
+    idx_d = idx_d.expand(out_height * out_width * num_batch, num_channels)
+    Id = torch.gather(im_flat, 0, idx_d)
+
+    x0_f = x0.float()
+    x1_f = x1.float()
+    y0_f = y0.float()
+    y1_f = y1.float()
+
+    wa = torch.unsqueeze(((x1_f - x) * (y1_f - y)), 1)
+    wb = torch.unsqueeze(((x1_f - x) * (y - y0_f)), 1)
+    wc = torch.unsqueeze(((x - x0_f) * (y1_f - y)), 1)
+    wd = torch.unsqueeze(((x - x0_f) * (y - y0_f)), 1)
+    output = wa*Ia+wb*Ib+wc*Ic+wd*Id
+
+    return output
+
+
+def _interpolate_grid_sample(im, x, y, out_size, scale_h):
+
+    num_batch, num_channels, height, width = im.size()
+    out_height, out_width = out_size[0], out_size[1]
+
+    if scale_h:
+        x = (x + 1.0) * width / 2.0
+        y = (y + 1.0) * height / 2.0
+
+    x = x.reshape([num_batch, out_height, out_width])
+    y = y.reshape([num_batch, out_height, out_width])
+
+    # _interpolate_gather clamps x0/x1 (y0/y1) to the same pixel outside
+    # [0, width - 1) x [0, height - 1), which zeroes all four weights there,
+    # while grid_sample would still blend the border pixels in
+    valid = (x >= 0) & (x < width - 1) & (y >= 0) & (y < height - 1)
+
+    grid = torch.stack((x * (2.0 / (width - 1)) - 1.0, y * (2.0 / (height - 1)) - 1.0), -1)
+    output = F.grid_sample(im.float(), grid, mode='bilinear', padding_mode='zeros', align_corners=True)
+    output = output * valid.unsqueeze(1).float()
+
+    return output.permute(0,2,3,1)
+
+
+# Bilinear sampling backends of transformer(). Each takes the input image
+# [num_batch, num_channels, height, width] and flat source coordinates, and
+# returns the samples reshapeable to [num_batch, out_height, out_width, num_channels].
+# 'gather' is the original implementation and is kept as the reference.
+SAMPLERS = {
+    'gather': _interpolate_gather,
+    'grid_sample': _interpolate_grid_sample,
+}
+
+ 
+def transformer(U, theta, out_size, sampler='grid_sample', **kwargs):
     """Spatial Transformer Layer
 
     Implements a spatial transformer layer as described in [1]_.
@@ -85,6 +444,12 @@ def transformer(U, theta, out_size, **kwargs):
         localisation network should be [num_batch, 6].
     out_size: tuple of two ints
         The size of the output of the network (height, width)
+    origin: int tensor, optional
+        Per-sample (x, y) offset of the output grid inside U, shape
+        [num_batch, 2]. When given, only the out_size patch at origin is
+        sampled instead of the full frame.
+    sampler: str
+        Name of the bilinear sampling backend in SAMPLERS.
 
     References
     ----------
@@ -104,94 +469,30 @@ def transformer(U, theta, out_size, **kwargs):
 
     """
 
-    def _repeat(x, n_repeats):
+    def _patch_axes(height, width, in_size, device):
+        in_height, in_width = in_size
+        x_lin = torch.linspace(-1.0, 1.0, in_width, device=device)
+        y_lin = torch.linspace(-1.0, 1.0, in_height, device=device)
+        return x_lin, y_lin, torch.arange(width, device=device), torch.arange(height, device=device)
 
-        rep = torch.ones([n_repeats, ]).unsqueeze(0)
-        rep = rep.int()
-        x = x.int()
+    def _meshgrid(height, width, scale_h, device, origin=None, in_size=None):
 
-        x = torch.matmul(x.reshape([-1,1]), rep)
-        return x.reshape([-1])
+        if origin is not None:
+            # Patch grid: output pixel (i, j) samples like full-frame pixel
+            # (x0 + i, y0 + j), so only the patch at the crop origin is warped.
+            origin = origin.long()
+            key = ('patch', height, width, in_size, str(origin.device))
+            x_lin, y_lin, x_range, y_range = grid_cache.get(
+                key, lambda: _patch_axes(height, width, in_size, origin.device))
+            x_t = x_lin[origin[:, :1] + x_range]
+            y_t = y_lin[origin[:, 1:] + y_range]
 
-    def _interpolate(im, x, y, out_size, scale_h):
+            num_batch = origin.size()[0]
+            x_t_flat = x_t.unsqueeze(1).expand(num_batch, height, width).reshape([num_batch, 1, -1])
+            y_t_flat = y_t.unsqueeze(2).expand(num_batch, height, width).reshape([num_batch, 1, -1])
 
-        num_batch, num_channels , height, width = im.size()
-
-        height_f = height
-        width_f = width
-        out_height, out_width = out_size[0], out_size[1]
-
-        zero = 0
-        max_y = height - 1
-        max_x = width - 1
-        if scale_h:
-
-            x = (x + 1.0)*(width_f) / 2.0
-            y = (y + 1.0) * (height_f) / 2.0
-
-        # do sampling
-        x0 = torch.floor(x).int()
-        x1 = x0 + 1
-        y0 = torch.floor(y).int()
-        y1 = y0 + 1
-
-        x0 = torch.clamp(x0, zero, max_x)
-        x1 = torch.clamp(x1, zero, max_x)
-        y0 = torch.clamp(y0, zero, max_y)
-        y1 = torch.clamp(y1, zero, max_y)
-        dim2 = torch.from_numpy( np.array(width) )
-        dim1 = torch.from_numpy( np.array(width * height) )
-
-        base = _repeat(torch.arange(0,num_batch) * dim1, out_height * out_width)
-        if torch.cuda.is_available():
-            dim2 = dim2.cuda()
-            dim1 = dim1.cuda()
-            y0 = y0.cuda()
-            y1 = y1.cuda()
-            x0 = x0.cuda()
-            x1 = x1.cuda()
-            base = base.cuda()
-        base_y0 = base + y0 * dim2
-        base_y1 = base + y1 * dim2
-        idx_a = base_y0 + x0
-        idx_b = base_y1 + x0
-        idx_c = base_y0 + x1
-        idx_d = base_y1 + x1
-
-        # channels dim
-        im = im.permute(0,2,3,1)
-        im_flat = im.reshape([-1, num_channels]).float()
-
-        idx_a = idx_a.unsqueeze(-1).long()
-        idx_a = idx_a.expand(height * width * num_batch,num_channels)
-        Ia = torch.gather(im_flat, 0, idx_a)
-
-        idx_b = idx_b.unsqueeze(-1).long()
-        idx_b = idx_b.expand(height * width * num_batch, num_channels)
-        Ib = torch.gather(im_flat, 0, idx_b)
-
-        idx_c = idx_c.unsqueeze(-1).long()
-        idx_c = idx_c.expand(height * width * num_batch, num_channels)
-        Ic = torch.gather(im_flat, 0, idx_c)
-
-        idx_d = idx_d.unsqueeze(-1).long()
-        idx_d = idx_d.expand(height * width * num_batch, num_channels)
-        Id = torch.gather(im_flat, 0, idx_d)
-
-        x0_f = x0.float()
-        x1_f = x1.float()
-        y0_f = y0.float()
-        y1_f = y1.float()
-
-        wa = torch.unsqueeze(((x1_f - x) * (y1_f - y)), 1)
-        wb = torch.unsqueeze(((x1_f - x) * (y - y0_f)), 1)
-        wc = torch.unsqueeze(((x - x0_f) * (y1_f - y)), 1)
-        wd = torch.unsqueeze(((x - x0_f) * (y - y0_f)), 1)
-        output = wa*Ia+wb*Ib+wc*Ic+wd*Id
-
-        return output
-
-    def _meshgrid(height, width, scale_h):
+            ones = torch.ones_like(x_t_flat)
+            return torch.cat([x_t_flat, y_t_flat, ones], 1)
 
         if scale_h:
             x_t = torch.matmul(torch.ones([height, 1]),
@@ -210,21 +511,22 @@ def transformer(U, theta, out_size, **kwargs):
 
         ones = torch.ones_like(x_t_flat)
         grid = torch.cat([x_t_flat, y_t_flat, ones], 0)
-        if torch.cuda.is_available():
-            grid = grid.cuda()
-        return grid
+        return grid.to(device)
+
+    def _transform(theta, input_dim, out_size, scale_h, origin=None):
+        interpolate = SAMPLERS[sampler]
 
-    def _transform(theta, input_dim, out_size, scale_h):
         num_batch, num_channels , height, width = input_dim.size()
         #  Changed
         theta = theta.reshape([-1, 3, 3]).float()
 
         out_height, out_width = out_size[0], out_size[1]
-        grid = _meshgrid(out_height, out_width, scale_h)
-        grid = grid.unsqueeze(0).reshape([1,-1])
-        shape = grid.size()
-        grid = grid.expand(num_batch,shape[1])
-        grid = grid.reshape([num_batch, 3, -1])
+        if origin is not None:
+            grid = _meshgrid(out_height, out_width, scale_h, input_dim.device, origin, (height, width))
+        else:
+            key = ('full', out_height, out_width, scale_h, str(input_dim.device))
+            grid = grid_cache.get(key, lambda: _meshgrid(out_height, out_width, scale_h, input_dim.device))
+            grid = grid.unsqueeze(0).expand(num_batch, 3, grid.shape[-1])
 
         T_g = torch.matmul(theta, grid)
         x_s = T_g[:,0,:]
@@ -243,7 +545,7 @@ def transformer(U, theta, out_size, **kwargs):
         x_s_flat = x_s.reshape([-1]) / t_s_flat
         y_s_flat = y_s.reshape([-1]) / t_s_flat
 
-        input_transformed = _interpolate( input_dim, x_s_flat, y_s_flat,out_size,scale_h)
+        input_transformed = interpolate( input_dim, x_s_flat, y_s_flat,out_size,scale_h)
 
         output = input_transformed.reshape([num_batch, out_height, out_width, num_channels ])
         return output, condition
@@ -252,19 +554,33 @@ def transformer(U, theta, out_size, **kwargs):
     img_h = U.size()[1]
 
     scale_h = True
-    output, condition = _transform(theta, U, out_size, scale_h)
+    output, condition = _transform(theta, U, out_size, scale_h, kwargs.get('origin'))
     return output, condition
 
 
-def transform(patch_size_h,patch_size_w,M_tile_inv,H_mat,M_tile,I1,patch_indices,batch_indices_tensor):
+def _stack_channels(I1):
+    # images sharing one homography are sampled as the channels of a single image,
+    # so the grid, source coordinates and bilinear weights are computed once
+    if isinstance(I1, (list, tuple)):
+        return torch.cat([x.float() for x in I1], dim=1), [x.size()[1] for x in I1]
+    return I1, None
+
+
+def _split_channels(output, split):
+    return output if split is None else list(output.split(split, dim=1))
+
+
+def transform(patch_size_h,patch_size_w,M_tile_inv,H_mat,M_tile,I1,patch_indices,batch_indices_tensor,sampler='grid_sample'):
     # Transform H_mat since we scale image indices in transformer
+    # I1: shape=(bs, c, h, w), or a list of such tensors warped together (a list is returned)
+    I1, split = _stack_channels(I1)
     batch_size, num_channels, img_h, img_w = I1.size()
     if torch.cuda.is_available():
         M_tile_inv = M_tile_inv.cuda()
     H_mat = torch.matmul(torch.matmul(M_tile_inv, H_mat), M_tile)
     # Transform image 1 (large image) to image 2
     out_size = (img_h, img_w)
-    warped_images, _ = transformer(I1, H_mat, out_size)
+    warped_images, _ = transformer(I1, H_mat, out_size, sampler)
 
     warped_images_flat = warped_images.reshape([-1,num_channels])
     patch_indices_flat = patch_indices.reshape([-1])
@@ -275,7 +591,46 @@ def transform(patch_size_h,patch_size_w,M_tile_inv,H_mat,M_tile,I1,patch_indices
 
     pred_I2 = pred_I2_flat.reshape([batch_size, patch_size_h, patch_size_w, num_channels])
 
-    return pred_I2.permute(0,3,1,2)
+    return _split_channels(pred_I2.permute(0,3,1,2), split)
+
+def transform_patch(patch_size_h, patch_size_w, M_tile_inv, H_mat, M_tile, I1, patch_origin, sampler='grid_sample'):
+    """
+    Same result as transform(), but only the patch at patch_origin is sampled, so
+    neither the full warped frame nor the patch gather is materialised
+    :param I1: shape=(bs, c, h, w), or a list of such tensors warped together
+    :param patch_origin: (x, y) crop origin of the patch, shape=(bs, 2)
+    :return: shape=(bs, c, patch_size_h, patch_size_w), or a list of them for a list I1
+    """
+    I1, split = _stack_channels(I1)
+    H_mat = torch.matmul(torch.matmul(M_tile_inv, H_mat), M_tile)
+    out_size = (patch_size_h, patch_size_w)
+    pred_I2, _ = transformer(I1, H_mat, out_size, sampler, origin=patch_origin)
+
+    return _split_channels(pred_I2.permute(0,3,1,2), split)
+
+
+def transform_frame(M_tile_inv, H_mat, M_tile, I1, sampler='grid_sample'):
+    """
+    Full-frame warp of transform(), without the patch gather
+    :param I1: shape=(bs, c, h, w), or a list of such tensors warped together
+    :return: shape=(bs, c, h, w), or a list of them for a list I1
+    """
+    I1, split = _stack_channels(I1)
+    H_mat = torch.matmul(torch.matmul(M_tile_inv, H_mat), M_tile)
+    warped, _ = transformer(I1, H_mat, I1.size()[2:], sampler)
+
+    return _split_channels(warped.permute(0,3,1,2), split)
+
+
+def get_patch_origin(patch_indices, img_w):
+    """
+    Crop origin of the patches described by the dataset's flat patch indices
+    :param patch_indices: shape=(bs, patch_size_h*patch_size_w)
+    :return: (x, y), shape=(bs, 2)
+    """
+    first_index = patch_indices[:, 0].long()
+    return torch.stack((first_index % img_w, first_index // img_w), 1)
+
 
 def getBatchHLoss(H, H_inv):
     batch_size = H.size()[0]
@@ -286,6 +641,87 @@ def getBatchHLoss(H, H_inv):
     return criterion_l2(H.bmm(H_inv), Identity)
 
 
+# channels reduced at a time by channel_l1, bounding its temporaries to (bs, 16, h, w)
+CHANNEL_CHUNK = 16
+
+
+def _channel_l1(x1, x2, eps):
+    dist = x1.new_zeros((x1.size()[0],) + x1.size()[2:])
+    for x1_c, x2_c in zip(x1.split(CHANNEL_CHUNK, dim=1), x2.split(CHANNEL_CHUNK, dim=1)):
+        dist += (x1_c - x2_c).add_(eps).abs_().sum(1)
+    return dist
+
+
+class _ChannelL1(torch.autograd.Function):
+    # saves only x1 and x2, which the graph keeps anyway, instead of the per-channel
+    # difference autograd would save for abs
+
+    @staticmethod
+    def forward(ctx, x1, x2, eps):
+        ctx.save_for_backward(x1, x2)
+        ctx.eps = eps
+        return _channel_l1(x1, x2, eps)
+
+    @staticmethod
+    def backward(ctx, grad_dist):
+        x1, x2 = ctx.saved_tensors
+        grad = torch.sign((x1 - x2).add_(ctx.eps)).mul_(grad_dist.unsqueeze(1))
+        grad_x1 = grad if ctx.needs_input_grad[0] else None
+        grad_x2 = -grad if ctx.needs_input_grad[1] else None
+        return grad_x1, grad_x2, None
+
+
+def channel_l1(x1, x2, eps=0.0):
+    """
+    sum over the channels of |x1 - x2 + eps|, without materialising the per-channel map
+    :param x1: shape=(bs, c, h, w)
+    :param x2: shape=(bs, c, h, w)
+    :return: shape=(bs, h, w)
+    """
+    if torch.is_grad_enabled() and (x1.requires_grad or x2.requires_grad):
+        return _ChannelL1.apply(x1, x2, eps)
+    with torch.no_grad():
+        return _channel_l1(x1, x2, eps)
+
+
+def masked_mean(loss_map, mask, per_sample=False):
+    """
+    :param loss_map: shape=(bs, h, w)
+    :param mask: shape=(bs, h, w) or (bs, 1, h, w)
+    :param per_sample: False: sum(mask * loss_map) / sum(mask) over the whole batch;
+                       True: the same per sample, with the mask sum clamped to >= 1, summed over the batch
+    :return: scalar loss
+    """
+    mask = mask.reshape(loss_map.size())
+    if not per_sample:
+        return torch.sum(mask * loss_map) / torch.sum(mask)
+    loss_den = torch.sum(mask.reshape(mask.size()[0], -1), dim=1)
+    loss_num = torch.sum((mask * loss_map).reshape(mask.size()[0], -1), dim=1)
+    return torch.sum(loss_num / torch.clamp(loss_den, min=1.0))
+
+
+def masked_triplet_loss(anchor, positive, negative, mask, margin=1.0, eps=1e-6, per_sample=False):
+    """
+    nn.TripletMarginLoss(p=1) on feature maps, distances taken over the channel dimension,
+    reduced with masked_mean
+    :param anchor: shape=(bs, c, h, w), as positive and negative
+    :param mask: shape=(bs, h, w) or (bs, 1, h, w)
+    :return: scalar loss, loss map shape=(bs, h, w) for the display
+    """
+    loss_map = torch.clamp(channel_l1(anchor, positive, eps) - channel_l1(anchor, negative, eps) + margin, min=0)
+    return masked_mean(loss_map, mask, per_sample), loss_map
+
+
+def get_display_inputs(org_imges, input_tesnors):
+    """
+    :return: I, I2_ori_img and I2 for display_using_tensorboard, normalising uint8 frames first
+    """
+    if org_imges.dtype == torch.uint8:
+        org_imges = normalize_gray(org_imges[:1])
+        input_tesnors = normalize_gray(input_tesnors[:1])
+    return org_imges[:, :1, ...], org_imges[:, 1:2, ...], input_tesnors[:, 1:2, ...]
+
+
 def display_using_tensorboard(I, I2_ori_img, I2, pred_I2, I2_dataMat_CnnFeature, pred_I2_dataMat_CnnFeature, triMask, loss_map, writer):
 
     I1_ori_img = cv2.normalize(I.cpu().detach().numpy()[0, 0, ...], None, 0, 255, cv2.NORM_MINMAX,
@@ -343,6 +779,153 @@ def display_using_tensorboard(I, I2_ori_img, I2, pred_I2, I2_dataMat_CnnFeature,
                      dataformats='HW')
 
 
+class StageTimer(object):
+    """
+    Timer of the stages of a training step. reset() opens the steps of the calling thread,
+    mark(name) closes the running stage and starts name, end_step() closes the last stage and
+    keeps the per-step total of every stage, flush() writes their percentiles to a
+    SummaryWriter and a JSON-lines file. With ranges on, every stage is also a record_function
+    range of the profiler. Disabled (the default), every call returns at once. Times come from
+    perf_counter, after a CUDA synchronize when sync is set, or from CUDA events read back at
+    flush with cuda_events
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.ranges = False
+        self.thread = None
+        self.marks = []
+        self.steps = []
+        self.range = None
+
+    def enable(self, device=None, cuda_events=False, jsonl_path=None, percentiles=(50, 90, 99)):
+        cuda = device is not None and torch.device(device).type == 'cuda'
+        self.device = device
+        self.cuda_events = cuda and cuda_events
+        self.sync = cuda and not cuda_events
+        self.jsonl_path = jsonl_path
+        self.percentiles = percentiles
+        self.enabled = True
+
+    def enable_ranges(self, ranges=True):
+        self._close_range()
+        self.ranges = ranges
+
+    def _now(self):
+        if self.cuda_events:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def _close_range(self):
+        if self.range is not None:
+            self.range.__exit__(None, None, None)
+            self.range = None
+
+    def reset(self):
+        # marks of other threads, e.g. the DataParallel replicas, are ignored
+        self.thread = threading.get_ident()
+        self.marks = []
+        self._close_range()
+
+    def mark(self, name):
+        if not (self.enabled or self.ranges) or threading.get_ident() != self.thread:
+            return
+        if self.enabled:
+            self.marks.append((name, self._now()))
+        if self.ranges:
+            self._close_range()
+            self.range = torch.autograd.profiler.record_function(name)
+            self.range.__enter__()
+
+    def end_step(self):
+        if not (self.enabled or self.ranges) or threading.get_ident() != self.thread:
+            return
+        if self.enabled and self.marks:
+            self.marks.append((None, self._now()))
+            self.steps.append(self.marks)
+        self.marks = []
+        self._close_range()
+
+    def _elapsed_ms(self, start, end):
+        if self.cuda_events:
+            return start.elapsed_time(end)
+        return 1000.0 * (end - start)
+
+    def summary(self):
+        """
+        :return: {stage: {'count', 'mean_ms', 'p50_ms', ...}} over the closed steps, 'step' for whole steps
+        """
+        if self.cuda_events and self.steps:
+            torch.cuda.synchronize(self.device)
+        samples = OrderedDict()
+        for marks in self.steps:
+            step = OrderedDict()
+            for (name, start), (_, end) in zip(marks[:-1], marks[1:]):
+                step[name] = step.get(name, 0.0) + self._elapsed_ms(start, end)
+            step['step'] = self._elapsed_ms(marks[0][1], marks[-1][1])
+            for name, ms in step.items():
+                samples.setdefault(name, []).append(ms)
+        stats = OrderedDict()
+        for name, ms in samples.items():
+            ms = np.array(ms)
+            stats[name] = {'count': int(ms.size), 'mean_ms': float(ms.mean())}
+            for p, value in zip(self.percentiles, np.percentile(ms, self.percentiles)):
+                stats[name]['p{}_ms'.format(p)] = float(value)
+        return stats
+
+    def flush(self, writer=None, step=0):
+        """
+        Write the percentiles of the closed steps and clear them
+        """
+        if not self.enabled or not self.steps:
+            return None
+        stats = self.summary()
+        self.steps = []
+        if writer is not None:
+            for name, s in stats.items():
+                writer.add_scalars('timing/{}'.format(name),
+                                   {'p{}'.format(p): s['p{}_ms'.format(p)] for p in self.percentiles}, step)
+        if self.jsonl_path is not None:
+            with open(self.jsonl_path, 'a') as f:
+                f.write(json.dumps({'step': step, 'stages': stats}) + '\n')
+        return stats
+
+
+# shared by train.py and the model's forward, disabled unless train.py enables it
+stage_timer = StageTimer()
+
+
+def build_profiler(log_dir, wait=1, warmup=1, active=3, repeat=1, top=20):
+    """
+    torch.profiler over a window of steps, advanced by its step(): wait steps are skipped,
+    warmup steps traced and dropped, then active steps recorded with input shapes and memory.
+    Every window writes trace_<step>.json (chrome://tracing) and ops_<step>.txt, the top
+    operators by self time and by self memory, into log_dir
+    """
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    device = 'cpu'
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+        device = 'cuda'
+
+    def on_trace_ready(prof):
+        prof.export_chrome_trace(os.path.join(log_dir, 'trace_{}.json'.format(prof.step_num)))
+        ops = prof.key_averages(group_by_input_shape=True)
+        with open(os.path.join(log_dir, 'ops_{}.txt'.format(prof.step_num)), 'w') as f:
+            f.write(ops.table(sort_by='self_{}_time_total'.format(device), row_limit=top) + '\n')
+            f.write(ops.table(sort_by='self_{}_memory_usage'.format(device), row_limit=top) + '\n')
+        print('Profile of steps up to {} written to {}'.format(prof.step_num, log_dir))
+
+    return torch.profiler.profile(activities=activities,
+                                  schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active,
+                                                                   repeat=repeat),
+                                  on_trace_ready=on_trace_ready, record_shapes=True, profile_memory=True)
+
+
 def synchronize():
     """
        Helper function to synchronize (barrier) among all processes when
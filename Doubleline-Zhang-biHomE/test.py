@@ -6,26 +6,48 @@ import torch.nn as nn
 import imageio
 from torch_homography_model import build_model
 from dataset import *
-from utils import transformer as trans
+from utils import transform_frame
+from utils import get_geometry
+from utils import stage_timer, build_profiler
 import os
+import csv
+import heapq
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 
-def geometricDistance(correspondence, h):
+def geometricDistance(points_1, points_2, h):
     """
-    Correspondence err
-    :param correspondence: Coordinate
-    :param h: Homography
-    :return: L2 distance
+    Correspondence err of all pairs and matches at once
+    :param points_1: Coordinate in img_A, shape=(n, k, 2)
+    :param points_2: Coordinate in img_B, shape=(n, k, 2)
+    :param h: Homography, shape=(n, 3, 3)
+    :return: L2 distance, shape=(n, k)
     """
 
-    p1 = np.transpose(np.matrix([correspondence[0][0], correspondence[0][1], 1]))
-    estimatep2 = np.dot(h, p1)
-    estimatep2 = (1/estimatep2.item(2))*estimatep2
+    p1 = np.concatenate([points_1, np.ones_like(points_1[..., :1])], axis=-1)
+    estimatep2 = np.matmul(p1, np.transpose(h, [0, 2, 1]).astype(np.float64))
+    estimatep2 = (1 / estimatep2[..., 2:]) * estimatep2[..., :2]
+    return np.linalg.norm(points_2 - estimatep2, axis=-1)
 
-    p2 = np.transpose(np.matrix([correspondence[1][0], correspondence[1][1], 1]))
-    error = p2 - estimatep2
-    return np.linalg.norm(error)
+
+def pair_errors(H_mat, matches):
+    """
+    Correspondence err of a batch of pairs
+    :param H_mat: Homography of estimate_homography, shape=(n, 3, 3)
+    :param matches: Coordinate pairs, shape=(n, k, 2, 2)
+    :return: min of the LR and RL L2 distances, shape=(n, k)
+    """
+
+    H_point = np.linalg.inv(H_mat)
+    # float64 reciprocal scaled into float32, as the per-pair (1.0 / H_point.item(8)) * H_point did
+    H_point = (1.0 / H_point[:, 2:, 2:].astype(np.float64)).astype(np.float32) * H_point
+
+    err_LR = geometricDistance(matches[:, :, 0], matches[:, :, 1], H_point)  # because of the order of the Coordinate of img_A and img_B is inconsistent
+    err_RL = geometricDistance(matches[:, :, 1], matches[:, :, 0], H_point)  # the data annotator has no fixed left or right when labelling
+    return np.minimum(err_LR, err_RL)
 
 
 def create_gif(image_list, gif_name, duration=0.35):
@@ -36,6 +58,56 @@ def create_gif(image_list, gif_name, duration=0.35):
     return
 
 
+def save_gifs(result_files, result_name, name, print_img_1, print_img_2, pred_full):
+    """
+    Input and output GIFs of one pair
+    :param print_img_1: BGR frame, shape=(h, w, 3), print_img_2 and pred_full (warped imgA) as well
+    """
+    pred_full = cv2.cvtColor(pred_full, cv2.COLOR_BGR2RGB)
+    print_img_1 = cv2.cvtColor(print_img_1, cv2.COLOR_BGR2RGB)
+    print_img_2 = cv2.cvtColor(print_img_2, cv2.COLOR_BGR2RGB)
+
+    input_list = [print_img_1, print_img_2]
+    output_list = [pred_full, print_img_2]
+    create_gif(input_list, os.path.join(result_files, name+"_input_["+result_name+"].gif"))
+    create_gif(output_list, os.path.join(result_files, name + "_output_[" + result_name + "].gif"))
+
+
+class AsyncWriter(object):
+    """
+    Runs output writes on a thread pool. submit blocks while max_pending writes are queued or
+    running, so a slow disk throttles the test loop instead of filling the memory with frames
+    """
+
+    def __init__(self, num_threads=2, max_pending=16):
+        """
+        :param num_threads: 0 writes synchronously in submit
+        """
+        self.pool = ThreadPoolExecutor(max_workers=num_threads) if num_threads > 0 else None
+        self.slots = threading.BoundedSemaphore(max(max_pending, 1))
+        self.errors = []
+
+    def _done(self, future):
+        self.slots.release()
+        if future.exception() is not None:
+            self.errors.append(future.exception())
+
+    def submit(self, fn, *args):
+        if self.errors:
+            raise self.errors[0]
+        if self.pool is None:
+            fn(*args)
+            return
+        self.slots.acquire()
+        self.pool.submit(fn, *args).add_done_callback(self._done)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+        if self.errors:
+            raise self.errors[0]
+
+
 def test(args):
 
     RE = ['0000011', '0000016', '00000147', '00000155', '00000158', '00000107', '00000239', '0000030']
@@ -44,16 +116,8 @@ def test(args):
     SF = ['00000244', '00000251', '0000026', '0000034', '00000115']
     LF = ['00000104', '0000031', '0000035', '00000129', '00000141', '00000200']
 
-    MSE_RE = []
-    MSE_LT = []
-    MSE_LL = []
-    MSE_SF = []
-    MSE_LF = []
-
     exp_name = os.path.abspath(os.path.join(os.path.dirname("__file__"), os.path.pardir))
     work_dir = os.path.join(exp_name, 'Data')
-    pair_list = list(open(os.path.join(work_dir, 'Test_List.txt')))
-    npy_path = os.path.join(work_dir, 'Coordinate/')
     #result_name = "exp_result_Oneline-FastDLT"
     result_name = "exp_result_oneline-from-scratch"
     result_files = os.path.join(exp_name, result_name)
@@ -62,7 +126,7 @@ def test(args):
 
     result_txt = "result_ours_exp.txt"
     res_txt = os.path.join(result_files, result_txt)
-    f = open(res_txt, "w")
+    res_csv = os.path.join(result_files, "result_ours_exp.csv")
 
     net = build_model(args.model_name, pretrained=args.pretrained)
     # if args.finetune == True:
@@ -89,112 +153,119 @@ def test(args):
     net = torch.nn.DataParallel(net)
     if torch.cuda.is_available():
         net = net.cuda()
+    # estimate_homography is not forward, so DataParallel does not scatter it: evaluation runs on a single device
+    model = getattr(net, 'module', net)
 
-    M_tensor = torch.tensor([[args.img_w/ 2.0, 0., args.img_w/ 2.0],
-                             [0., args.img_h / 2.0, args.img_h / 2.0],
-                             [0., 0., 1.]])
-    if torch.cuda.is_available():
-        M_tensor = M_tensor.cuda()
-
-    M_tile = M_tensor.unsqueeze(0).expand(1, M_tensor.shape[-2], M_tensor.shape[-1])
-    # Inverse of M
-    M_tensor_inv = torch.inverse(M_tensor)
-    M_tile_inv = M_tensor_inv.unsqueeze(0).expand(1, M_tensor_inv.shape[-2], M_tensor_inv.shape[-1])
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 
-    test_data = TestDataset(data_path=exp_name, patch_w=args.patch_size_w, patch_h=args.patch_size_h, rho=16, WIDTH=args.img_w, HEIGHT=args.img_h)
-    test_loader = DataLoader(dataset=test_data, batch_size=1, num_workers=0, shuffle=False, drop_last=True)
+    test_data = TestDataset(data_path=exp_name, patch_w=args.patch_size_w, patch_h=args.patch_size_h, rho=16, WIDTH=args.img_w, HEIGHT=args.img_h,
+                            uint8_frames=args.uint8_frames, frame_store=args.frame_store)
+    test_loader = DataLoader(dataset=test_data, batch_size=args.batch_size, num_workers=args.cpus, shuffle=False,
+                             drop_last=False)
 
     print("start testing")
     net.eval()
-    for i, batch_value in enumerate(test_loader):
-
-        img_pair = pair_list[i]
-        pari_id = img_pair.split(' ')
-        npy_name = pari_id[0].split('/')[1] + '_' + pari_id[1].split('/')[1][:-1] + '.npy'
-        npy_id = npy_path + npy_name
-        video_name = img_pair.split('/')[0]
-
-        org_imges = batch_value[0].float()
-        input_tesnors = batch_value[1].float()
-        patch_indices = batch_value[2].float()
-        h4p = batch_value[3].float()
+    writer = AsyncWriter(args.writer_threads, args.writer_queue)
+    worst = []  # min-heap of the gif_worst largest errors, (err_avg, index, gif arguments)
+    names, video_names, errors = [], [], []
+    start = time.perf_counter()
+    i = 0
+    prof = None
+    if args.profile:
+        prof = build_profiler(result_files, args.profile_wait, args.profile_warmup, args.profile_active,
+                              args.profile_repeat, args.profile_top)
+        stage_timer.enable_ranges()
+        prof.start()
+    stage_timer.reset()
+    stage_timer.mark('data')
+    for batch_value in test_loader:
+        stage_timer.mark('matches')
+
+        org_imges = batch_value[0]
+        if org_imges.dtype != torch.uint8:
+            org_imges = org_imges.float()
+        patch_origin = batch_value[2]
         print_img_1 = batch_value[4]
         print_img_2 = batch_value[5]
-
-        print_img_1_d = print_img_1.cpu().detach().numpy()[0, ...]
-        print_img_2_d = print_img_2.cpu().detach().numpy()[0, ...]
-        print_img_1_d = np.transpose(print_img_1_d, [1, 2, 0])
-        print_img_2_d = np.transpose(print_img_2_d, [1, 2, 0])
-
-        if torch.cuda.is_available():
-            input_tesnors = input_tesnors.cuda()
-            patch_indices = patch_indices.cuda()
-            h4p = h4p.cuda()
-            print_img_1 = print_img_1.cuda()
-
-        batch_out = net(org_imges, input_tesnors, h4p, patch_indices)
-        H_mat = batch_out['H_mat']
-
-        output_size = (args.img_h, args.img_w)
-   
-        H_point = H_mat.squeeze(0)
-        H_point = H_point.cpu().detach().numpy()
-        H_point = np.linalg.inv(H_point)
-        H_point = (1.0 / H_point.item(8)) * H_point
-
-        # print(H_point)
-        point_dic = np.load(npy_id, allow_pickle=True)
-        data = point_dic.item()
-        err_img = 0.0
-        for j in range(6):
-
-            points_LR = data['matche_pts'][j]
-            points_RL = [points_LR[1], points_LR[0]]
-
-            err_LR = geometricDistance(points_LR, H_point)  # because of the order of the Coordinate of img_A and img_B is inconsistent
-            err_RL = geometricDistance(points_RL, H_point)  # the data annotator has no fixed left or right when labelling
-
-            err = min(err_LR, err_RL)
-            err_img += err
-
-        err_avg = err_img / 6
-        name = "0"*(8-len(str(i)))+str(i)
-        line = name + ":" + str(err_avg)+"\n"
- 
-        f.write(line)
-        print("{}:{}".format(i, err_avg))
-        if video_name in RE:
-            MSE_RE.append(err_avg)
-        elif video_name in LT:
-            MSE_LT.append(err_avg)
-        elif video_name in LL:
-            MSE_LL.append(err_avg)
-        elif video_name in SF:
-            MSE_SF.append(err_avg)
-        elif video_name in LF:
-            MSE_LF.append(err_avg)
-
-        H_mat = torch.matmul(torch.matmul(M_tile_inv, H_mat), M_tile)
-        pred_full, _ = trans(print_img_1, H_mat, output_size)  # pred_full = warped imgA
-        pred_full = pred_full.cpu().detach().numpy()[0, ...]
-        pred_full = pred_full.astype(np.uint8)
-        pred_full = cv2.cvtColor(pred_full, cv2.COLOR_BGR2RGB)
-        print_img_1_d = cv2.cvtColor(print_img_1_d, cv2.COLOR_BGR2RGB)
-        print_img_2_d = cv2.cvtColor(print_img_2_d, cv2.COLOR_BGR2RGB)
-
-        input_list = [print_img_1_d, print_img_2_d]
-        output_list = [pred_full, print_img_2_d]
-        create_gif(input_list, os.path.join(result_files, name+"_input_["+result_name+"].gif"))
-        create_gif(output_list, os.path.join(result_files, name + "_output_[" + result_name + "].gif"))
-
-    MSE_RE_avg = np.mean(MSE_RE)
-    MSE_LT_avg = np.mean(MSE_LT)
-    MSE_LL_avg = np.mean(MSE_LL)
-    MSE_SF_avg = np.mean(MSE_SF)
-    MSE_LF_avg = np.mean(MSE_LF)
-    res = {'RE':MSE_RE_avg, 'LT':MSE_LT_avg, 'LL':MSE_LL_avg, 'SF':MSE_SF_avg, 'LF':MSE_LF_avg}
+        video_names.extend(batch_value[6])
+        names.extend(os.path.basename(npy_id)[:-4] for npy_id in batch_value[7])
+        matches = np.array([np.load(npy_id, allow_pickle=True).item()['matche_pts'] for npy_id in batch_value[7]],
+                           dtype=np.float64)  # shape=(bs, 6, 2, 2)
+
+        stage_timer.mark('h2d')
+        # only H is needed here, so skip the warps and the loss of forward; the test patch is fixed
+        img_1, img_2 = org_imges.to(device).chunk(2, dim=1)
+        H_mat = model.estimate_homography(img_1, img_2, args.patch_size_h, args.patch_size_w,
+                                          patch_origin[0].tolist())
+        stage_timer.mark('errors')
+        err = pair_errors(H_mat.cpu().detach().numpy(), matches)
+        errors.append(err)
+        err_avg = np.mean(err, axis=1)
+
+        stage_timer.mark('gifs')
+        # only the sampled pairs and the ones that may enter the worst-K heap are warped
+        batch_size = H_mat.size()[0]
+        every = [j for j in range(batch_size) if args.gif_every > 0 and (i + j) % args.gif_every == 0]
+        candidates = [j for j in range(batch_size) if j not in every and args.gif_worst > 0 and
+                      (len(worst) < args.gif_worst or err_avg[j] > worst[0][0])]
+        drawn = every + candidates
+        if drawn:
+            if torch.cuda.is_available():
+                print_img_1 = print_img_1.cuda()
+            geometry = get_geometry(len(drawn), args.img_h, args.img_w, args.patch_size_h, args.patch_size_w, device)
+            pred_full = transform_frame(geometry.M_tile_inv, H_mat[drawn], geometry.M_tile, print_img_1[drawn])  # pred_full = warped imgA
+            pred_full = np.transpose(pred_full.cpu().detach().numpy(), [0, 2, 3, 1]).astype(np.uint8)
+            print_img_1_d = np.transpose(print_img_1[drawn].cpu().detach().numpy(), [0, 2, 3, 1])
+            print_img_2_d = np.transpose(print_img_2[drawn].cpu().detach().numpy(), [0, 2, 3, 1])
+
+            for k, j in enumerate(drawn):
+                name = "0"*(8-len(str(i + j)))+str(i + j)
+                if j in every:
+                    writer.submit(save_gifs, result_files, result_name, name, print_img_1_d[k], print_img_2_d[k],
+                                  pred_full[k])
+                    continue
+                item = (err_avg[j], i + j, (name, print_img_1_d[k].copy(), print_img_2_d[k].copy(), pred_full[k].copy()))
+                if len(worst) < args.gif_worst:
+                    heapq.heappush(worst, item)
+                else:
+                    heapq.heappushpop(worst, item)
+        i += batch_size
+        print("{}/{}".format(i, len(test_data)))
+        stage_timer.end_step()
+        if prof is not None:
+            prof.step()
+        stage_timer.mark('data')
+    if prof is not None:
+        prof.stop()
+        stage_timer.enable_ranges(False)
+
+    for _, _, gif_args in worst:
+        writer.submit(save_gifs, result_files, result_name, *gif_args)
+    writer.close()
+
+    err = np.concatenate(errors, axis=0)  # shape=(n, 6)
+    err_avg = np.mean(err, axis=1)
+
+    categories = ['RE', 'LT', 'LL', 'SF', 'LF']
+    category_of_video = {video: c for c, videos in enumerate([RE, LT, LL, SF, LF]) for video in videos}
+    category = np.array([category_of_video.get(video, len(categories)) for video in video_names], dtype=np.int64)
+    err_sum = np.bincount(category, weights=err_avg, minlength=len(categories) + 1)[:len(categories)]
+    count = np.bincount(category, minlength=len(categories) + 1)[:len(categories)]
+    # a category without pairs is nan, as np.mean of an empty list
+    MSE_avg = np.where(count > 0, err_sum / np.maximum(count, 1), np.nan)
+    print('{} pairs in {:.1f}s'.format(len(err_avg), time.perf_counter() - start))
+
+    with open(res_csv, "w", newline="") as f:
+        rows = csv.writer(f)
+        rows.writerow(['index', 'pair', 'video', 'category', 'err_avg'] + ['err_{}'.format(j) for j in range(err.shape[1])])
+        for k in range(len(err_avg)):
+            rows.writerow([k, names[k], video_names[k], (categories + [''])[category[k]], repr(float(err_avg[k]))] +
+                          [repr(float(e)) for e in err[k]])
+
+    res = dict(zip(categories, MSE_avg.tolist()))
     print(res)
-    f.write(str(res))
+    with open(res_txt, "w") as f:
+        f.write(str(res))
     return res
 
 
@@ -208,9 +279,22 @@ if __name__=="__main__":
     parser.add_argument('--img_h', type=int, default=360)
     parser.add_argument('--patch_size_h', type=int, default=315)
     parser.add_argument('--patch_size_w', type=int, default=560)
+    parser.add_argument('--uint8_frames', action='store_true', help='Load raw uint8 frames, normalised on the device')
+    parser.add_argument('--frame_store', type=str, default=None, help='Path of a Data/build_frame_store.py output, without extension')
 
-    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--batch_size', type=int, default=8)
     parser.add_argument('--lr', type=float, default=1e-9, help='learning rate')
+    parser.add_argument('--gif_every', type=int, default=1, help='GIFs of every Nth pair, 0 disables')
+    parser.add_argument('--gif_worst', type=int, default=0, help='GIFs of the K pairs with the largest errors')
+    parser.add_argument('--writer_threads', type=int, default=2, help='GIF writing threads, 0 writes in the test loop')
+    parser.add_argument('--writer_queue', type=int, default=16, help='GIF writes pending before the test loop waits')
+    parser.add_argument('--profile', action='store_true',
+                        help='torch.profiler over a window of batches, trace and operator table to the result dir')
+    parser.add_argument('--profile_wait', type=int, default=1, help='Batches skipped before the window')
+    parser.add_argument('--profile_warmup', type=int, default=1, help='Batches traced and dropped')
+    parser.add_argument('--profile_active', type=int, default=3, help='Batches recorded')
+    parser.add_argument('--profile_repeat', type=int, default=1, help='Number of windows, 0 until the end')
+    parser.add_argument('--profile_top', type=int, default=20, help='Rows of the operator tables')
 
     parser.add_argument('--model_name', type=str, default='resnet34')
     parser.add_argument('--pretrained', type=bool, default=False, help='Use pretrained waights?')
@@ -1,11 +1,17 @@
+import threading
+from collections import OrderedDict
+from functools import reduce
+from types import SimpleNamespace
+
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.utils.model_zoo as model_zoo
 import torch, imageio
-from utils import transform, DLT_solve
+from utils import transform_patch, get_patch_origin, get_geometry, get_patch_corners, DLT_solve, normalize_gray
+from utils import inference_mode, siamese_forward, stage_timer, masked_triplet_loss
 import torchvision.models as models
 
 criterion_l2 = nn.MSELoss(reduce=True, size_average=True)
-triplet_loss = nn.TripletMarginLoss(margin=1.0, p=1, reduce=False,size_average=False)
 
 __all__ = ['ResNet', 'resnet18', 'resnet34', 'resnet50', 'resnet101',
            'resnet152']
@@ -27,16 +33,20 @@ def create_gif(image_list, gif_name, duration=0.35):
     return
 
 
-def getPatchFromFullimg(patch_size_h, patch_size_w, patchIndices, batch_indices_tensor, img_full):
+def getPatchFromFullimg(patch_size_h, patch_size_w, patch_origin, img_full):
+    """
+    :param patch_origin: (x, y) crop origin of every patch, shape=(bs, 2)
+    :return: shape=(bs, c, patch_size_h, patch_size_w)
+    """
     num_batch, num_channels, height, width = img_full.size()
-    warped_images_flat = img_full.reshape(-1)
-    patch_indices_flat = patchIndices.reshape(-1)
+    patch_origin = patch_origin.long()
 
-    pixel_indices = patch_indices_flat.long() + batch_indices_tensor
-    mask_patch = torch.gather(warped_images_flat, 0, pixel_indices)
-    mask_patch = mask_patch.reshape([num_batch, 1, patch_size_h, patch_size_w])
+    batch = torch.arange(num_batch, device=img_full.device).reshape(-1, 1, 1)
+    rows = patch_origin[:, 1:] + torch.arange(patch_size_h, device=img_full.device)
+    cols = patch_origin[:, :1] + torch.arange(patch_size_w, device=img_full.device)
+    mask_patch = img_full[batch, :, rows.unsqueeze(2), cols.unsqueeze(1)]
 
-    return mask_patch
+    return mask_patch.permute(0, 3, 1, 2)
 
 
 def normMask(mask, strenth = 0.5):
@@ -177,10 +187,199 @@ class AuxiliaryResnet(nn.Module):
         return x
 
 
+def fold_conv_bn(conv, bn):
+    """
+    conv followed by eval-mode bn as a single convolution
+    :return: weight, bias
+    """
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    weight = conv.weight * scale.reshape(-1, 1, 1, 1)
+    bias = bn.bias - bn.running_mean * scale
+    if conv.bias is not None:
+        bias = bias + conv.bias * scale
+    return weight.detach().clone(), bias.detach().clone()
+
+
+class FrozenAuxiliaryResnet(nn.Module):
+    """
+    AuxiliaryResnet with its frozen weights folded: conv1 summed over the RGB channels
+    the gray input used to be repeated to, and every BatchNorm folded into its convolution
+    with the running statistics, as in eval mode. The original frozen layers are kept as
+    self.resnet, so the state_dict keys are those of AuxiliaryResnet and checkpoints load
+    both ways; the folded weights are buffers left out of the state_dict, refolded on every load.
+    target_features computes the features that need no gradient without autograd history
+    and, with cache_size > 0, reuses them when the same input patch recurs
+    """
+
+    def __init__(self, auxiliary_resnet, cache_size=0):
+        super(FrozenAuxiliaryResnet, self).__init__()
+        self.resnet = resnet = auxiliary_resnet.resnet
+        # (conv path, bn path, gray) in self.resnet and conv arguments per folded conv
+        self.fold_sources, self.conv_args = OrderedDict(), {}
+        self.stem = self._register_conv('conv1', 'conv1', 'bn1', gray=True)
+        self.maxpool = resnet.maxpool
+
+        # (conv names of the residual branch, downsample conv name or None) per block
+        self.blocks = []
+        for layer in range(1, auxiliary_resnet.auxiliary_resnet_output_layer + 1):
+            for b, block in enumerate(getattr(resnet, 'layer{}'.format(layer))):
+                prefix, path = 'layer{}_{}_'.format(layer, b), 'layer{}.{}.'.format(layer, b)
+                names, i = [], 1
+                while hasattr(block, 'conv{}'.format(i)):
+                    names.append(self._register_conv(prefix + 'conv{}'.format(i), path + 'conv{}'.format(i),
+                                                     path + 'bn{}'.format(i)))
+                    i += 1
+                downsample = None
+                if block.downsample is not None:
+                    downsample = self._register_conv(prefix + 'downsample', path + 'downsample.0',
+                                                     path + 'downsample.1')
+                self.blocks.append((names, downsample))
+
+        # per-sample LRU of target features; the dicts are shared by the DataParallel replicas,
+        # which copy the module attributes, so hits and misses count the lookups of all devices
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.cache_counts = {'hits': 0, 'misses': 0}
+
+    @property
+    def hits(self):
+        return self.cache_counts['hits']
+
+    @property
+    def misses(self):
+        return self.cache_counts['misses']
+
+    def _submodule(self, path):
+        # getattr chain rather than Module.get_submodule (torch 1.9), nn.Sequential children are named '0', '1'...
+        return reduce(getattr, path.split('.'), self.resnet)
+
+    def _register_conv(self, name, conv_path, bn_path, gray=False):
+        conv = self._submodule(conv_path)
+        self.fold_sources[name] = (conv_path, bn_path, gray)
+        self.conv_args[name] = (conv.stride, conv.padding, conv.dilation, conv.groups)
+        weight, bias = self._fold(name)
+        self.register_buffer(name + '_weight', weight)
+        self.register_buffer(name + '_bias', bias)
+        return name
+
+    def _fold(self, name, state_dict=None, prefix=''):
+        conv_path, bn_path, gray = self.fold_sources[name]
+        conv = self._source(conv_path, state_dict, prefix)
+        bn = self._source(bn_path, state_dict, prefix)
+        weight, bias = fold_conv_bn(conv, bn)
+        if gray:
+            weight = weight.sum(1, keepdim=True)
+        return weight, bias
+
+    def _source(self, path, state_dict=None, prefix=''):
+        """
+        The module at path in self.resnet, or a stand-in with its tensors taken from
+        state_dict where it holds them in the module's shape
+        """
+        module = self._submodule(path)
+        if state_dict is None:
+            return module
+        tensors = {'eps': getattr(module, 'eps', None)}
+        for key, current in list(module._parameters.items()) + list(module._buffers.items()):
+            loaded = state_dict.get('{}resnet.{}.{}'.format(prefix, path, key))
+            if current is not None and loaded is not None and loaded.size() == current.size():
+                current = loaded.to(current)
+            tensors[key] = current
+        return SimpleNamespace(**tensors)
+
+    def refold(self, state_dict=None, prefix=''):
+        """
+        Rebuild the folded weights from self.resnet, or from the self.resnet entries of
+        state_dict, e.g. of a checkpoint being loaded
+        """
+        for name in self.fold_sources:
+            weight, bias = self._fold(name, state_dict, prefix)
+            setattr(self, name + '_weight', weight)
+            setattr(self, name + '_bias', bias)
+        with self.cache_lock:
+            self.cache.clear()
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        # the folded buffers are derived from self.resnet, which saves itself as a child
+        pass
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        # self.resnet loads after this, as a child, so fold from the checkpoint tensors themselves;
+        # the folded buffers are not in the state_dict and must not be reported missing
+        if strict:
+            for key in state_dict:
+                if key.startswith(prefix) and key[len(prefix):].split('.', 1)[0] not in self._modules:
+                    unexpected_keys.append(key)
+        self.refold(state_dict, prefix)
+
+    def _conv(self, name, x):
+        return F.conv2d(x, getattr(self, name + '_weight'), getattr(self, name + '_bias'), *self.conv_args[name])
+
+    def forward(self, x):
+        """
+        :param x: gray patches, shape=(bs, 1, h, w)
+        """
+        x = F.relu(self._conv(self.stem, x), inplace=True)
+        x = self.maxpool(x)
+
+        for names, downsample in self.blocks:
+            out = x
+            for i, name in enumerate(names):
+                out = self._conv(name, out)
+                if i < len(names) - 1:
+                    out = F.relu(out, inplace=True)
+            identity = x if downsample is None else self._conv(downsample, x)
+            x = F.relu(out + identity, inplace=True)
+
+        return x
+
+    def target_features(self, inputs):
+        """
+        Features of patches that need no gradient, e.g. the frozen targets of the feature loss
+        :param inputs: list of tensors, shape=(bs, 1, h, w) each
+        :return: list of features, one per input
+        """
+        x = torch.cat(inputs, dim=0)
+        with torch.no_grad():
+            features = self._cached_forward(x) if self.cache_size > 0 else self(x)
+        return list(features.chunk(len(inputs), dim=0))
+
+    def _cached_forward(self, x):
+        # a cheap fingerprint finds the candidate entry, torch.equal confirms it
+        flat = x.reshape(x.size()[0], -1).double()
+        fingerprints = torch.stack((flat.sum(1), (flat * flat).sum(1)), 1).tolist()
+        keys = [(str(x.device), tuple(x.size()[1:])) + tuple(f) for f in fingerprints]
+
+        features, missing = [None] * len(keys), []
+        with self.cache_lock:
+            for i, key in enumerate(keys):
+                entry = self.cache.get(key)
+                if entry is not None and torch.equal(entry[0], x[i]):
+                    self.cache.move_to_end(key)
+                    features[i] = entry[1]
+                else:
+                    missing.append(i)
+            self.cache_counts['hits'] += len(keys) - len(missing)
+            self.cache_counts['misses'] += len(missing)
+
+        if missing:
+            computed = self(x[missing])
+            with self.cache_lock:
+                for i, feature in zip(missing, computed):
+                    features[i] = feature
+                    self.cache[keys[i]] = (x[i].clone(), feature)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+        return torch.stack(features, dim=0)
+
+
 # define and forward ( Because of the load is unbalanced when use torch.nn.DataParallel, we define warp in forward)
 class ResNet(nn.Module):
 
-    def __init__(self, block, layers, num_classes=1000):
+    def __init__(self, block, layers, num_classes=1000, siamese=True, frozen_aux=False, aux_cache_size=0):
         self.inplanes = 64
         super(ResNet, self).__init__()
         self.conv1 = nn.Conv2d(2, 64, kernel_size=7, stride=2, padding=3,
@@ -194,6 +393,8 @@ class ResNet(nn.Module):
         self.layer4 = self._make_layer(block, 512, layers[3], stride=2)
         self.avgpool = nn.AvgPool2d(7, stride=1)
         self.fc = nn.Linear(512 * block.expansion, num_classes)
+        # run the shared-weight branches as one batched call, see utils.siamese_forward
+        self.siamese = siamese
 
         self.ShareFeature = nn.Sequential(
             nn.Conv2d(1, 4, kernel_size=3, padding=1, bias=False),
@@ -243,6 +444,9 @@ class ResNet(nn.Module):
         #######################################################################
 
         self.auxiliary_resnet = AuxiliaryResnet()
+        self.frozen_aux = frozen_aux
+        if frozen_aux:
+            self.auxiliary_resnet = FrozenAuxiliaryResnet(self.auxiliary_resnet, aux_cache_size)
 
     def _make_layer(self, block, planes, blocks, stride=1):
         downsample = None
@@ -261,67 +465,122 @@ class ResNet(nn.Module):
 
         return nn.Sequential(*layers)
 
+    def regress_offsets(self, patch_1, patch_2):
+
+        x = torch.cat((patch_1, patch_2), dim=1)
+
+        x = self.conv1(x)
+        x = self.bn1(x)
+        x = self.relu(x)
+        x = self.maxpool(x)
+
+        x = self.layer1(x)
+        x = self.layer2(x)
+        x = self.layer3(x)
+        x = self.layer4(x)
+
+        x = self.avgpool(x)
+        x = x.view(x.size(0), -1)
+        x = self.fc(x)
+
+        return x
+
+    def predict_homography(self, patch_1, patch_2, h4p):
+
+        stage_timer.mark('backbone')
+        x = self.regress_offsets(patch_1, patch_2)
+        stage_timer.mark('DLT')
+        H_mat = DLT_solve(h4p, x).squeeze(1)
+
+        return H_mat
+
+    def encode_frames(self, frames, patch_origin, patch_size_h, patch_size_w):
+        """
+        Masked ShareFeature of one patch per frame, the per-frame part of forward
+        :param frames: normalised gray, shape=(bs, 1, h, w)
+        :param patch_origin: (x, y) of the patch, shared by the batch
+        :return: shape=(bs, 1, patch_size_h, patch_size_w)
+        """
+        _, _, img_h, img_w = frames.size()
+        x, y = patch_origin
+        stage_timer.mark('genMask')
+        # genMask only needs its receptive field around the patch, not the full frame
+        halo = sum(m.padding[0] for m in self.genMask if isinstance(m, nn.Conv2d))
+        x0, y0 = max(x - halo, 0), max(y - halo, 0)
+        x1, y1 = min(x + patch_size_w + halo, img_w), min(y + patch_size_h + halo, img_h)
+        mask = self.genMask(frames[:, :, y0:y1, x0:x1])
+        mask = normMask(mask[:, :, y - y0:y - y0 + patch_size_h, x - x0:x - x0 + patch_size_w])
+
+        stage_timer.mark('ShareFeature')
+        patch = self.ShareFeature(frames[:, :, y:y + patch_size_h, x:x + patch_size_w])
+        return torch.mul(patch, mask)
+
+    def estimate_homography(self, img1, img2, patch_size_h=315, patch_size_w=560, patch_origin=None):
+        """
+        Inference-only homography of the pair: mask, features, backbone and DLT, without
+        the warps, loss and debug outputs of forward. Call eval() first
+        :param img1: uint8 BGR, shape=(bs, 3, h, w), or normalised gray, shape=(bs, 1, h, w)
+        :param patch_origin: (x, y) of the patch, the centred patch of test.py by default
+        :return: H mapping img2 pixel coordinates into img1, in full-frame pixels, shape=(bs, 3, 3)
+        """
+        batch_size, _, img_h, img_w = img1.size()
+        if patch_origin is None:
+            patch_origin = ((img_w - patch_size_w + 1) // 2, (img_h - patch_size_h + 1) // 2)
+        h4p = get_patch_corners(batch_size, patch_origin, patch_size_h, patch_size_w, img1.device)
+
+        with inference_mode():
+            stage_timer.mark('prepare')
+            frames = torch.cat((img1, img2), dim=0)
+            if frames.dtype == torch.uint8:
+                frames = normalize_gray(frames)
+            features = self.encode_frames(frames, patch_origin, patch_size_h, patch_size_w)
+            patch_1, patch_2 = features.chunk(2, dim=0)
+            return self.predict_homography(patch_1, patch_2, h4p)
+
     # forward ( Because of the load is unbalanced when use torch.nn.DataParallel, we define warp in forward)
-    def forward(self, org_imges, input_tesnors, h4p, patch_indices):
+    def forward(self, org_imges, input_tesnors, h4p, patch_origin):
+
+        stage_timer.mark('prepare')
+        if org_imges.dtype == torch.uint8:
+            # raw BGR frames of the datasets' uint8_frames mode
+            org_imges = normalize_gray(org_imges)
+            input_tesnors = normalize_gray(input_tesnors)
 
         batch_size, _, img_h, img_w = org_imges.size()
         _, _, patch_size_h, patch_size_w = input_tesnors.size() 
 
-        y_t = torch.arange(0, batch_size * img_w * img_h,
-                           img_w * img_h)
-        batch_indices_tensor = y_t.unsqueeze(1).expand(y_t.shape[0], patch_size_h * patch_size_w).reshape(-1)
-
-        M_tensor = torch.tensor([[img_w / 2.0, 0., img_w / 2.0],
-                      [0., img_h / 2.0, img_h / 2.0],
-                      [0., 0., 1.]])
+        geometry = get_geometry(batch_size, img_h, img_w, patch_size_h, patch_size_w, org_imges.device)
+        M_tile, M_tile_inv = geometry.M_tile, geometry.M_tile_inv
 
-        if torch.cuda.is_available():
-            M_tensor = M_tensor.cuda()
-            batch_indices_tensor = batch_indices_tensor.cuda()
+        if patch_origin.size()[-1] != 2:
+            # flat patch pixel indices of the old dataset contract
+            patch_origin = get_patch_origin(patch_origin, img_w)
+        stage_timer.mark('genMask')
 
-        M_tile = M_tensor.unsqueeze(0).expand(batch_size, M_tensor.shape[-2], M_tensor.shape[-1])
-        # Inverse of M
-        M_tensor_inv = torch.inverse(M_tensor)
-        M_tile_inv = M_tensor_inv.unsqueeze(0).expand(batch_size, M_tensor_inv.shape[-2],
-                                                      M_tensor_inv.shape[-1])
+        mask_I1_full, mask_I2_full = siamese_forward(self.genMask, [org_imges[:, :1, ...], org_imges[:, 1:, ...]],
+                                                     self.siamese)
 
-        mask_I1_full = self.genMask(org_imges[:, :1, ...])
-        mask_I2_full = self.genMask(org_imges[:, 1:, ...])
-
-        mask_I1 = getPatchFromFullimg(patch_size_h, patch_size_w, patch_indices, batch_indices_tensor, mask_I1_full)
-        mask_I2 = getPatchFromFullimg(patch_size_h, patch_size_w, patch_indices, batch_indices_tensor, mask_I2_full)
+        mask_I1 = getPatchFromFullimg(patch_size_h, patch_size_w, patch_origin, mask_I1_full)
+        mask_I2 = getPatchFromFullimg(patch_size_h, patch_size_w, patch_origin, mask_I2_full)
 
         mask_I1 = normMask(mask_I1)
 
         mask_I2 = normMask(mask_I2)
+        stage_timer.mark('ShareFeature')
 
-        patch_1 = self.ShareFeature(input_tesnors[:, :1, ...])
-        patch_2 = self.ShareFeature(input_tesnors[:, 1:, ...])
+        patch_1, patch_2 = siamese_forward(self.ShareFeature, [input_tesnors[:, :1, ...], input_tesnors[:, 1:, ...]],
+                                           self.siamese)
 
         patch_1_res = torch.mul(patch_1, mask_I1)
         patch_2_res = torch.mul(patch_2, mask_I2)
-        x = torch.cat((patch_1_res, patch_2_res), dim=1)
-
-        x = self.conv1(x)
-        x = self.bn1(x)
-        x = self.relu(x)
-        x = self.maxpool(x)
-
-        x = self.layer1(x)
-        x = self.layer2(x)
-        x = self.layer3(x)
-        x = self.layer4(x)
-
-        x = self.avgpool(x)
-        x = x.view(x.size(0), -1)
-        x = self.fc(x)
-        
+        stage_timer.mark('backbone')
+        x = self.regress_offsets(patch_1_res, patch_2_res)
+        stage_timer.mark('DLT')
         H_mat = DLT_solve(h4p, x).squeeze(1)
+        stage_timer.mark('warp')
 
-        pred_I2 = transform(patch_size_h, patch_size_w, M_tile_inv, H_mat, M_tile,
-                            org_imges[:, :1, ...], patch_indices, batch_indices_tensor)
-        pred_Mask = transform(patch_size_h, patch_size_w, M_tile_inv, H_mat, M_tile,
-                            mask_I1_full, patch_indices, batch_indices_tensor)
+        pred_I2, pred_Mask = transform_patch(patch_size_h, patch_size_w, M_tile_inv, H_mat, M_tile,
+                                             [org_imges[:, :1, ...], mask_I1_full], patch_origin)
 
         pred_Mask = normMask(pred_Mask)
 
@@ -340,9 +599,16 @@ class ResNet(nn.Module):
         #sum_value = torch.sum(mask_ap)
         #pred_I2_CnnFeature = self.ShareFeature(pred_I2)
 
-        patch_1 = self.auxiliary_resnet(input_tesnors[:, :1, ...])
-        patch_2 = self.auxiliary_resnet(input_tesnors[:, 1:, ...])
-        pred_I2_CnnFeature = self.auxiliary_resnet(pred_I2)
+        stage_timer.mark('aux')
+        if self.frozen_aux:
+            # frozen targets without autograd history, only pred_I2 needs gradients
+            patch_1, patch_2 = self.auxiliary_resnet.target_features([input_tesnors[:, :1, ...],
+                                                                      input_tesnors[:, 1:, ...]])
+            pred_I2_CnnFeature = self.auxiliary_resnet(pred_I2)
+        else:
+            patch_1, patch_2, pred_I2_CnnFeature = siamese_forward(
+                self.auxiliary_resnet, [input_tesnors[:, :1, ...], input_tesnors[:, 1:, ...], pred_I2], self.siamese)
+        stage_timer.mark('loss')
 
         # Downsample mask
         downsample_factor = 4
@@ -354,23 +620,13 @@ class ResNet(nn.Module):
         #l1 = 1 - torch.cosine_similarity(pred_I2_CnnFeature, patch_2, dim=1)
         #l3 = 1 - torch.cosine_similarity(patch_1, patch_2, dim=1)
 
-        # L1 distance
-        l1 = torch.sum(torch.abs(pred_I2_CnnFeature - patch_2), axis=1)
-        l3 = torch.sum(torch.abs(patch_1 - patch_2), axis=1)
-
         # Prepare mask
         mask_ap = torch.squeeze(mask_ap, dim=1)
-        triplet_margin = 100.
-        feature_loss_mat = torch.max(l1-l3 + torch.ones_like(l1) * triplet_margin, torch.zeros_like(l1))
-
-        # Triplet loss
-        feature_loss_mat = triplet_loss(patch_2, pred_I2_CnnFeature, patch_1)        
 
-        # Triplet loss Normalized by mask
-        loss_den = torch.sum(torch.sum(mask_ap, dim=-1), dim=-1)
-        feature_loss = torch.sum(torch.sum(mask_ap * feature_loss_mat, dim=-1), dim=-1) /\
-                       torch.max(loss_den, torch.ones_like(loss_den))
-        feature_loss = torch.unsqueeze(torch.sum(feature_loss), dim=0)
+        # Triplet loss Normalized by mask, per sample
+        feature_loss, feature_loss_mat = masked_triplet_loss(patch_2, pred_I2_CnnFeature, patch_1, mask_ap,
+                                                             per_sample=True)
+        feature_loss = torch.unsqueeze(feature_loss, dim=0)
 
         # Old implementation
 #         feature_loss_mat = triplet_loss(patch_2, pred_I2_CnnFeature, patch_1)
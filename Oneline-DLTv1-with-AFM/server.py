@@ -0,0 +1,280 @@
+# coding: utf-8
+import argparse
+import http.client
+import io
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+from streaming import load_model
+
+
+class DynamicBatcher(object):
+    """
+    Coalesces concurrent pair requests into batches for ResNet.estimate_homography: a batch
+    closes when it holds max_batch_size pairs or max_wait_ms after its first pair arrived,
+    and runs as one call per frame size found in it
+    """
+
+    def __init__(self, net, max_batch_size=8, max_wait_ms=5.0, patch_size_h=315, patch_size_w=560,
+                 latency_window=10000):
+        self.net = net
+        self.device = next(net.parameters()).device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.patch_size_h, self.patch_size_w = patch_size_h, patch_size_w
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.batch_sizes = Counter()
+        self.latencies = deque(maxlen=latency_window)
+        self.num_requests, self.num_errors = 0, 0
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, img1, img2):
+        """
+        :param img1: uint8 BGR frame, shape=(h, w, 3), img2 of the same shape
+        :return: Future of H mapping img2 pixel coordinates into img1, in full-frame pixels, shape=(3, 3)
+        """
+        if img1.dtype != np.uint8 or img1.ndim != 3 or img1.shape[2] != 3 or img1.shape != img2.shape:
+            raise ValueError('expected two uint8 BGR frames of the same (h, w, 3) shape, got {} and {}'.format(
+                img1.shape, img2.shape))
+        if img1.shape[0] < self.patch_size_h or img1.shape[1] < self.patch_size_w:
+            raise ValueError('frame {} is smaller than the patch ({}, {})'.format(
+                img1.shape[:2], self.patch_size_h, self.patch_size_w))
+        future = Future()
+        self.requests.put((time.perf_counter(), img1, img2, future))
+        return future
+
+    def close(self):
+        self.requests.put(None)
+        self.worker.join()
+
+    def _collect(self):
+        first = self.requests.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first[0] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                item = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                # serve what was collected, then stop
+                self.requests.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _estimate(self, batch):
+        img1 = torch.from_numpy(np.stack([item[1] for item in batch])).permute(0, 3, 1, 2).to(self.device)
+        img2 = torch.from_numpy(np.stack([item[2] for item in batch])).permute(0, 3, 1, 2).to(self.device)
+        H_mat = self.net.estimate_homography(img1, img2, self.patch_size_h, self.patch_size_w)
+        return H_mat.cpu().numpy()
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                break
+            groups = {}
+            for item in batch:
+                groups.setdefault(item[1].shape, []).append(item)
+            for group in groups.values():
+                try:
+                    H_mats = self._estimate(group)
+                except Exception as e:
+                    for item in group:
+                        item[3].set_exception(e)
+                    with self.lock:
+                        self.num_errors += len(group)
+                    continue
+                done = time.perf_counter()
+                with self.lock:
+                    for item in group:
+                        self.latencies.append(done - item[0])
+                    self.num_requests += len(group)
+                for item, H_mat in zip(group, H_mats):
+                    item[3].set_result(H_mat)
+            with self.lock:
+                self.batch_sizes[len(batch)] += 1
+
+    def metrics(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000.0
+            metrics = {'queue_depth': self.requests.qsize(), 'requests': self.num_requests,
+                       'errors': self.num_errors, 'batches': sum(self.batch_sizes.values()),
+                       'batch_size_histogram': {str(k): v for k, v in sorted(self.batch_sizes.items())}}
+        if latencies.size:
+            metrics['latency_ms'] = {'p50': float(np.percentile(latencies, 50)),
+                                     'p99': float(np.percentile(latencies, 99)),
+                                     'max': float(latencies.max()), 'window': int(latencies.size)}
+        return metrics
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /homography: body is an .npz (np.savez) of two uint8 BGR frames img1 and img2,
+    answers {"H": 3x3 list} with H mapping img2 pixel coordinates into img1. GET /metrics answers
+    the batcher's metrics
+    """
+
+    def _reply(self, code, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self._reply(200, self.server.batcher.metrics())
+        else:
+            self._reply(404, {'error': 'unknown path {}'.format(self.path)})
+
+    def do_POST(self):
+        if self.path != '/homography':
+            self._reply(404, {'error': 'unknown path {}'.format(self.path)})
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            with np.load(io.BytesIO(body), allow_pickle=False) as pair:
+                future = self.server.batcher.submit(pair['img1'], pair['img2'])
+        except Exception as e:
+            # a malformed body fails in many ways: EOFError when empty, BadZipFile when truncated,
+            # KeyError without img1/img2, ValueError from submit
+            self._reply(400, {'error': '{}: {}'.format(type(e).__name__, e)})
+            return
+        try:
+            H_mat = future.result()
+        except Exception as e:
+            self._reply(500, {'error': str(e)})
+            return
+        self._reply(200, {'H': H_mat.tolist()})
+
+    def log_message(self, format, *args):
+        # one line per request would dominate the cost of a batched call
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super(UnixHTTPServer, self).get_request()
+        # BaseHTTPRequestHandler expects an (host, port) client address
+        return request, ('unix', 0)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout=60):
+        super(UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def connect(address, timeout=60):
+    """
+    :param address: host:port, or the path of a Unix socket
+    """
+    if ':' in address and not os.path.exists(address):
+        host, port = address.rsplit(':', 1)
+        return http.client.HTTPConnection(host, int(port), timeout=timeout)
+    return UnixHTTPConnection(address, timeout)
+
+
+def request_homography(address, img1, img2, timeout=60):
+    """
+    Client side of POST /homography
+    :return: H mapping img2 pixel coordinates into img1, in full-frame pixels, shape=(3, 3)
+    """
+    buffer = io.BytesIO()
+    np.savez(buffer, img1=img1, img2=img2)
+    conn = connect(address, timeout)
+    try:
+        conn.request('POST', '/homography', buffer.getvalue(), {'Content-Type': 'application/octet-stream'})
+        response = conn.getresponse()
+        content = json.loads(response.read().decode('utf-8'))
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise RuntimeError('{}: {}'.format(response.status, content.get('error')))
+    return np.array(content['H'], dtype=np.float32)
+
+
+def load_checkpoint(args, device):
+    # load_model keeps the random weights when it gets no checkpoint, never serve those
+    if not args.model_path:
+        raise FileNotFoundError('no checkpoint to serve: pass --model_path')
+    return load_model(args.model_name, args.model_path, device)
+
+
+def serve(args):
+    device = torch.device('cpu') if args.cpu or not torch.cuda.is_available() else torch.device('cuda')
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    net = load_checkpoint(args, device)
+    batcher = DynamicBatcher(net, args.max_batch_size, args.max_wait_ms, args.patch_size_h, args.patch_size_w)
+
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixHTTPServer(args.socket, RequestHandler)
+        address = args.socket
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+        server.daemon_threads = True
+        address = '{}:{}'.format(*server.server_address[:2])
+    server.batcher = batcher
+    print('serving on {} ({}), max batch {}, max wait {} ms'.format(address, device, args.max_batch_size,
+                                                                    args.max_wait_ms))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+        print(json.dumps(batcher.metrics()))
+
+
+if __name__=="__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_name', type=str, default='resnet34')
+    parser.add_argument('--model_path', type=str, required=True, help='checkpoint, e.g. a torch.save(net) of train.py')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--socket', type=str, default=None, help='serve on this Unix socket instead of TCP')
+    parser.add_argument('--max_batch_size', type=int, default=8)
+    parser.add_argument('--max_wait_ms', type=float, default=5.0, help='how long a batch waits for more pairs')
+    parser.add_argument('--cpu', action='store_true', help='run on CPU even if CUDA is available')
+    parser.add_argument('--threads', type=int, default=0, help='torch CPU threads, 0 keeps the default')
+    parser.add_argument('--patch_size_h', type=int, default=315)
+    parser.add_argument('--patch_size_w', type=int, default=560)
+
+    args = parser.parse_args()
+    serve(args)
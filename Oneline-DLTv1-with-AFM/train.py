@@ -10,8 +10,8 @@ from tensorboardX import SummaryWriter
 import cv2
 from torch_homography_model import build_model
 from datetime import datetime
-from dataset import TrainDataset
-from utils import display_using_tensorboard
+from dataset import TrainDataset, VideoPairDataset, SyntheticPairDataset
+from utils import display_using_tensorboard, get_display_inputs, stage_timer, build_profiler
 
 # name of log
 train_log_dir = 'train_log_Oneline-FastDLT'
@@ -40,7 +40,8 @@ if not os.path.exists(LOG_DIR):
 def train(args):
 
     train_path = os.path.join(exp_name, 'Data/Train_List.txt')
-    net = build_model(args.model_name, pretrained=args.pretrained)
+    net = build_model(args.model_name, pretrained=args.pretrained, siamese=not args.sequential_branches,
+                      frozen_aux=args.frozen_aux, aux_cache_size=args.aux_cache_size)
 
     if args.finetune:
         model_path = os.path.join(exp_name, 'models/freeze-mask-first-fintune.pth')
@@ -53,7 +54,8 @@ def train(args):
             name_key = k[7:]  # remove `module.`
             new_state_dict[name_key] = v
         # load params
-        net = build_model(args.model_name)
+        net = build_model(args.model_name, siamese=not args.sequential_branches, frozen_aux=args.frozen_aux,
+                          aux_cache_size=args.aux_cache_size)
         model_dict = net.state_dict()
         new_state_dict = {k: v for k, v in new_state_dict.items() if k in model_dict.keys()}
         model_dict.update(new_state_dict)
@@ -63,12 +65,29 @@ def train(args):
     if torch.cuda.is_available():
         net = net.cuda()
 
-    train_data = TrainDataset(data_path=train_path, exp_path=exp_name, patch_w=args.patch_size_w, patch_h=args.patch_size_h, rho=16)
-    train_loader = DataLoader(dataset=train_data, batch_size=args.batch_size, num_workers=args.cpus, shuffle=True, drop_last=True)
+    if args.video_path is not None:
+        # pairs decoded straight from the videos, the dataset shuffles and shards them over workers
+        train_data = VideoPairDataset(video_path=args.video_path, patch_w=args.patch_size_w, patch_h=args.patch_size_h, rho=16, uint8_frames=args.uint8_frames)
+    elif args.synthetic > 0:
+        # generated pairs with the layout of TrainDataset, no dataset needed
+        train_data = SyntheticPairDataset(args.synthetic, patch_w=args.patch_size_w, patch_h=args.patch_size_h, rho=16, moving_object=args.synthetic_objects, uint8_frames=args.uint8_frames)
+    else:
+        train_data = TrainDataset(data_path=train_path, exp_path=exp_name, patch_w=args.patch_size_w, patch_h=args.patch_size_h, rho=16, uint8_frames=args.uint8_frames, frame_store=args.frame_store, pair_index=args.pair_index)
+    train_loader = DataLoader(dataset=train_data, batch_size=args.batch_size, num_workers=args.cpus, shuffle=args.video_path is None, drop_last=True)
 
     optimizer = optim.Adam(net.parameters(), lr=args.lr, amsgrad=True, weight_decay=1e-4)  # default as 0.0001
     scheduler = optim.lr_scheduler.ExponentialLR(optimizer, gamma=0.8)
 
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    if args.timing:
+        stage_timer.enable(device, cuda_events=args.timing_cuda_events, jsonl_path=os.path.join(LOG_DIR, 'timing.jsonl'))
+    prof = None
+    if args.profile:
+        prof = build_profiler(LOG_DIR, args.profile_wait, args.profile_warmup, args.profile_active,
+                              args.profile_repeat, args.profile_top)
+        stage_timer.enable_ranges()
+        prof.start()
+
     print("start training")
 
     score_print_fre = 200
@@ -77,12 +96,17 @@ def train(args):
 
     for epoch in range(args.max_epoch):
         net.train()
+        if hasattr(train_data, 'set_epoch'):
+            train_data.set_epoch(epoch)
         loss_sigma = 0.0
         loss_sigma_feature = 0.0
 
         scheduler.step()  # Note: The initial learning rate should be 1e-4. torch_version==1.0.1 ->init lr == 0.0001; torch_version>=1.2.0 ->init lr == 0.0001*1.25?
         print(epoch, 'lr={:.6f}'.format(scheduler.get_lr()[0]))
+        stage_timer.reset()
+        stage_timer.mark('data')
         for i, batch_value in enumerate(train_loader):
+            stage_timer.mark('checkpoint')
             # save model
             if (glob_iter % model_save_fre == 0 and glob_iter != 0 ):
                 filename = str(args.model_name)+'_iter_' + str(glob_iter) + '.pth'
@@ -94,33 +118,27 @@ def train(args):
 
                         writer.add_histogram(name + '_grad', layer.grad.cpu().data.numpy(), glob_iter)
                         writer.add_histogram(name + '_data', layer.cpu().data.numpy(), glob_iter)
-
-            org_imges = batch_value[0].float()
-            input_tesnors = batch_value[1].float()
-            patch_indices = batch_value[2].float()
+            stage_timer.mark('h2d')
+
+            org_imges = batch_value[0]
+            input_tesnors = batch_value[1]
+            if org_imges.dtype != torch.uint8:
+                # uint8 frames are normalised on the device by the model
+                org_imges = org_imges.float()
+                input_tesnors = input_tesnors.float()
+            patch_origin = batch_value[2]
             h4p = batch_value[3].float()
 
-            I = org_imges[:, 0, ...]
-            I = I[:, np.newaxis, ...]
-            I2_ori_img = org_imges[:, 1, ...]
-            I2_ori_img = I2_ori_img[:, np.newaxis, ...]
-            I1 = input_tesnors[:, 0, ...]
-            I1 = I1[:, np.newaxis, ...]
-            I2 = input_tesnors[:, 1, ...]
-            I2 = I2[:, np.newaxis, ...]
-
             if torch.cuda.is_available():
                 input_tesnors = input_tesnors.cuda()
-                patch_indices = patch_indices.cuda()
+                patch_origin = patch_origin.cuda()
                 h4p = h4p.cuda()
-                I = I.cuda()
-                I2_ori_img = I2_ori_img.cuda()
-                I2 = I2.cuda()
+            stage_timer.mark('forward')
 
             # forward, backward, update weights
             optimizer.zero_grad()
 
-            batch_out = net(org_imges, input_tesnors, h4p, patch_indices)
+            batch_out = net(org_imges, input_tesnors, h4p, patch_origin)
             loss_feature = batch_out['feature_loss'].mean()
             pred_I2 = batch_out['pred_I2_d']
             I2_dataMat_CnnFeature = batch_out['patch_2_res_d']
@@ -129,8 +147,11 @@ def train(args):
             loss_map = batch_out['feature_loss_mat_d']
 
             total_loss = loss_feature
+            stage_timer.mark('backward')
             total_loss.backward()
+            stage_timer.mark('optimizer')
             optimizer.step()
+            stage_timer.mark('logging')
 
             loss_sigma += total_loss.item()
             loss_sigma_feature += loss_feature.item()
@@ -150,11 +171,23 @@ def train(args):
 
             # using tensorbordX to check the input or output performance during training
             if glob_iter % 200 == 0:
+                I, I2_ori_img, I2 = get_display_inputs(org_imges, input_tesnors)
                 display_using_tensorboard(I, I2_ori_img, I2, pred_I2, I2_dataMat_CnnFeature, pred_I2_dataMat_CnnFeature,
                                           triMask, loss_map, writer)
             writer.add_scalars('Loss_group', {'feature_loss': loss_feature.item()}, glob_iter)
             writer.add_scalar('learning rate', scheduler.get_lr()[0], glob_iter)
 
+            stage_timer.end_step()
+            if glob_iter % args.timing_every == 0 and glob_iter != 0:
+                timing = stage_timer.flush(writer, glob_iter)
+                if timing is not None:
+                    print('Timing p50 ms: ' + ', '.join('{} {:.1f}'.format(name, s['p50_ms']) for name, s in timing.items()))
+            if prof is not None:
+                prof.step()
+            stage_timer.mark('data')
+
+    if prof is not None:
+        prof.stop()
     print('Finished Training')
 
 
@@ -168,6 +201,32 @@ if __name__=="__main__":
     parser.add_argument('--img_h', type=int, default=360)
     parser.add_argument('--patch_size_h', type=int, default=315)
     parser.add_argument('--patch_size_w', type=int, default=560)
+    parser.add_argument('--uint8_frames', action='store_true', help='Load raw uint8 frames, normalised on the device')
+    parser.add_argument('--sequential_branches', action='store_true',
+                        help='Run the shared-weight branches one call per input instead of batched')
+    parser.add_argument('--timing', action='store_true',
+                        help='Time the stages of every step, percentiles to tensorboard and timing.jsonl')
+    parser.add_argument('--timing_every', type=int, default=200, help='Steps between two timing flushes')
+    parser.add_argument('--timing_cuda_events', action='store_true',
+                        help='Time with CUDA events instead of synchronising the device at every stage')
+    parser.add_argument('--profile', action='store_true',
+                        help='torch.profiler over a window of steps, trace and operator table to the log dir')
+    parser.add_argument('--profile_wait', type=int, default=1, help='Steps skipped before the window')
+    parser.add_argument('--profile_warmup', type=int, default=1, help='Steps traced and dropped')
+    parser.add_argument('--profile_active', type=int, default=3, help='Steps recorded')
+    parser.add_argument('--profile_repeat', type=int, default=1, help='Number of windows, 0 until the end')
+    parser.add_argument('--profile_top', type=int, default=20, help='Rows of the operator tables')
+    parser.add_argument('--frozen_aux', action='store_true',
+                        help='Use the folded auxiliary resnet (eval-mode BatchNorm, targets without autograd history)')
+    parser.add_argument('--aux_cache_size', type=int, default=0,
+                        help='Target patches whose --frozen_aux features are kept for reuse, 0 disables')
+    parser.add_argument('--frame_store', type=str, default=None, help='Path of a Data/build_frame_store.py output, without extension')
+    parser.add_argument('--pair_index', type=str, default=None, help='Data/make_pair_index.py output used instead of Train_List.txt')
+    parser.add_argument('--video_path', type=str, default=None, help='Train on pairs decoded from the videos of this folder')
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help='Train on this many generated pairs per epoch instead of Train_List.txt')
+    parser.add_argument('--synthetic_objects', action='store_true',
+                        help='Add an independently moving object to the generated pairs')
 
     parser.add_argument('--batch_size', type=int, default=32)
     parser.add_argument('--max_epoch', type=int, default=30)
@@ -1,7 +1,8 @@
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset
 import  numpy as np
 import cv2, torch
 import os
+import json
 
 
 def make_mesh(patch_w,patch_h):
@@ -19,10 +20,141 @@ def make_mesh(patch_w,patch_h):
     return x_mesh,y_mesh
 
 
+class FrameStore(object):
+    """
+    Preprocessed frames written by Data/build_frame_store.py: <path>.npy holds one frame
+    per row, uint8 BGR or float16 normalised gray, and <path>.json maps frame names to
+    rows. The .npy is memory-mapped on first use in every worker process, so all
+    DataLoader workers and ranks share the same page cache instead of decoding jpgs.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path + '.json', 'r') as f:
+            index = json.load(f)
+        self.dtype = index['dtype']
+        self.HEIGHT = index['height']
+        self.WIDTH = index['width']
+        self.rows = {name: row for row, name in enumerate(index['names'])}
+        self.frames = None
+
+    def __getstate__(self):
+        # workers map the file themselves rather than receiving a pickled copy
+        state = self.__dict__.copy()
+        state['frames'] = None
+        return state
+
+    def read(self, name):
+        """
+        :return: read-only view of the frame, shape=(h, w, 3) uint8 or (h, w, 1) float16
+        """
+        if self.frames is None:
+            self.frames = np.load(self.path + '.npy', mmap_mode='r')
+        return self.frames[self.rows[name]]
+
+
+class PairIndex(object):
+    """
+    Pair index written by Data/make_pair_index.py: int32 frame-id pairs and a string table of
+    frame names (one utf-8 blob plus offsets). A handful of numpy arrays instead of a list of
+    Python strings, so worker memory does not grow through copy-on-write of refcounts.
+    """
+    def __init__(self, path):
+        with np.load(path) as index:
+            self.pairs = index['pairs']
+            self.names = index['names']
+            self.offsets = index['offsets']
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def name(self, frame_id):
+        return self.names[self.offsets[frame_id]:self.offsets[frame_id + 1]].tobytes().decode('utf-8')
+
+    def __getitem__(self, index):
+        frame_1, frame_2 = self.pairs[index]
+        return self.name(frame_1), self.name(frame_2)
+
+
+def open_frame_store(path, WIDTH, HEIGHT, uint8_frames=False, need_bgr=False):
+    if path is None:
+        return None
+    frame_store = FrameStore(path)
+    if frame_store.WIDTH != WIDTH or frame_store.HEIGHT != HEIGHT:
+        raise ValueError('frame store {} holds {}x{} frames, expected {}x{}'.format(
+            path, frame_store.WIDTH, frame_store.HEIGHT, WIDTH, HEIGHT))
+    if (uint8_frames or need_bgr) and frame_store.dtype != 'uint8':
+        raise ValueError('frame store {} holds normalised gray, build it with --dtype uint8'.format(path))
+    return frame_store
+
+
+def read_img(img_dir, name, frame_store=None):
+    if frame_store is not None:
+        return frame_store.read(name)
+    if name.endswith('.npy'):
+        # raw frames of Data/video2img.py --ext npy, BGR like cv2.imread also for --gray extractions
+        img = np.load(img_dir + name)
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR) if img.ndim == 2 else img
+    return cv2.imread(img_dir + name)
+
+
+def prepare_img(img, mean_I, std_I, keep_uint8=False):
+    """
+    :param img: BGR frame, shape=(h, w, 3); or normalised gray of a float16 frame store, shape=(h, w, 1)
+    :param keep_uint8: return the raw frame, normalised on the model's device by utils.normalize_gray
+    :return: normalised gray, float64 (float16 from a frame store), shape=(1, h, w); or uint8 BGR, shape=(3, h, w)
+    """
+    if img.dtype == np.uint8 and not keep_uint8:
+        img = (img - mean_I) / std_I
+        img = np.mean(img, axis=2, keepdims=True)
+    return np.transpose(img, [2, 0, 1])
+
+
+def crop_pair(org_img, patch_w, patch_h, rho, return_patch_indices=False, rng=np.random, origin=None):
+    """
+    Random training crop of a pair of prepared frames
+    :param org_img: both frames stacked on channels, shape=(c, h, w)
+    :param origin: (x, y) of the crop, drawn from rng when not given
+    :return: (org_img, input_tesnor, patch_origin, h4p) of TrainDataset
+    """
+    HEIGHT, WIDTH = org_img.shape[1:]
+    if origin is not None:
+        x, y = origin
+    else:
+        x = rng.randint(rho, WIDTH - rho - patch_w)
+        y = rng.randint(rho, HEIGHT - rho - patch_h)
+
+    input_tesnor = org_img[:, y: y + patch_h, x: x + patch_w]
+
+    patch_origin = np.array([x, y])
+    if return_patch_indices:
+        x_mesh, y_mesh = make_mesh(patch_w, patch_h)
+        y_t_flat = np.reshape(y_mesh, (-1))
+        x_t_flat = np.reshape(x_mesh, (-1))
+        patch_origin = (y_t_flat + y) * WIDTH + (x_t_flat + x)
+
+    top_left_point = (x, y)
+    bottom_left_point = (x, y + patch_h)
+    bottom_right_point = (patch_w + x, patch_h + y)
+    top_right_point = (x + patch_w, y)
+    h4p = [top_left_point, bottom_left_point, bottom_right_point, top_right_point]
+
+    h4p = np.reshape(h4p, (-1))
+
+    org_img = torch.tensor(org_img)
+    input_tesnor = torch.tensor(input_tesnor)
+    patch_origin = torch.tensor(patch_origin)
+    h4p = torch.tensor(h4p)
+
+    return (org_img, input_tesnor, patch_origin, h4p)
+
+
 class TrainDataset(Dataset):
-    def __init__(self, data_path, exp_path, patch_w=560, patch_h=315, rho=16):
+    def __init__(self, data_path, exp_path, patch_w=560, patch_h=315, rho=16, return_patch_indices=False,
+                 uint8_frames=False, frame_store=None, pair_index=None):
 
-        self.imgs = open(data_path, 'r').readlines()
+        # a Data/make_pair_index.py index replaces the pair list of data_path
+        self.pair_index = PairIndex(pair_index) if pair_index is not None else None
+        self.imgs = open(data_path, 'r').readlines() if pair_index is None else None
         self.mean_I = np.reshape(np.array([118.93, 113.97, 102.60]), (1, 1, 3))
         self.std_I = np.reshape(np.array([69.85, 68.81, 72.45]), (1, 1, 3))
 
@@ -31,65 +163,305 @@ class TrainDataset(Dataset):
         self.WIDTH = 640
         self.HEIGHT = 360
         self.rho = rho
-        self.x_mesh, self.y_mesh = make_mesh(self.patch_w, self.patch_h)
         self.train_path = os.path.join(exp_path, 'Data/Train/')
+        # return flat patch pixel indices instead of the (x, y) crop origin (old contract)
+        self.return_patch_indices = return_patch_indices
+        # return raw uint8 BGR frames (3 channels per image) instead of float64 gray
+        self.uint8_frames = uint8_frames
+        # path of a Data/build_frame_store.py output to read frames from instead of the jpgs
+        self.frame_store = open_frame_store(frame_store, self.WIDTH, self.HEIGHT, uint8_frames)
 
     def __getitem__(self, index):
 
-        value = self.imgs[index]
-        img_names = value.split(' ')
+        if self.pair_index is not None:
+            name_1, name_2 = self.pair_index[index]
+        else:
+            img_names = self.imgs[index].split(' ')
+            name_1, name_2 = img_names[0], img_names[1][:-1]
 
-        img_1 = cv2.imread(self.train_path + img_names[0])
+        img_1 = read_img(self.train_path, name_1, self.frame_store)
 
         height, width = img_1.shape[:2]
         if height != self.HEIGHT or width != self.WIDTH:
             img_1 = cv2.resize(img_1, (self.WIDTH, self.HEIGHT))
 
-        img_1 = (img_1 - self.mean_I) / self.std_I
-        img_1 = np.mean(img_1, axis=2, keepdims=True)
-        img_1 = np.transpose(img_1, [2, 0, 1])
+        img_1 = prepare_img(img_1, self.mean_I, self.std_I, self.uint8_frames)
 
-        img_2 = cv2.imread(self.train_path + img_names[1][:-1])
+        img_2 = read_img(self.train_path, name_2, self.frame_store)
         height, width = img_2.shape[:2]
         if height != self.HEIGHT or width != self.WIDTH:
             img_2 = cv2.resize(img_2, (self.WIDTH, self.HEIGHT))
 
-        img_2 = (img_2 - self.mean_I) / self.std_I
-        img_2 = np.mean(img_2, axis=2, keepdims=True)
-        img_2 = np.transpose(img_2, [2, 0, 1])
+        img_2 = prepare_img(img_2, self.mean_I, self.std_I, self.uint8_frames)
         org_img = np.concatenate([img_1, img_2], axis=0)
 
-        x = np.random.randint(self.rho, self.WIDTH - self.rho - self.patch_w)
-        y = np.random.randint(self.rho, self.HEIGHT - self.rho - self.patch_h)
+        return crop_pair(org_img, self.patch_w, self.patch_h, self.rho, self.return_patch_indices)
 
-        input_tesnor = org_img[:, y: y + self.patch_h, x: x + self.patch_w]
+    def __len__(self):
 
-        y_t_flat = np.reshape(self.y_mesh, (-1))
-        x_t_flat = np.reshape(self.x_mesh, (-1))
-        patch_indices = (y_t_flat + y) * self.WIDTH + (x_t_flat + x)
+        if self.pair_index is not None:
+            return len(self.pair_index)
+        return len(self.imgs)
 
-        top_left_point = (x, y)
-        bottom_left_point = (x, y + self.patch_h)
-        bottom_right_point = (self.patch_w + x, self.patch_h + y)
-        top_right_point = (x + self.patch_w, y)
-        h4p = [top_left_point, bottom_left_point, bottom_right_point, top_right_point]
 
-        h4p = np.reshape(h4p, (-1))
+def build_video_index(video_path, index_name='video_index.json'):
+    """
+    Frame count of every video in a folder. Counted once and cached in
+    <video_path>/<index_name>; a video is counted again when its size or mtime changes
+    :return: list of (video name, frame count), sorted by name
+    """
+    index_file = os.path.join(video_path, index_name)
+    index = {}
+    if os.path.exists(index_file):
+        with open(index_file, 'r') as f:
+            index = json.load(f)
+
+    videos, changed = [], False
+    for name in sorted(os.listdir(video_path)):
+        path = os.path.join(video_path, name)
+        if name == index_name or not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        entry = index.get(name)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            vc = cv2.VideoCapture(path)
+            # container estimate, the iteration itself always reads to the end of the video
+            frames = int(vc.get(cv2.CAP_PROP_FRAME_COUNT)) if vc.isOpened() else 0
+            vc.release()
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'frames': frames}
+            index[name] = entry
+            changed = True
+        if entry['frames'] > 1:
+            videos.append((name, entry['frames']))
+
+    if changed:
+        with open(index_file + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(index_file + '.tmp', index_file)
+    return videos
+
+
+class VideoPairDataset(IterableDataset):
+    """
+    Training pairs sampled straight from the videos of a folder, without the jpg
+    extraction of Data/video2img.py. Videos are shuffled per epoch and split over
+    ranks and DataLoader workers. Every worker keeps videos_in_flight videos open and
+    reads them sequentially in runs of run_length frames; each frame of a run is
+    paired with a frame 1..max_gap frames later in the same run and the pairs of all
+    open videos are shuffled together. Every frame is decoded once per epoch.
+    Under torch.distributed every rank yields the same number of pairs, the smallest
+    rank share estimated from the frame counts, so no rank is left waiting for the
+    others at the end of the epoch. Samples have the layout of TrainDataset.
+    """
+    def __init__(self, video_path, patch_w=560, patch_h=315, rho=16, max_gap=8, run_length=32,
+                 videos_in_flight=4, seed=0, return_patch_indices=False, uint8_frames=False):
+
+        self.video_path = video_path
+        self.mean_I = np.reshape(np.array([118.93, 113.97, 102.60]), (1, 1, 3))
+        self.std_I = np.reshape(np.array([69.85, 68.81, 72.45]), (1, 1, 3))
 
-        org_img = torch.tensor(org_img)
-        input_tesnor = torch.tensor(input_tesnor)
-        patch_indices = torch.tensor(patch_indices)
-        h4p = torch.tensor(h4p)
+        self.patch_h = patch_h
+        self.patch_w = patch_w
+        self.WIDTH = 640
+        self.HEIGHT = 360
+        self.rho = rho
+        self.max_gap = max_gap
+        self.run_length = run_length
+        self.videos_in_flight = videos_in_flight
+        self.seed = seed
+        self.epoch = 0
+        self.return_patch_indices = return_patch_indices
+        self.uint8_frames = uint8_frames
+        self.videos = build_video_index(video_path)
+        # resolved here, the DataLoader worker processes are not part of the process group
+        self.num_ranks, self.rank = 1, 0
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            self.num_ranks, self.rank = torch.distributed.get_world_size(), torch.distributed.get_rank()
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def get_order(self):
+        # same video order on every rank and worker
+        return np.random.RandomState([self.seed, self.epoch]).permutation(len(self.videos))
+
+    def pair_count(self, videos):
+        # pairs of an epoch from the container frame counts: every frame but the last of a run
+        return sum(frames - (frames + self.run_length - 1) // self.run_length for _, frames in videos)
+
+    def rank_pairs(self, order, num_ranks):
+        """
+        :return: pairs every rank yields in a distributed epoch, the smallest estimated rank share
+        """
+        return min(self.pair_count([self.videos[i] for i in order[rank::num_ranks]]) for rank in range(num_ranks))
+
+    def read_run(self, vc):
+        run = []
+        while len(run) < self.run_length:
+            rval, frame = vc.read()
+            if not rval:
+                break
+            if frame.shape[0] != self.HEIGHT or frame.shape[1] != self.WIDTH:
+                frame = cv2.resize(frame, (self.WIDTH, self.HEIGHT))
+            run.append(frame)
+        return run
+
+    def __iter__(self):
+        num_ranks, rank = self.num_ranks, self.rank
+        worker_info = torch.utils.data.get_worker_info()
+        num_workers, worker = (1, 0) if worker_info is None else (worker_info.num_workers, worker_info.id)
+        # videos split over ranks, then over the DataLoader workers of the rank; different crops and gaps per shard
+        order = self.get_order()
+        rank_videos = [self.videos[i][0] for i in order[rank::num_ranks]]
+        videos = rank_videos[worker::num_workers]
+        rng = np.random.RandomState([self.seed, self.epoch, rank * num_workers + worker])
+
+        quota = None
+        if num_ranks > 1:
+            # the same share for the same worker of every rank, as the DataLoader batches every worker apart
+            pairs = self.rank_pairs(order, num_ranks)
+            quota = pairs // num_workers + (worker < pairs % num_workers)
+
+        pending, captures, count, padded_at = list(videos), [], 0, None
+        try:
+            while (pending or captures) if quota is None else count < quota:
+                if not pending and not captures:
+                    # short of the quota: pad with the worker's videos again, or the rank's if it has none
+                    if padded_at == count:
+                        raise RuntimeError('VideoPairDataset: no pairs could be read from {}'.format(rank_videos))
+                    pending, padded_at = list(videos or rank_videos), count
+                while pending and len(captures) < self.videos_in_flight:
+                    captures.append(cv2.VideoCapture(os.path.join(self.video_path, pending.pop(0))))
+
+                pairs = []
+                for vc in list(captures):
+                    run = self.read_run(vc)
+                    if len(run) < self.run_length:
+                        vc.release()
+                        captures.remove(vc)
+                    for t in range(len(run) - 1):
+                        gap = rng.randint(1, min(self.max_gap, len(run) - 1 - t) + 1)
+                        pairs.append((run[t], run[t + gap]))
+
+                for i in rng.permutation(len(pairs)):
+                    if count == quota:
+                        break
+                    count += 1
+                    # runs hold the decoded uint8 frames, a float64 frame would take 8 times the memory
+                    org_img = np.concatenate([prepare_img(img, self.mean_I, self.std_I, self.uint8_frames)
+                                              for img in pairs[i]], axis=0)
+                    yield crop_pair(org_img, self.patch_w, self.patch_h, self.rho, self.return_patch_indices, rng)
+        finally:
+            for vc in captures:
+                vc.release()
+
+    def __len__(self):
+        if self.num_ranks > 1:
+            return self.rank_pairs(self.get_order(), self.num_ranks)
+        # approximate outside torch.distributed: the container frame counts are estimates
+        return self.pair_count(self.videos)
+
+
+def random_texture(rng, height, width, cell_sizes=(64, 16, 4)):
+    """
+    BGR texture of smooth noise at several scales, the coarse ones weighted the most. The
+    scales are summed coarse to fine on their own grids, only the finest is resized to the frame
+    :return: uint8, shape=(height, width, 3)
+    """
+    texture = None
+    for cell in cell_sizes:
+        grid = (width // cell + 2, height // cell + 2)
+        noise = rng.uniform(-np.sqrt(cell), np.sqrt(cell), (grid[1], grid[0], 3)).astype(np.float32)
+        if texture is not None:
+            noise += cv2.resize(texture, grid, interpolation=cv2.INTER_CUBIC)
+        texture = noise
+    texture = cv2.resize(texture, (width, height), interpolation=cv2.INTER_CUBIC)
+    # contrast from a subsample, scaled and saturated to uint8 in one pass
+    sample = texture[::8, ::8]
+    scale = 60 / (sample.std() + 1e-6)
+    return cv2.addWeighted(texture, scale, texture, 0, 128 - scale * sample.mean(), dtype=cv2.CV_8U)
+
+
+class SyntheticPairDataset(Dataset):
+    """
+    Generated training pairs with the layout of TrainDataset, no dataset needed. Frame 1
+    is a random texture and frame 2 its warp by a random homography moving the four
+    patch corners by at most rho, optionally with an object moving on its own on top of
+    both frames. Every sample is drawn from RandomState([seed, epoch, index]), so a run
+    is reproducible and the DataLoader workers need no coordination. With
+    return_homography, the ground-truth H is appended to the sample; like the model's
+    H_mat, it maps frame 2 pixels to frame 1
+    """
+    def __init__(self, length=10000, patch_w=560, patch_h=315, rho=16, seed=0, moving_object=False,
+                 return_patch_indices=False, uint8_frames=False, return_homography=False):
+
+        self.length = length
+        self.mean_I = np.reshape(np.array([118.93, 113.97, 102.60]), (1, 1, 3))
+        self.std_I = np.reshape(np.array([69.85, 68.81, 72.45]), (1, 1, 3))
+
+        self.patch_h = patch_h
+        self.patch_w = patch_w
+        self.WIDTH = 640
+        self.HEIGHT = 360
+        self.rho = rho
+        self.seed = seed
+        self.epoch = 0
+        self.moving_object = moving_object
+        self.return_patch_indices = return_patch_indices
+        self.uint8_frames = uint8_frames
+        self.return_homography = return_homography
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def add_object(self, rng, img_1, img_2):
+        # a textured ellipse, displaced between the frames independently of the homography
+        size = rng.randint(self.HEIGHT // 8, self.HEIGHT // 3)
+        texture = random_texture(rng, size, size, cell_sizes=(8, 2))
+        yy, xx = np.ogrid[:size, :size]
+        a, b = rng.uniform(0.3, 0.5, 2) * size
+        mask = ((xx - size / 2.0) / a) ** 2 + ((yy - size / 2.0) / b) ** 2 <= 1
+        x = rng.randint(0, self.WIDTH - size)
+        y = rng.randint(0, self.HEIGHT - size)
+        for img in [img_1, img_2]:
+            img[y:y + size, x:x + size][mask] = texture[mask]
+            x = int(np.clip(x + rng.randint(-2 * self.rho, 2 * self.rho + 1), 0, self.WIDTH - size))
+            y = int(np.clip(y + rng.randint(-2 * self.rho, 2 * self.rho + 1), 0, self.HEIGHT - size))
 
-        return (org_img, input_tesnor, patch_indices, h4p)
+    def __getitem__(self, index):
+
+        rng = np.random.RandomState([self.seed, self.epoch, index])
+        x = rng.randint(self.rho, self.WIDTH - self.rho - self.patch_w)
+        y = rng.randint(self.rho, self.HEIGHT - self.rho - self.patch_h)
+        corners = np.float32([[x, y], [x, y + self.patch_h], [x + self.patch_w, y + self.patch_h],
+                              [x + self.patch_w, y]])
+        offsets = rng.uniform(-self.rho, self.rho, corners.shape).astype(np.float32)
+        # H maps the patch corners of frame 2 to the moved corners of frame 1, as DLT_solve(h4p, offsets)
+        H = cv2.getPerspectiveTransform(corners, corners + offsets)
+
+        img_1 = random_texture(rng, self.HEIGHT, self.WIDTH)
+        img_2 = cv2.warpPerspective(img_1, H, (self.WIDTH, self.HEIGHT), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                                    borderMode=cv2.BORDER_REFLECT)
+        if self.moving_object:
+            self.add_object(rng, img_1, img_2)
+
+        img_1 = prepare_img(img_1, self.mean_I, self.std_I, self.uint8_frames)
+        img_2 = prepare_img(img_2, self.mean_I, self.std_I, self.uint8_frames)
+        org_img = np.concatenate([img_1, img_2], axis=0)
+
+        sample = crop_pair(org_img, self.patch_w, self.patch_h, self.rho, self.return_patch_indices, origin=(x, y))
+        if self.return_homography:
+            sample = sample + (torch.tensor(H, dtype=torch.float32),)
+        return sample
 
     def __len__(self):
 
-        return len(self.imgs)
+        return self.length
 
 
 class TestDataset(Dataset):
-    def __init__(self, data_path, patch_w=560, patch_h=315, rho=16, WIDTH=640, HEIGHT=360):
+    def __init__(self, data_path, patch_w=560, patch_h=315, rho=16, WIDTH=640, HEIGHT=360,
+                 return_patch_indices=False, uint8_frames=False, frame_store=None):
         self.mean_I = np.reshape(np.array([118.93, 113.97, 102.60]), (1, 1, 3))
         self.std_I = np.reshape(np.array([69.85, 68.81, 72.45]), (1, 1, 3))
 
@@ -99,6 +471,10 @@ class TestDataset(Dataset):
         self.HEIGHT = HEIGHT
         self.rho = rho
         self.x_mesh, self.y_mesh = make_mesh(self.patch_w,self.patch_h)
+        self.return_patch_indices = return_patch_indices
+        self.uint8_frames = uint8_frames
+        # the test script draws the BGR frames, so only uint8 frame stores can be used
+        self.frame_store = open_frame_store(frame_store, self.WIDTH, self.HEIGHT, need_bgr=True)
 
         self.work_dir = os.path.join(data_path, 'Data')
         self.pair_list = list(open(os.path.join(self.work_dir, 'Test_List.txt')))
@@ -116,15 +492,15 @@ class TestDataset(Dataset):
 
         # load img1
         if pari_id[0][-1] == 'M':
-            img_1 = cv2.imread(self.img_path + pari_id[0][:-2])
+            img_1 = read_img(self.img_path, pari_id[0][:-2], self.frame_store)
         else:
-            img_1 = cv2.imread(self.img_path + pari_id[0])
+            img_1 = read_img(self.img_path, pari_id[0], self.frame_store)
 
         # load img2
         if pari_id[1][-2] == 'M':
-            img_2 = cv2.imread(self.img_path + pari_id[1][:-3])
+            img_2 = read_img(self.img_path, pari_id[1][:-3], self.frame_store)
         else:
-            img_2 = cv2.imread(self.img_path + pari_id[1][:-1])
+            img_2 = read_img(self.img_path, pari_id[1][:-1], self.frame_store)
         
         height, width = img_1.shape[:2]
  
@@ -134,9 +510,7 @@ class TestDataset(Dataset):
         print_img_1 = img_1.copy()
         print_img_1 = np.transpose(print_img_1, [2, 0, 1])
 
-        img_1 = (img_1 - self.mean_I) / self.std_I
-        img_1 = np.mean(img_1, axis=2, keepdims=True)
-        img_1 = np.transpose(img_1, [2, 0, 1])
+        img_1 = prepare_img(img_1, self.mean_I, self.std_I, self.uint8_frames)
 
         height, width = img_2.shape[:2]
 
@@ -145,9 +519,7 @@ class TestDataset(Dataset):
 
         print_img_2 = img_2.copy()
         print_img_2 = np.transpose(print_img_2, [2, 0, 1])
-        img_2 = (img_2 - self.mean_I) / self.std_I
-        img_2 = np.mean(img_2, axis=2, keepdims=True)
-        img_2 = np.transpose(img_2, [2, 0, 1])
+        img_2 = prepare_img(img_2, self.mean_I, self.std_I, self.uint8_frames)
         org_img = np.concatenate([img_1, img_2], axis=0)
         WIDTH = org_img.shape[2]
         HEIGHT = org_img.shape[1]
@@ -158,9 +530,11 @@ class TestDataset(Dataset):
         y = 23  # patch should in the middle of full img when testing
         input_tesnor = org_img[:, y: y + self.patch_h, x: x + self.patch_w]
 
-        y_t_flat = np.reshape(self.y_mesh, [-1])
-        x_t_flat = np.reshape(self.x_mesh, [-1])
-        patch_indices = (y_t_flat + y) * WIDTH + (x_t_flat + x)
+        patch_origin = np.array([x, y])
+        if self.return_patch_indices:
+            y_t_flat = np.reshape(self.y_mesh, [-1])
+            x_t_flat = np.reshape(self.x_mesh, [-1])
+            patch_origin = (y_t_flat + y) * WIDTH + (x_t_flat + x)
 
         top_left_point = (x, y)
         bottom_left_point = (x, y + self.patch_h)
@@ -170,7 +544,7 @@ class TestDataset(Dataset):
 
         four_points = np.reshape(four_points, (-1))
 
-        return (org_img, input_tesnor, patch_indices, four_points,print_img_1, print_img_2, video_name, npy_id)
+        return (org_img, input_tesnor, patch_origin, four_points,print_img_1, print_img_2, video_name, npy_id)
 
     def __len__(self):
 
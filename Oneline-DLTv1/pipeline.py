@@ -0,0 +1,238 @@
+# coding: utf-8
+import argparse
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from streaming import load_model
+from utils import get_patch_corners, normalize_gray, inference_mode
+
+
+# end of stream marker passed down the queues
+END = None
+
+
+class StageStats(object):
+    """
+    Busy time of one pipeline stage: the time spent on its own work, not waiting on its queues
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.busy = 0.0
+        self.items = 0
+
+    def utilisation(self, seconds):
+        return self.busy / max(seconds, 1e-9)
+
+
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return END
+
+
+class PairEstimator(object):
+    """
+    Homographies of the consecutive frames of a stream, a batch of frames at a time: every
+    frame is encoded once (ResNet.encode_frames) and the features of the last frame of a
+    batch are carried over to pair with the first frame of the next one
+    """
+
+    def __init__(self, net, patch_size_h=315, patch_size_w=560, patch_origin=None):
+        self.net = net
+        self.device = next(net.parameters()).device
+        self.patch_size_h, self.patch_size_w = patch_size_h, patch_size_w
+        self.patch_origin = patch_origin
+        self.last = None
+
+    def __call__(self, frames):
+        """
+        :param frames: list of uint8 BGR frames, shape=(h, w, 3)
+        :return: H of every pair ending at one of the frames, frame t -> t + 1, shape=(n, 3, 3)
+        """
+        x = torch.from_numpy(np.stack(frames)).permute(0, 3, 1, 2).to(self.device)
+        if self.patch_origin is None:
+            _, _, img_h, img_w = x.size()
+            self.patch_origin = ((img_w - self.patch_size_w + 1) // 2, (img_h - self.patch_size_h + 1) // 2)
+
+        with inference_mode():
+            features = self.net.encode_frames(normalize_gray(x), self.patch_origin, self.patch_size_h,
+                                              self.patch_size_w)
+            if self.last is not None:
+                features = torch.cat((self.last, features), dim=0)
+            self.last = features[-1:]
+            num_pairs = features.size()[0] - 1
+            if num_pairs == 0:
+                return np.zeros((0, 3, 3), dtype=np.float32)
+            h4p = get_patch_corners(num_pairs, self.patch_origin, self.patch_size_h, self.patch_size_w, self.device)
+            H_mat = self.net.predict_homography(features[:-1], features[1:], h4p)
+        return H_mat.cpu().numpy()
+
+
+def decode_stage(video, size, batch_size, max_frames, out_q, stop, stats):
+    vc = cv2.VideoCapture(video)
+    if not vc.isOpened():
+        raise IOError('can not open {}'.format(video))
+    batch = []
+    try:
+        while not stop.is_set():
+            start = time.perf_counter()
+            rval, frame = vc.read()
+            if not rval or 0 < max_frames <= stats.items:
+                break
+            if (frame.shape[1], frame.shape[0]) != size:
+                frame = cv2.resize(frame, size)
+            batch.append(frame)
+            stats.items += 1
+            stats.busy += time.perf_counter() - start
+            if len(batch) == batch_size:
+                _put(out_q, batch, stop)
+                batch = []
+        if batch:
+            _put(out_q, batch, stop)
+    finally:
+        vc.release()
+
+
+def estimate_stage(estimator, in_q, out_q, stop, stats):
+    while True:
+        frames = _get(in_q, stop)
+        if frames is END:
+            break
+        start = time.perf_counter()
+        H_mats = estimator(frames)
+        stats.items += len(frames)
+        stats.busy += time.perf_counter() - start
+        _put(out_q, (frames, H_mats), stop)
+
+
+def write_stage(out_video, size, fps, in_q, stop, stats, results):
+    """
+    Accumulates H_mats (frame t -> t + 1) and to_first (frame t -> frame 0), and writes every
+    frame warped to the first one when out_video is given
+    """
+    writer = None
+    if out_video is not None:
+        writer = cv2.VideoWriter(out_video, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+    to_first = np.eye(3)
+    try:
+        while True:
+            item = _get(in_q, stop)
+            if item is END:
+                break
+            start = time.perf_counter()
+            frames, H_mats = item
+            # the first frame of the stream has no pair
+            pair_of_frame = [None] * (len(frames) - len(H_mats)) + list(H_mats)
+            for frame, H_mat in zip(frames, pair_of_frame):
+                if H_mat is not None:
+                    results['H_mats'].append(H_mat)
+                    # H_mat maps frame t + 1 pixels to frame t, as transform() samples with it
+                    to_first = np.matmul(to_first, H_mat.astype(np.float64))
+                    to_first = to_first / to_first[2, 2]
+                results['to_first'].append(to_first.astype(np.float32))
+                if writer is not None:
+                    writer.write(cv2.warpPerspective(frame, to_first, size))
+            stats.items += len(frames)
+            stats.busy += time.perf_counter() - start
+    finally:
+        if writer is not None:
+            writer.release()
+
+
+def _run(target, args, stop, errors, out_q=None):
+    try:
+        target(*args)
+    except Exception as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        if out_q is not None:
+            _put(out_q, END, stop)
+
+
+def run_pipeline(args):
+    device = torch.device('cpu') if args.cpu or not torch.cuda.is_available() else torch.device('cuda')
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    net = load_model(args.model_name, args.model_path, device)
+    estimator = PairEstimator(net, args.patch_size_h, args.patch_size_w)
+
+    vc = cv2.VideoCapture(args.video)
+    fps = vc.get(cv2.CAP_PROP_FPS) or 30.0
+    vc.release()
+    size = (args.img_w, args.img_h)
+
+    frames_q = queue.Queue(maxsize=args.queue_size)
+    results_q = queue.Queue(maxsize=args.queue_size)
+    stop, errors = threading.Event(), []
+    stats = [StageStats('decode'), StageStats('estimate'), StageStats('write')]
+    results = {'H_mats': [], 'to_first': []}
+    threads = [
+        threading.Thread(target=_run, args=(decode_stage, (args.video, size, args.batch_size, args.max_frames,
+                                                           frames_q, stop, stats[0]), stop, errors, frames_q)),
+        threading.Thread(target=_run, args=(estimate_stage, (estimator, frames_q, results_q, stop, stats[1]),
+                                            stop, errors, results_q)),
+        threading.Thread(target=_run, args=(write_stage, (args.out_video, size, fps, results_q, stop, stats[2],
+                                                          results), stop, errors)),
+    ]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    if errors:
+        raise errors[0]
+
+    if args.out is not None:
+        np.savez(args.out, H_mats=np.array(results['H_mats'], dtype=np.float32).reshape(-1, 3, 3),
+                 to_first=np.array(results['to_first'], dtype=np.float32).reshape(-1, 3, 3))
+    num_frames = stats[2].items
+    print('{} frames in {:.2f}s, {:.2f} fps on {}'.format(num_frames, seconds, num_frames / max(seconds, 1e-9), device))
+    for s in stats:
+        print('{:<8s} utilisation {:5.1f}%, {:.1f} ms per frame'.format(
+            s.name, 100.0 * s.utilisation(seconds), 1000.0 * s.busy / max(s.items, 1)))
+    return results
+
+
+if __name__=="__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--video', type=str, required=True)
+    parser.add_argument('--model_name', type=str, default='resnet34')
+    parser.add_argument('--model_path', type=str, default=None, help='checkpoint, random weights if not given')
+    parser.add_argument('--out', type=str, default=None,
+                        help='.npz of H_mats (frame t -> t + 1) and to_first (frame t -> frame 0)')
+    parser.add_argument('--out_video', type=str, default=None, help='write the frames warped to the first one')
+    parser.add_argument('--batch_size', type=int, default=8, help='frames per estimation batch')
+    parser.add_argument('--queue_size', type=int, default=4, help='batches buffered between two stages')
+    parser.add_argument('--max_frames', type=int, default=0)
+    parser.add_argument('--cpu', action='store_true', help='run on CPU even if CUDA is available')
+    parser.add_argument('--threads', type=int, default=0, help='torch CPU threads, 0 keeps the default')
+    parser.add_argument('--img_w', type=int, default=640)
+    parser.add_argument('--img_h', type=int, default=360)
+    parser.add_argument('--patch_size_h', type=int, default=315)
+    parser.add_argument('--patch_size_w', type=int, default=560)
+
+    args = parser.parse_args()
+    run_pipeline(args)
@@ -0,0 +1,69 @@
+# coding: utf-8
+"""
+CPU benchmark of the auxiliary-resnet features of one training step of the AFM
+and biHomE variants: the AuxiliaryResnet on the two target patches and pred_I2
+against FrozenAuxiliaryResnet (folded weights, targets without autograd history,
+optional target cache), forward+backward time, bytes saved for backward, and the
+difference of the features with the AuxiliaryResnet in eval mode. Builds a
+pretrained torchvision resnet34, whose weights must be downloadable or cached.
+"""
+import argparse
+
+import torch
+
+from common import use_variant, time_it, report, saved_bytes
+
+
+def run(args):
+    use_variant(args.variant)
+    from resnet import AuxiliaryResnet, FrozenAuxiliaryResnet
+    from utils import siamese_forward
+
+    torch.manual_seed(0)
+    torch.set_num_threads(args.threads)
+    aux = AuxiliaryResnet()
+    frozen = FrozenAuxiliaryResnet(aux, cache_size=args.cache_size)
+
+    patch_1 = torch.randn(args.batch_size, 1, args.patch_size_h, args.patch_size_w)
+    patch_2 = torch.randn(args.batch_size, 1, args.patch_size_h, args.patch_size_w)
+    pred_I2 = torch.randn(args.batch_size, 1, args.patch_size_h, args.patch_size_w, requires_grad=True)
+
+    def aux_step():
+        features = siamese_forward(aux, [patch_1, patch_2, pred_I2])
+        return sum(feature.sum() for feature in features)
+
+    def frozen_step():
+        features = frozen.target_features([patch_1, patch_2]) + [frozen(pred_I2)]
+        return sum(feature.sum() for feature in features)
+
+    aux.eval()
+    with torch.no_grad():
+        err = ((aux(pred_I2) - frozen(pred_I2)).abs().max() / aux(pred_I2).abs().max()).item()
+    print('relative |diff| to eval-mode AuxiliaryResnet {:.1e}'.format(err))
+
+    aux.train()
+    for name, fn in [('AuxiliaryResnet (train)', aux_step),
+                     ('FrozenAuxiliaryResnet cache {}'.format(args.cache_size), frozen_step)]:
+        def step():
+            pred_I2.grad = None
+            fn().backward()
+        seconds, _ = time_it(step, repeat=args.repeat)
+        report('{} bs {}'.format(name, args.batch_size), seconds, saved_bytes(fn, [patch_1, patch_2, pred_I2]))
+    if args.cache_size > 0:
+        print('target cache hits {} misses {}'.format(frozen.hits, frozen.misses))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--variant', type=str, default='Doubleline-Zhang-biHomE',
+                        choices=['Oneline-DLTv1-with-AFM', 'Doubleline-Zhang-biHomE'])
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--patch_size_h', type=int, default=315)
+    parser.add_argument('--patch_size_w', type=int, default=560)
+    parser.add_argument('--cache_size', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=1)
+
+    args = parser.parse_args()
+    run(args)
@@ -0,0 +1,76 @@
+# coding: utf-8
+"""
+CPU benchmark of ResNet.predict_bidirectional of the Doubleline variants: both
+pair orders through one backbone pass and one DLT_solve against the two
+predict_homography calls it replaces, forward and backward in training mode,
+with a check that the homographies, losses, parameter gradients and BatchNorm
+running statistics of the two paths agree. The biHomE variant builds a
+pretrained torchvision resnet34, whose weights must be downloadable or cached.
+"""
+import argparse
+import copy
+
+import torch
+
+from common import use_variant, time_it, report
+
+
+def run(args):
+    use_variant(args.variant)
+    from torch_homography_model import build_model
+    from utils import get_patch_corners
+
+    torch.manual_seed(0)
+    torch.set_num_threads(args.threads)
+    net = build_model(args.model_name)
+    net.train()
+    sequential = copy.deepcopy(net)
+    sequential.siamese = False
+
+    patch_1 = torch.randn(args.batch_size, 1, args.patch_size_h, args.patch_size_w)
+    patch_2 = torch.randn(args.batch_size, 1, args.patch_size_h, args.patch_size_w)
+    h4p = get_patch_corners(args.batch_size, (40, 23), args.patch_size_h, args.patch_size_w, patch_1.device)
+    # weight the directions differently so a swapped split would show
+    weight_12, weight_21 = torch.randn(3, 3), torch.randn(3, 3)
+
+    def step(model, batched):
+        model.zero_grad()
+        if batched:
+            H_mat_12, H_mat_21 = model.predict_bidirectional(patch_1, patch_2, h4p)
+        else:
+            H_mat_12 = model.predict_homography(patch_1, patch_2, h4p)
+            H_mat_21 = model.predict_homography(patch_2, patch_1, h4p)
+        loss = (H_mat_12 * weight_12).sum() + (H_mat_21 * weight_21).sum()
+        loss.backward()
+        return H_mat_12, H_mat_21, loss
+
+    for _ in range(args.steps):
+        H_seq, H_bat = step(sequential, False), step(net, True)
+    H_err = max(((a - b).abs().max() / a.abs().max()).item() for a, b in zip(H_seq[:2], H_bat[:2]))
+    loss_err = abs(H_seq[2].item() - H_bat[2].item()) / abs(H_seq[2].item())
+    grad_err = max(((a.grad - b.grad).abs().max() / a.grad.abs().max().clamp(min=1e-12)).item()
+                   for a, b in zip(sequential.parameters(), net.parameters()) if a.grad is not None)
+    stats_err = max((a.double() - b.double()).abs().max().item() for a, b in zip(sequential.buffers(), net.buffers()))
+    print('relative |diff| H {:.1e} loss {:.1e} grad {:.1e}, running stats {:.1e} after {} steps'.format(
+        H_err, loss_err, grad_err, stats_err, args.steps))
+
+    for name, model, batched in [('predict_homography x2', sequential, False), ('predict_bidirectional', net, True)]:
+        seconds, _ = time_it(lambda: step(model, batched), repeat=args.repeat)
+        report('{} bs {}'.format(name, args.batch_size), seconds)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--variant', type=str, default='Doubleline-DLTv1',
+                        choices=['Doubleline-DLTv1', 'Doubleline-Zhang-biHomE'])
+    parser.add_argument('--model_name', type=str, default='resnet34')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--patch_size_h', type=int, default=315)
+    parser.add_argument('--patch_size_w', type=int, default=560)
+    parser.add_argument('--steps', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=1)
+
+    args = parser.parse_args()
+    run(args)
@@ -0,0 +1,54 @@
+# coding: utf-8
+"""
+CPU benchmark of the vectorised DLT_solve against the per-cell DLT_solve_loop
+for single homographies and dense meshes.
+"""
+import argparse
+
+import numpy as np
+import torch
+
+from common import use_variant, time_it, report
+
+
+def mesh_points(batch_size, divide, img_w=640, img_h=360, rho=16):
+    """
+    :return: mesh points and random offsets, shape=(bs, 2*(divide+1)**2) each
+    """
+    ys, xs = np.meshgrid(np.linspace(0, img_h, divide + 1), np.linspace(0, img_w, divide + 1), indexing='ij')
+    src_p = torch.tensor(np.stack([xs, ys], -1).reshape(1, -1), dtype=torch.float32).repeat(batch_size, 1)
+    off_set = (torch.rand_like(src_p) * 2 - 1) * rho / max(divide, 1)
+    return src_p, off_set
+
+
+def run(args):
+    use_variant(args.variant)
+    from utils import DLT_solve, DLT_solve_loop
+
+    torch.manual_seed(0)
+    torch.set_num_threads(args.threads)
+    for divide in args.divides:
+        for batch_size in args.batch_sizes:
+            src_p, off_set = mesh_points(batch_size, divide)
+            H_loop = DLT_solve_loop(src_p, off_set)
+            H = DLT_solve(src_p, off_set)
+            err = ((H - H_loop).abs().max() / H_loop.abs().max()).item()
+
+            name = 'mesh {}x{} bs {}'.format(divide, divide, batch_size)
+            loop_time, _ = time_it(lambda: DLT_solve_loop(src_p, off_set), repeat=args.repeat)
+            report(name + ' loop', loop_time)
+            solve_time, _ = time_it(lambda: DLT_solve(src_p, off_set), repeat=args.repeat)
+            report(name + ' batched (rel err {:.1e})'.format(err), solve_time)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--variant', type=str, default='Oneline-DLTv1')
+    parser.add_argument('--divides', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 32])
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=1)
+
+    args = parser.parse_args()
+    run(args)
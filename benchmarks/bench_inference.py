@@ -0,0 +1,60 @@
+# coding: utf-8
+"""
+CPU benchmark of ResNet.estimate_homography against a no_grad forward() that
+only keeps H, on uint8 frames, with the difference of the two homographies.
+The AFM and biHomE variants build a pretrained torchvision resnet34, whose
+weights must be downloadable or cached.
+"""
+import argparse
+
+import torch
+
+from common import use_variant, time_it, report
+
+
+def run(args):
+    use_variant(args.variant)
+    from torch_homography_model import build_model
+    from utils import get_patch_corners
+
+    torch.manual_seed(0)
+    torch.set_num_threads(args.threads)
+    net = build_model(args.model_name)
+    net.eval()
+
+    frames = torch.randint(0, 256, (args.batch_size, 6, args.img_h, args.img_w), dtype=torch.uint8)
+    x, y = (args.img_w - args.patch_size_w + 1) // 2, (args.img_h - args.patch_size_h + 1) // 2
+    patches = frames[:, :, y:y + args.patch_size_h, x:x + args.patch_size_w].contiguous()
+    h4p = get_patch_corners(args.batch_size, (x, y), args.patch_size_h, args.patch_size_w, frames.device)
+    patch_origin = torch.tensor([[x, y]]).repeat(args.batch_size, 1)
+
+    def forward():
+        with torch.no_grad():
+            out = net(frames, patches, h4p, patch_origin)
+        return out['H_mat'] if 'H_mat' in out else out['H_mat_12']
+
+    def estimate():
+        return net.estimate_homography(frames[:, :3], frames[:, 3:], args.patch_size_h, args.patch_size_w)
+
+    H_forward, H = forward(), estimate()
+    err = ((H - H_forward).abs().max() / H_forward.abs().max()).item()
+    for name, fn in [('forward', forward), ('estimate_homography (rel err {:.1e})'.format(err), estimate)]:
+        seconds, _ = time_it(fn, repeat=args.repeat)
+        report('{} bs {}'.format(name, args.batch_size), seconds)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--variant', type=str, default='Oneline-DLTv1')
+    parser.add_argument('--model_name', type=str, default='resnet34')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--img_w', type=int, default=640)
+    parser.add_argument('--img_h', type=int, default=360)
+    parser.add_argument('--patch_size_h', type=int, default=315)
+    parser.add_argument('--patch_size_w', type=int, default=560)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=1)
+
+    args = parser.parse_args()
+    run(args)
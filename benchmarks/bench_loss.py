@@ -0,0 +1,71 @@
+# coding: utf-8
+"""
+CPU benchmark of the fused feature losses of utils (channel_l1, masked_mean,
+masked_triplet_loss) against the per-channel autograd expressions they replace,
+on auxiliary-resnet sized features: bytes the graph saves for backward beyond
+the input features, forward+backward time, and the difference of the losses
+and gradients.
+"""
+import argparse
+
+import torch
+
+from common import use_variant, time_it, report, saved_bytes
+
+
+def run(args):
+    use_variant(args.variant)
+    from utils import channel_l1, masked_mean, masked_triplet_loss
+
+    torch.manual_seed(0)
+    torch.set_num_threads(args.threads)
+    shape = (args.batch_size, args.channels, args.feat_h, args.feat_w)
+    pred = torch.randn(shape, requires_grad=True)
+    anchor, negative = torch.randn(shape), torch.randn(shape)
+    mask = torch.rand(args.batch_size, args.feat_h, args.feat_w)
+
+    def triplet_reference():
+        loss_map = torch.clamp(torch.sum(torch.abs(anchor - pred + 1e-6), dim=1) -
+                               torch.sum(torch.abs(anchor - negative + 1e-6), dim=1) + 1.0, min=0)
+        return torch.sum(mask * loss_map) / torch.sum(mask)
+
+    def triplet_fused():
+        return masked_triplet_loss(anchor, pred, negative, mask)[0]
+
+    def bihome_reference():
+        loss_map = torch.sum(torch.abs(pred - anchor), dim=1) - torch.sum(torch.abs(negative - anchor), dim=1)
+        loss_den = torch.sum(torch.sum(mask, dim=-1), dim=-1)
+        return torch.sum(torch.sum(torch.sum(mask * loss_map, dim=-1), dim=-1) /
+                         torch.max(loss_den, torch.ones_like(loss_den)))
+
+    def bihome_fused():
+        return masked_mean(channel_l1(pred, anchor) - channel_l1(negative, anchor), mask, per_sample=True)
+
+    for name, reference, fused in [('triplet', triplet_reference, triplet_fused),
+                                   ('biHomE l1', bihome_reference, bihome_fused)]:
+        loss_ref, loss = reference(), fused()
+        grad_ref, = torch.autograd.grad(loss_ref, pred)
+        grad, = torch.autograd.grad(loss, pred)
+        print('{}: |diff| loss {:.1e} grad {:.1e}'.format(
+            name, abs(loss_ref.item() - loss.item()), (grad_ref - grad).abs().max().item()))
+        for label, fn in [('autograd', reference), ('fused', fused)]:
+            def step():
+                pred.grad = None
+                fn().backward()
+            seconds, _ = time_it(step, repeat=args.repeat)
+            report('{} {} saved'.format(name, label), seconds, saved_bytes(fn, [pred, anchor, negative, mask]))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--variant', type=str, default='Doubleline-Zhang-biHomE')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--channels', type=int, default=64)
+    parser.add_argument('--feat_h', type=int, default=79)
+    parser.add_argument('--feat_w', type=int, default=140)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=1)
+
+    args = parser.parse_args()
+    run(args)
@@ -0,0 +1,58 @@
+# coding: utf-8
+"""
+CPU micro-benchmark of the transformer() sampling backends: full-frame and
+patch-only warps with every backend in utils.SAMPLERS, checked against the
+'gather' reference.
+"""
+import argparse
+
+import torch
+
+from common import use_variant, time_it, allocated_bytes, report
+
+
+def random_homographies(batch_size, rho=0.02):
+    H = torch.eye(3).unsqueeze(0).repeat(batch_size, 1, 1)
+    H[:, :2, :2] += rho * torch.randn(batch_size, 2, 2)
+    H[:, :2, 2] += rho * torch.randn(batch_size, 2)
+    H[:, 2, :2] += rho * 0.1 * torch.randn(batch_size, 2)
+    return H
+
+
+def run(args):
+    use_variant(args.variant)
+    from utils import transformer, SAMPLERS
+
+    torch.manual_seed(0)
+    torch.set_num_threads(args.threads)
+    U = torch.randn(args.batch_size, args.channels, args.img_h, args.img_w)
+    theta = random_homographies(args.batch_size)
+    origin = torch.tensor([[40, 23]]).repeat(args.batch_size, 1)
+
+    cases = [('full', (args.img_h, args.img_w), {}),
+             ('patch', (args.patch_size_h, args.patch_size_w), {'origin': origin})]
+    for case, out_size, kwargs in cases:
+        reference, _ = transformer(U, theta, out_size, 'gather', **kwargs)
+        for sampler in SAMPLERS:
+            fn = lambda: transformer(U, theta, out_size, sampler, **kwargs)
+            output, _ = fn()
+            err = (output - reference).abs().max().item()
+            seconds, _ = time_it(fn, repeat=args.repeat)
+            report('{}/{} (max err {:.1e})'.format(case, sampler, err), seconds, allocated_bytes(fn))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--variant', type=str, default='Oneline-DLTv1')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--channels', type=int, default=1)
+    parser.add_argument('--img_w', type=int, default=640)
+    parser.add_argument('--img_h', type=int, default=360)
+    parser.add_argument('--patch_size_h', type=int, default=315)
+    parser.add_argument('--patch_size_w', type=int, default=560)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=1)
+
+    args = parser.parse_args()
+    run(args)
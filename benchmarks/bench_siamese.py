@@ -0,0 +1,87 @@
+# coding: utf-8
+"""
+CPU benchmark of utils.siamese_forward against one call per branch for the
+shared-weight modules of a training forward (genMask on the full frames,
+ShareFeature and the auxiliary resnet on the patches), in training mode, with a
+check that the outputs, input gradients and BatchNorm running statistics of the
+two paths agree. The AFM and biHomE variants build a pretrained torchvision
+resnet34, whose weights must be downloadable or cached.
+"""
+import argparse
+import copy
+
+import torch
+
+from common import use_variant, time_it, report
+
+
+def compare(sequential, batched, inputs):
+    """
+    One step of both paths from the same state
+    :return: max abs difference of outputs, input gradients and running statistics
+    """
+    from utils import siamese_forward
+
+    seq_inputs = [x.clone().requires_grad_() for x in inputs]
+    bat_inputs = [x.clone().requires_grad_() for x in inputs]
+    seq_out = siamese_forward(sequential, seq_inputs, batched=False)
+    bat_out = siamese_forward(batched, bat_inputs)
+    # weight the branches differently so a swapped split would show
+    sum((i + 1) * out.sum() for i, out in enumerate(seq_out)).backward()
+    sum((i + 1) * out.sum() for i, out in enumerate(bat_out)).backward()
+
+    out_err = max((a - b).abs().max().item() for a, b in zip(seq_out, bat_out))
+    grad_err = max((a.grad - b.grad).abs().max().item() for a, b in zip(seq_inputs, bat_inputs))
+    stats_err = max([(a.double() - b.double()).abs().max().item()
+                     for a, b in zip(sequential.buffers(), batched.buffers())] + [0.0])
+    return out_err, grad_err, stats_err
+
+
+def run(args):
+    use_variant(args.variant)
+    from torch_homography_model import build_model
+    from utils import siamese_forward
+
+    torch.manual_seed(0)
+    torch.set_num_threads(args.threads)
+    net = build_model(args.model_name)
+    net.train()
+
+    frames = torch.randn(args.batch_size, 2, args.img_h, args.img_w)
+    patches = frames[:, :, :args.patch_size_h, :args.patch_size_w].contiguous()
+    branches = [('genMask', net.genMask, [frames[:, :1], frames[:, 1:]]),
+                ('ShareFeature', net.ShareFeature, [patches[:, :1], patches[:, 1:]])]
+    if hasattr(net, 'auxiliary_resnet'):
+        branches.append(('auxiliary_resnet', net.auxiliary_resnet, [patches[:, :1], patches[:, 1:], patches[:, 1:]]))
+
+    for name, module, inputs in branches:
+        sequential, batched = copy.deepcopy(module), copy.deepcopy(module)
+        for _ in range(args.steps):
+            out_err, grad_err, stats_err = compare(sequential, batched, inputs)
+        print('{}: max |diff| output {:.1e} input grad {:.1e} running stats {:.1e} after {} steps'.format(
+            name, out_err, grad_err, stats_err, args.steps))
+
+        for label, batched_call in [('sequential', False), ('batched', True)]:
+            def step():
+                module.zero_grad()
+                sum(out.sum() for out in siamese_forward(module, inputs, batched_call)).backward()
+            seconds, _ = time_it(step, repeat=args.repeat)
+            report('{} {} bs {}'.format(name, label, args.batch_size), seconds)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--variant', type=str, default='Oneline-DLTv1')
+    parser.add_argument('--model_name', type=str, default='resnet34')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--img_w', type=int, default=640)
+    parser.add_argument('--img_h', type=int, default=360)
+    parser.add_argument('--patch_size_h', type=int, default=315)
+    parser.add_argument('--patch_size_w', type=int, default=560)
+    parser.add_argument('--steps', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=1)
+
+    args = parser.parse_args()
+    run(args)
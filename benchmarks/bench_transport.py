@@ -0,0 +1,52 @@
+# coding: utf-8
+"""
+CPU benchmark of the float64 and uint8 sample transports: bytes pickled per
+sample through the DataLoader worker queues, worker-side preprocessing time and
+device-side normalize_gray time, with a bit-parity check of the two paths.
+"""
+import argparse
+import pickle
+
+import numpy as np
+import torch
+
+from common import use_variant, time_it, report
+
+
+def run(args):
+    use_variant(args.variant)
+    from dataset import prepare_img
+    from utils import normalize_gray
+
+    torch.set_num_threads(args.threads)
+    rng = np.random.RandomState(0)
+    mean_I = np.reshape(np.array([118.93, 113.97, 102.60]), (1, 1, 3))
+    std_I = np.reshape(np.array([69.85, 68.81, 72.45]), (1, 1, 3))
+    frames = [rng.randint(0, 256, (args.img_h, args.img_w, 3)).astype(np.uint8) for _ in range(2)]
+
+    def sample(keep_uint8):
+        return torch.tensor(np.concatenate([prepare_img(img, mean_I, std_I, keep_uint8) for img in frames], axis=0))
+
+    float_sample, uint8_sample = sample(False), sample(True)
+    batch = uint8_sample.unsqueeze(0).repeat(args.batch_size, 1, 1, 1)
+    parity = torch.equal(float_sample.unsqueeze(0).float(), normalize_gray(uint8_sample.unsqueeze(0)))
+
+    for name, keep_uint8, tensor in [('float64', False, float_sample), ('uint8', True, uint8_sample)]:
+        seconds, _ = time_it(lambda: sample(keep_uint8), repeat=args.repeat)
+        report('worker {} sample'.format(name), seconds, len(pickle.dumps(tensor)))
+    seconds, _ = time_it(lambda: normalize_gray(batch), repeat=args.repeat)
+    report('normalize_gray bs {} (bit-exact {})'.format(args.batch_size, parity), seconds)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--variant', type=str, default='Oneline-DLTv1')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--img_w', type=int, default=640)
+    parser.add_argument('--img_h', type=int, default=360)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=1)
+
+    args = parser.parse_args()
+    run(args)
@@ -0,0 +1,82 @@
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+
+# The variants are plain script folders importing each other as top-level modules
+# (utils, resnet, dataset, ...), so only one of them can be imported at a time.
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+VARIANTS = ['Oneline-DLTv1', 'Oneline-DLTv1-with-AFM', 'Doubleline-DLTv1', 'Doubleline-Zhang-biHomE']
+
+
+def use_variant(variant):
+    """
+    Make the modules of variant importable. Switching variants drops the modules of the
+    previous one from sys.modules, so imports made after the switch load this variant's
+    copies; module objects imported before it keep working
+    """
+    path = os.path.join(ROOT, variant)
+    for other in VARIANTS:
+        other_path = os.path.join(ROOT, other)
+        if other == variant or other_path not in sys.path:
+            continue
+        sys.path.remove(other_path)
+        for name, module in list(sys.modules.items()):
+            if (getattr(module, '__file__', None) or '').startswith(other_path + os.sep):
+                del sys.modules[name]
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    return path
+
+
+def time_it(fn, repeat=10, warmup=2):
+    """
+    :return: per-call wall time in seconds (median, min)
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)), float(np.min(times))
+
+
+def allocated_bytes(fn):
+    """
+    Total bytes allocated by the ATen ops of one CPU call of fn, a proxy for the
+    size of the temporaries it materialises
+    """
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    return int(sum(e.self_cpu_memory_usage for e in prof.events() if e.self_cpu_memory_usage > 0))
+
+
+def saved_bytes(fn, inputs):
+    """
+    Bytes of the tensors the autograd graph of fn() saves for backward, not counting
+    the inputs themselves, which the network keeps alive anyway
+    """
+    input_ptrs = {x.data_ptr() for x in inputs}
+    saved = {}
+
+    def pack(tensor):
+        if tensor.data_ptr() not in input_ptrs:
+            saved[tensor.data_ptr()] = tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+    return sum(saved.values())
+
+
+def report(name, seconds, nbytes=None):
+    line = '{:<40s} {:9.3f} ms'.format(name, seconds * 1000)
+    if nbytes is not None:
+        line += ' {:10.1f} MB'.format(nbytes / 2.0 ** 20)
+    print(line)
@@ -0,0 +1,307 @@
+# coding: utf-8
+"""
+CPU benchmark suite on synthetic data, no dataset needed: DLT_solve, the transformer
+warps, TrainDataset.__getitem__ on generated JPEGs, SyntheticPairDataset and the
+test-set error post-processing (in --kernels_variant), genMask/ShareFeature and a full
+forward plus backward per backbone (in every variant). Every variant runs in its own
+subprocess.
+
+    python run.py --out baseline.json
+    python run.py --out new.json --compare baseline.json
+    python run.py --current new.json --compare baseline.json
+
+--compare prints the ratio of every timing to the baseline and exits with 1 when
+one of them is slower than the baseline by more than --threshold. The AFM and
+biHomE variants build a pretrained torchvision resnet34, whose weights must be
+downloadable or cached; a benchmark that fails is recorded with its error.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+import torch
+
+from common import VARIANTS, use_variant, time_it, report
+
+
+def failed(results, name, e):
+    results[name] = {'error': '{}: {}'.format(type(e).__name__, e)}
+    print('{:<40s} failed: {}'.format(name, results[name]['error']))
+
+
+def measure(results, name, fn, repeat, warmup=1):
+    try:
+        median, best = time_it(fn, repeat=repeat, warmup=warmup)
+    except Exception as e:
+        failed(results, name, e)
+        return
+    results[name] = {'median_ms': median * 1000, 'min_ms': best * 1000, 'repeat': repeat}
+    report(name, median)
+
+
+def parse_size(size):
+    h, w = size.lower().split('x')
+    return int(h), int(w)
+
+
+def bench_dlt(args, results, prefix):
+    from utils import DLT_solve
+    from bench_dlt import mesh_points
+
+    for divide in args.divides:
+        for batch_size in args.dlt_batch_sizes:
+            src_p, off_set = mesh_points(batch_size, divide)
+            measure(results, '{}/DLT_solve/mesh {}x{} bs {}'.format(prefix, divide, divide, batch_size),
+                    lambda: DLT_solve(src_p, off_set), args.repeat)
+
+
+def bench_transform(args, results, prefix):
+    from utils import get_geometry, transform, transform_patch, transform_frame
+    from bench_sampler import random_homographies
+
+    batch_size = args.batch_size
+    for size in args.sizes:
+        img_h, img_w = parse_size(size)
+        # the 315x560 patch of a 360x640 frame, scaled with the frame
+        patch_h, patch_w = img_h * 315 // 360, img_w * 560 // 640
+        x, y = (img_w - patch_w) // 2, (img_h - patch_h) // 2
+        geometry = get_geometry(batch_size, img_h, img_w, patch_h, patch_w, 'cpu')
+        I1 = [torch.randn(batch_size, 1, img_h, img_w), torch.rand(batch_size, 1, img_h, img_w)]
+        H_mat = random_homographies(batch_size)
+        patch_origin = torch.tensor([[x, y]]).repeat(batch_size, 1)
+        ys, xs = np.mgrid[y:y + patch_h, x:x + patch_w]
+        patch_indices = torch.tensor((ys * img_w + xs).reshape(1, -1)).float().repeat(batch_size, 1)
+
+        name = '{}/{{}}/{} bs {}'.format(prefix, size, batch_size)
+        measure(results, name.format('transform_frame'),
+                lambda: transform_frame(geometry.M_tile_inv, H_mat, geometry.M_tile, I1), args.repeat)
+        measure(results, name.format('transform'),
+                lambda: transform(patch_h, patch_w, geometry.M_tile_inv, H_mat, geometry.M_tile, I1, patch_indices,
+                                  geometry.batch_indices_tensor), args.repeat)
+        measure(results, name.format('transform_patch'),
+                lambda: transform_patch(patch_h, patch_w, geometry.M_tile_inv, H_mat, geometry.M_tile, I1,
+                                        patch_origin), args.repeat)
+
+
+def write_jpegs(exp_path, num_images, img_h=360, img_w=640):
+    """
+    Smooth random textures, closer to the decode cost of real frames than white noise
+    :return: path of a Train_List.txt of consecutive pairs
+    """
+    rng = np.random.RandomState(0)
+    os.makedirs(os.path.join(exp_path, 'Data', 'Train', 'bench'))
+    names = []
+    for k in range(num_images):
+        texture = rng.randint(0, 256, (img_h // 8, img_w // 8, 3)).astype(np.uint8)
+        img = cv2.resize(texture, (img_w, img_h), interpolation=cv2.INTER_CUBIC)
+        img = cv2.add(img, rng.randint(0, 16, img.shape).astype(np.uint8))
+        names.append('bench/{:05d}.jpg'.format(k))
+        cv2.imwrite(os.path.join(exp_path, 'Data', 'Train', names[-1]), img)
+    list_path = os.path.join(exp_path, 'Train_List.txt')
+    with open(list_path, 'w') as f:
+        for name_1, name_2 in zip(names[:-1], names[1:]):
+            f.write('{} {}\n'.format(name_1, name_2))
+    return list_path
+
+
+def measure_items(results, name, data, repeat):
+    state = {'index': 0}
+
+    def get_item():
+        data[state['index'] % len(data)]
+        state['index'] += 1
+
+    measure(results, name, get_item, repeat)
+
+
+def bench_dataset(args, results, prefix):
+    from dataset import TrainDataset, SyntheticPairDataset
+
+    exp_path = tempfile.mkdtemp(prefix='bench_dataset_')
+    try:
+        list_path = write_jpegs(exp_path, args.num_images)
+        for uint8_frames in [False, True]:
+            mode = 'uint8' if uint8_frames else 'float'
+            measure_items(results, '{}/TrainDataset.__getitem__/{}'.format(prefix, mode),
+                          TrainDataset(list_path, exp_path, uint8_frames=uint8_frames), args.repeat * 4)
+            measure_items(results, '{}/SyntheticPairDataset.__getitem__/{}'.format(prefix, mode),
+                          SyntheticPairDataset(args.num_images, uint8_frames=uint8_frames), args.repeat * 4)
+        measure_items(results, '{}/SyntheticPairDataset.__getitem__/moving object'.format(prefix),
+                      SyntheticPairDataset(args.num_images, moving_object=True), args.repeat * 4)
+    finally:
+        shutil.rmtree(exp_path, ignore_errors=True)
+
+
+def bench_postprocess(args, results, prefix):
+    from test import pair_errors
+
+    rng = np.random.RandomState(0)
+    for num_pairs in args.test_pairs:
+        H_mat = np.tile(np.eye(3, dtype=np.float32), (num_pairs, 1, 1))
+        H_mat += rng.normal(0, 1e-3, H_mat.shape).astype(np.float32)
+        matches = rng.uniform(0, 640, (num_pairs, 6, 2, 2))
+        measure(results, '{}/pair_errors/{} pairs'.format(prefix, num_pairs),
+                lambda: pair_errors(H_mat, matches), args.repeat)
+
+
+def model_inputs(batch_size, img_h, img_w, patch_h, patch_w):
+    torch.manual_seed(0)
+    org_imges = torch.randn(batch_size, 2, img_h, img_w)
+    x, y = (img_w - patch_w) // 2, (img_h - patch_h) // 2
+    input_tesnors = org_imges[:, :, y:y + patch_h, x:x + patch_w].contiguous()
+    h4p = torch.tensor([x, y, x, y + patch_h, x + patch_w, y + patch_h, x + patch_w, y]).float().repeat(batch_size, 1)
+    patch_origin = torch.tensor([[x, y]]).repeat(batch_size, 1)
+    return org_imges, input_tesnors, h4p, patch_origin
+
+
+def bench_model(args, results, prefix):
+    from torch_homography_model import build_model
+
+    img_h, img_w = parse_size(args.sizes[0])
+    org_imges, input_tesnors, h4p, patch_origin = model_inputs(args.batch_size, img_h, img_w, args.patch_size_h,
+                                                               args.patch_size_w)
+    for backbone in args.backbones:
+        name = '{}/{}/{{}} bs {}'.format(prefix, backbone, args.batch_size)
+        try:
+            net = build_model(backbone)
+        except Exception as e:
+            failed(results, name.format('build_model'), e)
+            continue
+        net.train()
+
+        def modules():
+            mask = net.genMask(org_imges[:, :1])
+            feature = net.ShareFeature(input_tesnors[:, :1])
+            (mask.sum() + feature.sum()).backward()
+
+        def train_step():
+            net.zero_grad()
+            out = net(org_imges, input_tesnors, h4p, patch_origin)
+            loss = sum(v.sum() for k, v in out.items() if 'loss' in k and not k.endswith('_d'))
+            loss.backward()
+
+        if backbone == args.backbones[0]:
+            # genMask and ShareFeature do not depend on the backbone
+            measure(results, name.format('genMask+ShareFeature'), modules, args.model_repeat)
+        measure(results, name.format('forward+backward'), train_step, args.model_repeat)
+
+
+def run_variant(args):
+    use_variant(args.worker)
+    torch.set_num_threads(args.threads)
+    results = OrderedDict()
+    benches = [bench_model]
+    if args.worker == args.kernels_variant:
+        benches = [bench_dlt, bench_transform, bench_dataset, bench_postprocess] + benches
+    for bench in benches:
+        if bench.__name__[len('bench_'):] in args.skip:
+            continue
+        bench(args, results, args.worker)
+    with open(args.worker_out, 'w') as f:
+        json.dump(results, f)
+
+
+def run_suite(args):
+    results = OrderedDict()
+    for variant in args.variants:
+        print('# {}'.format(variant))
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            # the variants import each other's modules by top-level name, one per process
+            code = subprocess.call([sys.executable, os.path.abspath(__file__)] + sys.argv[1:] +
+                                   ['--worker', variant, '--worker_out', path])
+            if code != 0 or os.path.getsize(path) == 0:
+                results[variant] = {'error': 'worker exited with {}'.format(code)}
+            else:
+                with open(path, 'r') as f:
+                    results.update(json.load(f, object_pairs_hook=OrderedDict))
+        finally:
+            os.remove(path)
+    return {'meta': {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+                     'torch': torch.__version__, 'platform': platform.platform(), 'processor': platform.processor(),
+                     'threads': args.threads, 'argv': sys.argv[1:]},
+            'results': results}
+
+
+def compare(baseline, current, threshold, metric):
+    """
+    :return: names of the timings slower than baseline by more than threshold
+    """
+    regressions = []
+    for name, base in baseline['results'].items():
+        now = current['results'].get(name)
+        if now is None or metric not in base or metric not in now:
+            print('{:<60s} {}'.format(name, 'missing' if now is None else now.get('error', base.get('error', ''))))
+            continue
+        ratio = now[metric] / base[metric]
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 / (1 + threshold):
+            flag = 'faster'
+        print('{:<60s} {:10.3f} -> {:10.3f} ms  x{:.2f} {}'.format(name, base[metric], now[metric], ratio, flag))
+    for name in current['results']:
+        if name not in baseline['results']:
+            print('{:<60s} new'.format(name))
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--out', type=str, default=None, help='write the results to this JSON file')
+    parser.add_argument('--compare', type=str, default=None, help='baseline JSON to compare the results with')
+    parser.add_argument('--current', type=str, default=None, help='compare this JSON instead of running the suite')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown ratio flagged as a regression')
+    parser.add_argument('--metric', type=str, default='median_ms', choices=['median_ms', 'min_ms'])
+    parser.add_argument('--variants', type=str, nargs='+', default=VARIANTS)
+    parser.add_argument('--kernels_variant', type=str, default='Oneline-DLTv1',
+                        help='variant that runs the DLT, warp, dataset and post-processing benchmarks')
+    parser.add_argument('--skip', type=str, nargs='*', default=[],
+                        choices=['dlt', 'transform', 'dataset', 'postprocess', 'model'])
+    parser.add_argument('--backbones', type=str, nargs='+', default=['resnet34', 'resnet50'])
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--sizes', type=str, nargs='+', default=['360x640', '720x1280'],
+                        help='frame sizes of the warps, the first one for the models')
+    parser.add_argument('--patch_size_h', type=int, default=315)
+    parser.add_argument('--patch_size_w', type=int, default=560)
+    parser.add_argument('--divides', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--dlt_batch_sizes', type=int, nargs='+', default=[1, 32])
+    parser.add_argument('--num_images', type=int, default=16, help='generated JPEGs of the dataset benchmark')
+    parser.add_argument('--test_pairs', type=int, nargs='+', default=[64, 4096])
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--model_repeat', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--worker', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--worker_out', type=str, default=None, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    if args.worker is not None:
+        run_variant(args)
+        sys.exit(0)
+
+    if args.current is not None:
+        with open(args.current, 'r') as f:
+            current = json.load(f, object_pairs_hook=OrderedDict)
+    else:
+        current = run_suite(args)
+        if args.out is not None:
+            with open(args.out, 'w') as f:
+                json.dump(current, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f, object_pairs_hook=OrderedDict)
+        regressions = compare(baseline, current, args.threshold, args.metric)
+        print('{} regression(s) over {:.0f}%'.format(len(regressions), 100 * args.threshold))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,63 @@
+# coding: utf-8
+"""
+ResNet.predict_bidirectional of the Doubleline variants against the two
+predict_homography calls it replaces, in training mode: BatchNorm running
+statistics must be identical, homographies, loss and parameter gradients equal
+up to float rounding. Run with python -m pytest benchmarks
+"""
+import copy
+
+import pytest
+import torch
+import torchvision
+
+from common import use_variant
+
+# (rtol, atol) of the homographies, the loss and the parameter gradients
+TOLERANCES = {torch.float64: (1e-9, 1e-12), torch.float32: (1e-3, 1e-5)}
+
+
+@pytest.mark.parametrize('variant', ['Doubleline-DLTv1', 'Doubleline-Zhang-biHomE'])
+@pytest.mark.parametrize('dtype', [torch.float64, torch.float32])
+def test_predict_bidirectional(variant, dtype, monkeypatch):
+    # the biHomE auxiliary resnet is not used here, so its pretrained weights are not needed
+    resnet34 = torchvision.models.resnet34
+    monkeypatch.setattr(torchvision.models, 'resnet34', lambda pretrained=False, **kwargs: resnet34(**kwargs))
+    use_variant(variant)
+    from torch_homography_model import build_model
+    from utils import get_patch_corners
+
+    torch.manual_seed(0)
+    net = build_model('resnet34').to(dtype)
+    net.train()
+    sequential = copy.deepcopy(net)
+    sequential.siamese = False
+
+    batch_size, patch_size_h, patch_size_w = 3, 64, 96
+    patch_1 = torch.randn(batch_size, 1, patch_size_h, patch_size_w, dtype=dtype)
+    patch_2 = torch.randn(batch_size, 1, patch_size_h, patch_size_w, dtype=dtype)
+    h4p = get_patch_corners(batch_size, (40, 23), patch_size_h, patch_size_w, patch_1.device, dtype)
+    # weight the directions differently so a swapped split would show
+    weight_12, weight_21 = torch.randn(3, 3, dtype=dtype), torch.randn(3, 3, dtype=dtype)
+
+    def step(model, batched):
+        model.zero_grad()
+        if batched:
+            H_mat_12, H_mat_21 = model.predict_bidirectional(patch_1, patch_2, h4p)
+        else:
+            H_mat_12 = model.predict_homography(patch_1, patch_2, h4p)
+            H_mat_21 = model.predict_homography(patch_2, patch_1, h4p)
+        loss = (H_mat_12 * weight_12).sum() + (H_mat_21 * weight_21).sum()
+        loss.backward()
+        return H_mat_12, H_mat_21, loss
+
+    rtol, atol = TOLERANCES[dtype]
+    for _ in range(2):
+        expected, actual = step(sequential, False), step(net, True)
+        for a, b in zip(expected, actual):
+            torch.testing.assert_close(b, a, rtol=rtol, atol=atol)
+        for (name, a), (_, b) in zip(sequential.named_parameters(), net.named_parameters()):
+            if a.grad is not None:
+                torch.testing.assert_close(b.grad, a.grad, rtol=rtol, atol=atol, msg=name)
+        for (name, a), (_, b) in zip(sequential.named_buffers(), net.named_buffers()):
+            assert torch.equal(a, b), name
@@ -0,0 +1,67 @@
+# coding: utf-8
+"""
+The 'grid_sample' backend of utils.transformer against the 'gather' reference,
+for full-frame and patch warps, including samples on the frame border and
+outside the frame. Run with python -m pytest benchmarks
+"""
+import pytest
+import torch
+
+from common import use_variant, VARIANTS
+
+# both backends see the same source coordinates and only compute the bilinear
+# weights differently, so for pixels in [0, 1) they agree to float32 rounding
+ATOL = 1e-5
+
+IMG_H, IMG_W = 24, 32
+PATCH_H, PATCH_W = 10, 14
+
+
+def homographies():
+    """
+    Pixel-space H_mat, taking output pixels to source pixels: identity samples the
+    border pixels exactly, the translations put samples across the border and
+    outside the frame, the last one entirely outside it
+    """
+    H = torch.eye(3).unsqueeze(0).repeat(6, 1, 1)
+    H[1, :2, 2] = torch.tensor([0.5, 0.25])
+    H[2, :2, 2] = torch.tensor([-10.3, 7.7])
+    H[3, :2, 2] = torch.tensor([IMG_W - 1.5, -(IMG_H - 0.75)])
+    H[4, :2, :2] += 0.05 * torch.randn(2, 2)
+    H[4, 2, :2] = 0.002 * torch.randn(2)
+    H[5, :2, 2] = torch.tensor([3.0 * IMG_W, 0.0])
+    return H
+
+
+@pytest.mark.parametrize('variant', VARIANTS)
+def test_transform_frame(variant):
+    use_variant(variant)
+    from utils import get_geometry, transform_frame
+
+    torch.manual_seed(0)
+    H_mat = homographies()
+    I1 = torch.rand(H_mat.size(0), 2, IMG_H, IMG_W)
+    M_tile, M_tile_inv, _ = get_geometry(H_mat.size(0), IMG_H, IMG_W, PATCH_H, PATCH_W, I1.device)
+
+    reference = transform_frame(M_tile_inv, H_mat, M_tile, I1, sampler='gather')
+    output = transform_frame(M_tile_inv, H_mat, M_tile, I1, sampler='grid_sample')
+    assert reference[-1].abs().max() < ATOL
+    torch.testing.assert_close(output, reference, rtol=0, atol=ATOL)
+
+
+@pytest.mark.parametrize('variant', VARIANTS)
+@pytest.mark.parametrize('patch_origin', [(0, 0), (9, 5), (IMG_W - PATCH_W, IMG_H - PATCH_H)])
+def test_transform_patch(variant, patch_origin):
+    use_variant(variant)
+    from utils import get_geometry, transform_patch
+
+    torch.manual_seed(0)
+    H_mat = homographies()
+    I1 = torch.rand(H_mat.size(0), 2, IMG_H, IMG_W)
+    M_tile, M_tile_inv, _ = get_geometry(H_mat.size(0), IMG_H, IMG_W, PATCH_H, PATCH_W, I1.device)
+    origin = torch.tensor([patch_origin]).repeat(H_mat.size(0), 1)
+
+    reference = transform_patch(PATCH_H, PATCH_W, M_tile_inv, H_mat, M_tile, I1, origin, sampler='gather')
+    output = transform_patch(PATCH_H, PATCH_W, M_tile_inv, H_mat, M_tile, I1, origin, sampler='grid_sample')
+    assert reference[-1].abs().max() < ATOL
+    torch.testing.assert_close(output, reference, rtol=0, atol=ATOL)
@@ -0,0 +1,78 @@
+# coding: utf-8
+"""
+server.RequestHandler on malformed POST /homography bodies: every one must be
+answered with a 400 and leave the server serving. Run with python -m pytest benchmarks
+"""
+import http.client
+import io
+import json
+import threading
+from http.server import ThreadingHTTPServer
+
+import numpy as np
+import pytest
+import torch
+
+from common import use_variant, VARIANTS
+
+
+def npz(**arrays):
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue()
+
+
+@pytest.fixture(params=VARIANTS)
+def address(request):
+    use_variant(request.param)
+    from server import DynamicBatcher, RequestHandler
+
+    # no request reaches the network, any module with parameters will do
+    batcher = DynamicBatcher(torch.nn.Linear(1, 1), patch_size_h=32, patch_size_w=48)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RequestHandler)
+    server.daemon_threads = True
+    server.batcher = batcher
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[:2]
+    server.shutdown()
+    server.server_close()
+    batcher.close()
+
+
+def post(address, body, content_length=True):
+    conn = http.client.HTTPConnection(*address, timeout=10)
+    try:
+        conn.putrequest('POST', '/homography')
+        if content_length:
+            conn.putheader('Content-Length', str(len(body)))
+        conn.endheaders()
+        conn.send(body)
+        response = conn.getresponse()
+        return response.status, json.loads(response.read().decode('utf-8'))
+    finally:
+        conn.close()
+
+
+frame = np.zeros((36, 64, 3), dtype=np.uint8)
+MALFORMED = {
+    'empty': (b'', True),
+    'no content-length': (b'', False),
+    'truncated': (npz(img1=frame, img2=frame)[:100], True),
+    'not an npz': (b'not an npz' * 10, True),
+    'missing img2': (npz(img1=frame), True),
+    'shape mismatch': (npz(img1=frame, img2=frame[:, :50]), True),
+    'smaller than the patch': (npz(img1=frame[:20], img2=frame[:20]), True),
+}
+
+
+@pytest.mark.parametrize('case', list(MALFORMED))
+def test_malformed_body(address, case):
+    body, content_length = MALFORMED[case]
+    status, content = post(address, body, content_length)
+    assert status == 400 and content['error']
+
+    conn = http.client.HTTPConnection(*address, timeout=10)
+    conn.request('GET', '/metrics')
+    assert conn.getresponse().status == 200
+    conn.close()
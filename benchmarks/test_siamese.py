@@ -0,0 +1,78 @@
+# coding: utf-8
+"""
+utils.siamese_forward against one call per branch in training mode: BatchNorm
+running statistics must be identical, outputs and input gradients equal up to
+float rounding. Run with python -m pytest benchmarks
+"""
+import copy
+
+import pytest
+import torch
+import torchvision
+
+from common import use_variant, VARIANTS
+
+# (rtol, atol) of outputs and input gradients; the batched BatchNorm reduces each
+# branch in another memory layout, which only reorders the float sums
+TOLERANCES = {torch.float64: (1e-10, 1e-12), torch.float32: (1e-4, 1e-5)}
+
+
+def small_net():
+    return torch.nn.Sequential(
+        torch.nn.Conv2d(1, 4, 3, padding=1), torch.nn.BatchNorm2d(4), torch.nn.ReLU(),
+        torch.nn.Conv2d(4, 4, 3, padding=1), torch.nn.BatchNorm2d(4, momentum=None), torch.nn.ReLU(),
+        torch.nn.Conv2d(4, 2, 3, padding=1), torch.nn.BatchNorm2d(2, affine=False))
+
+
+def resnet_trunk():
+    # the residual blocks of the auxiliary resnet, built without the pretrained weights
+    resnet = torchvision.models.resnet18(weights=None)
+    return torch.nn.Sequential(torch.nn.Conv2d(1, 3, 1), resnet.conv1, resnet.bn1, resnet.relu, resnet.layer1)
+
+
+def check_siamese_forward(module, inputs, steps=3):
+    from utils import siamese_forward
+
+    sequential, batched = copy.deepcopy(module).train(), copy.deepcopy(module).train()
+    rtol, atol = TOLERANCES[inputs[0].dtype]
+    for _ in range(steps):
+        seq_inputs = [x.clone().requires_grad_() for x in inputs]
+        bat_inputs = [x.clone().requires_grad_() for x in inputs]
+        seq_out = siamese_forward(sequential, seq_inputs, batched=False)
+        bat_out = siamese_forward(batched, bat_inputs)
+        # weight the branches differently so a swapped split would show
+        sum((i + 1) * out.sum() for i, out in enumerate(seq_out)).backward()
+        sum((i + 1) * out.sum() for i, out in enumerate(bat_out)).backward()
+
+        for a, b in zip(seq_out, bat_out):
+            torch.testing.assert_close(b, a, rtol=rtol, atol=atol)
+        for a, b in zip(seq_inputs, bat_inputs):
+            torch.testing.assert_close(b.grad, a.grad, rtol=rtol, atol=atol)
+        for (name, a), (_, b) in zip(sequential.named_buffers(), batched.named_buffers()):
+            assert torch.equal(a, b), name
+
+
+@pytest.mark.parametrize('variant', VARIANTS)
+@pytest.mark.parametrize('dtype', [torch.float64, torch.float32])
+@pytest.mark.parametrize('num_branches', [2, 3])
+def test_siamese_forward(variant, dtype, num_branches):
+    use_variant(variant)
+    torch.manual_seed(0)
+    inputs = [torch.randn(3, 1, 20, 24, dtype=dtype) for _ in range(num_branches)]
+    check_siamese_forward(small_net().to(dtype), inputs)
+    check_siamese_forward(resnet_trunk().to(dtype), inputs)
+
+
+# the AFM and biHomE models build a pretrained torchvision resnet on construction
+@pytest.mark.parametrize('variant', ['Oneline-DLTv1', 'Doubleline-DLTv1'])
+@pytest.mark.parametrize('dtype', [torch.float64, torch.float32])
+def test_siamese_forward_model(variant, dtype):
+    use_variant(variant)
+    from torch_homography_model import build_model
+
+    torch.manual_seed(0)
+    net = build_model('resnet34').to(dtype)
+    frames = torch.randn(2, 2, 36, 64, dtype=dtype)
+    patches = frames[:, :, :32, :48].contiguous()
+    check_siamese_forward(net.genMask, [frames[:, :1], frames[:, 1:]])
+    check_siamese_forward(net.ShareFeature, [patches[:, :1], patches[:, 1:]])
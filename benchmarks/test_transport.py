@@ -0,0 +1,38 @@
+# coding: utf-8
+"""
+The uint8 sample transport against the float64 one it replaces: frames kept
+uint8 by dataset.prepare_img and normalised on the device by
+utils.normalize_gray must give exactly the float64 dataset preprocessing
+followed by .float(). Run with python -m pytest benchmarks
+"""
+import numpy as np
+import pytest
+import torch
+
+from common import use_variant, VARIANTS
+
+
+@pytest.mark.parametrize('variant', VARIANTS)
+def test_normalize_gray_matches_float64_preprocessing(variant):
+    use_variant(variant)
+    from dataset import prepare_img
+    from utils import normalize_gray
+
+    rng = np.random.RandomState(0)
+    mean_I = np.reshape(np.array([118.93, 113.97, 102.60]), (1, 1, 3))
+    std_I = np.reshape(np.array([69.85, 68.81, 72.45]), (1, 1, 3))
+    frames = [rng.randint(0, 256, (36, 64, 3)).astype(np.uint8) for _ in range(4)]
+    # every value of every channel, and the extremes on all channels at once
+    frames[0][:16, :16] = np.arange(256, dtype=np.uint8).reshape(16, 16, 1)
+    frames[0][16] = 0
+    frames[0][17] = 255
+
+    def batch(keep_uint8):
+        samples = [np.concatenate([prepare_img(img, mean_I, std_I, keep_uint8) for img in frames[i:i + 2]], axis=0)
+                   for i in (0, 2)]
+        return torch.tensor(np.stack(samples))
+
+    float_batch, uint8_batch = batch(False), batch(True)
+    assert float_batch.dtype == torch.float64 and uint8_batch.dtype == torch.uint8
+    # bit-exact: normalize_gray runs numpy's float64 operations in numpy's order
+    assert torch.equal(normalize_gray(uint8_batch), float_batch.float())